@@ -0,0 +1,90 @@
+# Parity of the numpy backend (NumpyDenseModel on the model exported by convert_NN_model.py)
+# with the keras model, on the windows the UDF builds from the recorded time series in
+# EX_files. The windows are taken from the UDF run of the replayed pipeline (openeo_replay.py).
+# Without tensorflow the numpy backend is checked against the predictions of the keras model
+# stored in EX_files/NN_model_keras_predictions.npz (the windows of the UDF run and random
+# windows, predicted with tensorflow 2.11).
+
+import os
+from pathlib import Path
+import numpy as np
+import pytest
+
+from Crop_calendars.Crop_calendars_openeo_integration import Cropcalendars
+from Crop_calendars.Terrascope_catalogue_retrieval import OpenSearch
+from Crop_calendars.benchmark_pipeline import METRICS_ORDER, PARAMETERS_EVENT, PATH_NN_MODEL
+from Crop_calendars.convert_NN_model import export_NN_model_npz
+from Crop_calendars.openeo_replay import ReplayConnection, StubCatalogueServer
+
+PATH_CROP_CALENDARS = Path(__file__).resolve().parents[2] / 'src' / 'Crop_calendars'
+PATH_FIELDS = Path(__file__).resolve().parent / 'EX_files' / 'Field_test.geojson'
+PATH_KERAS_PREDICTIONS = Path(__file__).resolve().parent / 'EX_files' / 'NN_model_keras_predictions.npz'
+START, END = '2019-01-01', '2019-12-31'
+TOLERANCE = 1e-5
+
+
+# replayed backend which keeps the model input of the windows predicted in the UDF
+class WindowsReplayConnection(ReplayConnection):
+    def __init__(self):
+        super().__init__()
+        self.windows = []
+
+    def exec_udf(self, udf):
+        udf_globals = super().exec_udf(udf)
+        predict_batched = udf_globals['predict_batched']
+
+        def predict_batched_windows(loaded_model, x_test, batch_size=4096):
+            self.windows.append(np.asarray(x_test, dtype=np.float32))
+            return predict_batched(loaded_model, x_test, batch_size)
+        udf_globals['predict_batched'] = predict_batched_windows
+        return udf_globals
+
+
+@pytest.fixture(scope='module')
+def path_npz(tmp_path_factory):
+    return export_NN_model_npz(str(PATH_NN_MODEL), str(tmp_path_factory.mktemp('model') / 'model.npz'))
+
+
+@pytest.fixture(scope='module')
+def ex_files_windows(path_npz):
+    connection = WindowsReplayConnection()
+    # the UDF is read from the Crop_calendars folder
+    cwd = os.getcwd()
+    os.chdir(str(PATH_CROP_CALENDARS))
+    try:
+        with StubCatalogueServer(connection.acquisitions(START, END)) as catalogue:
+            generator = Cropcalendars(fAPAR_rescale_Openeo=0.005, coherence_rescale_Openeo=0.004, path_harvest_model=path_npz,
+                                      VH_VV_range_normalization=[-13, -3.5], fAPAR_range_normalization=[0, 1], metrics_order=METRICS_ORDER,
+                                      connection=connection, NN_model_backend='numpy', open_search=OpenSearch(catalogue.url, cache_dir=None),
+                                      poll_interval=0, cropsar_backend='stub')
+            generator.generate_cropcalendars(START, END, str(PATH_FIELDS), **PARAMETERS_EVENT)
+    finally:
+        os.chdir(cwd)
+    return np.concatenate(connection.windows)
+
+
+def test_ex_files_windows(ex_files_windows):
+    # a window has the 2 metrics (cropSAR, VH/VV) of window_values dates
+    assert ex_files_windows.shape[0] > 0
+    assert ex_files_windows.shape[1] == len(PARAMETERS_EVENT['metrics_crop_event']) * PARAMETERS_EVENT['window_values']
+    assert np.isfinite(ex_files_windows).any()
+
+
+def test_numpy_backend_parity(ex_files_windows, path_npz):
+    tensorflow_keras = pytest.importorskip('tensorflow.keras.models')
+    from Crop_calendars.crop_calendar_udf import NumpyDenseModel
+
+    predictions_keras = tensorflow_keras.load_model(str(PATH_NN_MODEL)).predict(ex_files_windows)
+    predictions_numpy = NumpyDenseModel(path_npz).predict(ex_files_windows)
+    assert predictions_numpy.shape == predictions_keras.shape
+    np.testing.assert_allclose(predictions_numpy, predictions_keras, rtol=0, atol=TOLERANCE)
+
+
+def test_numpy_backend_keras_predictions(path_npz):
+    from Crop_calendars.crop_calendar_udf import NumpyDenseModel
+
+    with np.load(str(PATH_KERAS_PREDICTIONS)) as keras_predictions:
+        windows, predictions_keras = keras_predictions['windows'], keras_predictions['predictions']
+    predictions_numpy = NumpyDenseModel(path_npz).predict(windows)
+    assert predictions_numpy.shape == predictions_keras.shape
+    np.testing.assert_allclose(predictions_numpy, predictions_keras, rtol=0, atol=TOLERANCE)
@@ -0,0 +1,45 @@
+# The windows of the NN model must stay bit-identical to the windows of the former UDF (the
+# wide dataframe with a column per field and metric, as of the strided windowing). The input
+# time series (synthetic, with missing values and fields on different date grids) and the
+# windows which that UDF made of them are stored in EX_files/windows_reference.npz.
+
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pytest
+
+from Crop_calendars.benchmark_pipeline import METRICS_ORDER
+from Crop_calendars.crop_calendar_udf import prepare_df_NN_model, prepare_timeseries
+
+PATH_REFERENCE = Path(__file__).resolve().parent / 'EX_files' / 'windows_reference.npz'
+WINDOW_VALUES = 5
+METRICS_CROP_EVENT = ['cropSAR', 'VH_VV_{}']
+
+
+@pytest.fixture(scope='module')
+def reference():
+    with np.load(str(PATH_REFERENCE)) as npz:
+        return dict(npz)
+
+
+def test_windows_reference(reference):
+    values = reference['values']
+    ids_fields = [str(f) for f in range(values.shape[1])]
+    ts_df = pd.DataFrame(values.reshape(values.shape[0], -1), index=pd.to_datetime(reference['dates']).date,
+                         columns=pd.MultiIndex.from_product([range(values.shape[1]), range(values.shape[2])]))
+    ts_df_cropsar = pd.DataFrame(reference['values_cropsar'], index=pd.to_datetime(reference['dates_cropsar']).date,
+                                 columns=[id_field + '_cropSAR' for id_field in ids_fields])
+    context = {'unique_ids_fields': ids_fields, 'metrics_order': METRICS_ORDER, 'VH_VV_range_normalization': [-13, -3.5],
+               'fAPAR_range_normalization': [0, 1], 'fAPAR_rescale_Openeo': 0.005}
+    ro_s = {orbit_pass: {id_field: {str(first_dates[p]): 1} for id_field, first_dates in zip(ids_fields, reference['first_dates'])}
+            for p, orbit_pass in enumerate(['descending', 'ascending'])}
+
+    ts_fields = prepare_timeseries(ts_df, ts_df_cropsar, context)
+    df_windows = prepare_df_NN_model(ts_fields, WINDOW_VALUES, ids_fields, ro_s, METRICS_CROP_EVENT)
+
+    windows = df_windows.iloc[:, :len(METRICS_CROP_EVENT) * WINDOW_VALUES].values
+    assert windows.dtype == np.float64
+    # exact comparison, the NaN padding included
+    np.testing.assert_array_equal(windows, reference['windows'])
+    assert list(df_windows.index) == list(reference['index_window'])
+    assert np.array_equal(np.array(df_windows['prediction_date_window'].values, dtype='datetime64[D]'), reference['dates_window'])
@@ -0,0 +1,120 @@
+# Tests of the RO selection of all fields at once (RO_selection.py) against the former
+# selection per field (find_optimal_RO_per_pass and the merge of the catalogue metadata and
+# the angle time series per field, copied below from the baseline): ties of the angle and
+# of the amount of acquisitions, a single orbit pass, fields without acquisitions with an
+# angle and fields missing from the angle table.
+
+import collections
+import numpy as np
+import pandas as pd
+import pytest
+
+from Crop_calendars.RO_selection import RO_angle_table, select_RO_fields, RO_selection_to_dicts
+
+ORBIT_PASSES = ['ASCENDING', 'DESCENDING']
+
+
+# the former selection of the RO of an orbit pass of a field. statistics.mode is replaced
+# by the mode of python >= 3.8 (the first of the most common values), before python 3.8
+# statistics.mode raised an error on ties
+def find_optimal_RO_per_pass(dict_orbit_metadata_frequency_info, dict_angle_orbit_pass):
+    RO_orbit_counter = collections.Counter(list(dict_orbit_metadata_frequency_info.values()))
+    RO_steepest_angle = max(dict_angle_orbit_pass, key=lambda x: dict_angle_orbit_pass[x])
+    if RO_orbit_counter.get(RO_steepest_angle) < int(max(list(RO_orbit_counter.values())) * 0.80):
+        RO_orbit_selection = max(RO_orbit_counter, key=RO_orbit_counter.get)
+    else:
+        RO_orbit_selection = RO_steepest_angle
+    list_orbit_passes = sorted(list(
+        (key) for key, value in dict_orbit_metadata_frequency_info.items() if value == RO_orbit_selection))
+    dict_metadata_RO_selection = {list_orbit_passes[0].strftime('%Y-%m-%d'): RO_orbit_selection}
+    return dict_metadata_RO_selection, RO_orbit_selection
+
+
+# the former merge of the catalogue metadata and the angle of a field (Opensearch_OpenEO_RO_selection)
+def former_RO_selection(orbits_field, angle_fields, orbit_pass, s):
+    dict_orbits_field = orbits_field[1] if orbit_pass == 'ASCENDING' else orbits_field[0]
+    df_RO_pass = pd.DataFrame(data=list(dict_orbits_field.values()), columns=(['RO']), index=dict_orbits_field.keys())
+    df_RO_pass.index = pd.to_datetime(df_RO_pass.index)
+    df_RO_pass = df_RO_pass.tz_localize(None)
+    df_angle_pass = angle_fields['{}'.format(orbit_pass)].iloc[:, s]
+    df_angle_pass.index = pd.to_datetime(df_angle_pass.index)
+    df_angle_pass = df_angle_pass.tz_localize(None)
+    df_pass_combine = df_RO_pass.merge(df_angle_pass, left_index=True, right_index=True, how='inner')
+    dict_angle_pass = df_pass_combine.set_index('RO').T.reset_index(drop=True).to_dict(orient='records')[0]
+    columns_df = [item for item in list(df_pass_combine.columns.values) if not 'angle' in item]
+    dict_metadata_pass = df_pass_combine[columns_df].to_dict()[columns_df[0]]
+    return find_optimal_RO_per_pass(dict_metadata_pass, dict_angle_pass)[0]
+
+
+# function to generate the catalogue metadata ((descending, ascending) dicts of date: RO per field)
+# and the angle time series (as get_angle_timeseries) of fields with a few RO's per orbit pass. The
+# angles are taken from a few values, so that several RO's have the same (steepest) angle
+def random_fields(amount_fields, seed, amount_dates=40):
+    random = np.random.RandomState(seed)
+    dates = pd.date_range('2019-01-01', periods=amount_dates, freq='D')
+    orbits_fields = [tuple(dict() for _ in ORBIT_PASSES) for _ in range(amount_fields)]
+    angle_fields = dict()
+    for loc_pass, orbit_pass in zip([1, 0], ORBIT_PASSES):
+        angles = np.full((amount_dates, amount_fields), np.nan)
+        for s in range(amount_fields):
+            ROs = random.choice([37, 88, 110, 161], random.randint(1, 4), replace=False)
+            angles_RO = dict(zip(ROs, random.choice([35., 38., 41.], len(ROs))))
+            for d in np.sort(random.choice(amount_dates, random.randint(1, 15), replace=False)):
+                RO = random.choice(ROs)
+                orbits_fields[s][loc_pass][str(dates[d].date())] = int(RO)
+                angles[d, s] = angles_RO[RO]
+        angle_fields[orbit_pass] = pd.DataFrame(angles, index=[str(date.date()) + 'T00:00:00Z' for date in dates],
+                                                columns=['{}_angle'.format(s) for s in range(amount_fields)])
+    return orbits_fields, angle_fields
+
+
+def selection(orbits_fields, angle_fields, ids_fields, orbit_passes=ORBIT_PASSES):
+    return RO_selection_to_dicts(select_RO_fields(RO_angle_table(orbits_fields, angle_fields, orbit_passes)), ids_fields, orbit_passes)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_RO_selection_former(seed):
+    orbits_fields, angle_fields = random_fields(50, seed)
+    ids_fields = ['field_{}'.format(s) for s in range(len(orbits_fields))]
+    dicts_passes = selection(orbits_fields, angle_fields, ids_fields)
+    for orbit_pass, dict_pass in zip(ORBIT_PASSES, dicts_passes):
+        assert dict_pass == {ids_fields[s]: former_RO_selection(orbits_fields[s], angle_fields, orbit_pass, s) for s in range(len(orbits_fields))}
+
+
+def test_RO_selection_ties():
+    dates = ['2019-01-0{}'.format(d) for d in range(1, 10)]
+    angle_fields = {orbit_pass: pd.DataFrame({'0_angle': [40.] * 9, '1_angle': [40.] * 9}, index=dates) for orbit_pass in ORBIT_PASSES}
+    # field 0: the same angle and amount of acquisitions, the first RO is selected
+    # field 1: 161 has the steepest angle (the angle of a RO is the angle of its last acquisition)
+    # with 3 acquisitions against 4 of 110, which is not fewer than int(4 * 0.8)
+    angle_fields['ASCENDING'].loc['2019-01-02', '1_angle'] = 39.
+    angle_fields['ASCENDING'].loc['2019-01-06', '1_angle'] = 41.
+    orbits_fields = [({}, {dates[0]: 110, dates[1]: 88, dates[2]: 110, dates[3]: 88}),
+                     ({}, {dates[0]: 110, dates[1]: 161, dates[2]: 110, dates[3]: 161, dates[4]: 110, dates[5]: 161, dates[6]: 110})]
+    ids_fields = ['a', 'b']
+    expected = {'a': {'2019-01-01': 110}, 'b': {'2019-01-02': 161}}
+    assert selection(orbits_fields, angle_fields, ids_fields, ['ASCENDING']) == [expected]
+    assert expected == {ids_fields[s]: former_RO_selection(orbits_fields[s], angle_fields, 'ASCENDING', s) for s in range(2)}
+
+
+def test_RO_selection_single_pass():
+    orbits_fields, angle_fields = random_fields(10, 0)
+    ids_fields = [str(s) for s in range(10)]
+    dict_descending, = selection(orbits_fields, {'DESCENDING': angle_fields['DESCENDING']}, ids_fields, ['DESCENDING'])
+    assert dict_descending == selection(orbits_fields, angle_fields, ids_fields)[1]
+    assert dict_descending == {ids_fields[s]: former_RO_selection(orbits_fields[s], angle_fields, 'DESCENDING', s) for s in range(10)}
+
+
+def test_RO_selection_no_valid_RO():
+    orbits_fields, angle_fields = random_fields(6, 1)
+    ids_fields = [str(s) for s in range(6)]
+    # field 2 has no acquisitions of the catalogue with an angle (the former selection failed on this)
+    orbits_fields[2] = ({'2018-12-01': 37}, {})
+    # fields 4 and 5 are missing from the angle table
+    angle_fields = {orbit_pass: angle_fields[orbit_pass].iloc[:, :4] for orbit_pass in ORBIT_PASSES}
+    dict_ascending, dict_descending = selection(orbits_fields, angle_fields, ids_fields)
+    for orbit_pass, dict_pass in zip(ORBIT_PASSES, [dict_ascending, dict_descending]):
+        assert list(dict_pass) == ['0', '1', '3']
+        assert dict_pass == {ids_fields[s]: former_RO_selection(orbits_fields[s], angle_fields, orbit_pass, s) for s in [0, 1, 3]}
+        with pytest.raises(IndexError):
+            former_RO_selection(orbits_fields[2], angle_fields, orbit_pass, 2)
@@ -0,0 +1,61 @@
+# Tests of batch_crop_calendars.py with the replayed openEO backend and the stub catalogue:
+# a finished file is skipped (and not part of the throughput) and processed again when
+# the time range, the parameters or the output format change.
+
+import json
+import os
+from pathlib import Path
+import pytest
+
+from Crop_calendars import batch_crop_calendars
+from Crop_calendars.Terrascope_catalogue_retrieval import OpenSearch
+from Crop_calendars.benchmark_pipeline import PATH_NN_MODEL, synthetic_fields_geojson
+from Crop_calendars.convert_NN_model import export_NN_model_npz
+from Crop_calendars.openeo_replay import ReplayConnection, StubCatalogueServer
+
+PATH_CROP_CALENDARS = Path(__file__).resolve().parents[2] / 'src' / 'Crop_calendars'
+START, END = '2019-01-01', '2019-12-31'
+
+
+@pytest.fixture
+def batch(tmp_path, monkeypatch, capsys):
+    # the UDF is read from the Crop_calendars folder
+    monkeypatch.chdir(str(PATH_CROP_CALENDARS))
+    path_model = export_NN_model_npz(str(PATH_NN_MODEL), str(tmp_path / 'model.npz'))
+    synthetic_fields_geojson(12, str(tmp_path / 'fields.geojson'))
+    connection = ReplayConnection()
+    with StubCatalogueServer(connection.acquisitions(START, END)) as catalogue:
+        def run(*options, end=END):
+            argv = [str(tmp_path / 'fields.geojson'), '--outdir', str(tmp_path / 'out'), '--start', START, '--end', end,
+                    '--chunk-size', '5', '--model', path_model, '--NN-model-backend', 'numpy', '--cropsar-backend', 'stub'] + list(options)
+            capsys.readouterr()
+            assert batch_crop_calendars.main(argv, connection=connection, open_search=OpenSearch(catalogue.url, cache_dir=None)) == 0
+            output = capsys.readouterr().out
+            summary = json.loads(output.split('THROUGHPUT SUMMARY: ')[1].splitlines()[0])
+            return summary, 'ALREADY PROCESSED' in output
+        yield run
+
+
+def test_checkpoint_settings(batch, tmp_path):
+    summary, skipped = batch()
+    assert not skipped and summary['fields'] == summary['fields_processed'] == 12
+    assert os.path.exists(str(tmp_path / 'out' / 'fields_cropcalendars.geojson.checkpoint.json'))
+
+    # finished: skipped, its fields are not part of the throughput
+    summary, skipped = batch()
+    assert skipped and summary['fields_skipped'] == 12 and summary['fields_processed'] == 0
+    assert summary['fields_per_s'] == 0
+
+    # another time range or other parameters: processed again
+    summary, skipped = batch(end='2019-11-30')
+    assert not skipped and summary['fields_processed'] == 12
+    summary, skipped = batch('--thr-detection', '0.5', end='2019-11-30')
+    assert not skipped and summary['fields_processed'] == 12
+
+
+def test_checkpoint_output_format(batch, tmp_path):
+    batch()
+    summary, skipped = batch('--output-format', 'geojsonseq')
+    assert not skipped and summary['fields_processed'] == 12
+    assert os.path.exists(str(tmp_path / 'out' / 'fields_cropcalendars.geojsons'))
+    assert batch()[1]
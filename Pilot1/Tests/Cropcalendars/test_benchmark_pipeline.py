@@ -0,0 +1,82 @@
+# Benchmarks (pytest-benchmark) of the stages of the crop calendar pipeline with the replayed
+# openEO backend and the stub catalogue, on synthetic sets of fields (see benchmark_pipeline.py).
+# Each stage runs once per amount of fields (--benchmark-fields), the large amounts
+# (--benchmark-fields-chunked) are processed as a whole with generate_cropcalendars_chunked.
+# usage: pytest Tests/Cropcalendars/test_benchmark_pipeline.py --benchmark-fields 10,1000 --benchmark-fields-chunked 100000
+
+import os
+import resource
+from pathlib import Path
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from Crop_calendars.benchmark_pipeline import PipelineBenchmark
+
+PATH_CROP_CALENDARS = Path(__file__).resolve().parents[2] / 'src' / 'Crop_calendars'
+CHUNK_SIZE = 500
+
+
+def pytest_generate_tests(metafunc):
+    for name, option in [('amount_fields', '--benchmark-fields'), ('amount_fields_chunked', '--benchmark-fields-chunked')]:
+        if name in metafunc.fixturenames:
+            metafunc.parametrize(name, [int(amount) for amount in metafunc.config.getoption(option).split(',')], scope='module')
+
+
+@pytest.fixture(scope='module')
+def workdir(tmp_path_factory):
+    return str(tmp_path_factory.mktemp('benchmark_pipeline'))
+
+
+@pytest.fixture(scope='module')
+def crop_calendars_folder():
+    # the UDF is read from the Crop_calendars folder
+    cwd = os.getcwd()
+    os.chdir(str(PATH_CROP_CALENDARS))
+    yield
+    os.chdir(cwd)
+
+
+@pytest.fixture(scope='module')
+def pipeline(amount_fields, workdir, crop_calendars_folder):
+    with PipelineBenchmark(amount_fields, workdir) as pipeline:
+        yield pipeline
+
+
+def run_stage(benchmark, pipeline, name):
+    benchmark.extra_info['fields'] = pipeline.amount_fields
+    # the stages are slow and depend on the previous stages, so they run once
+    return benchmark.pedantic(getattr(pipeline, name), rounds=1, iterations=1)
+
+
+def test_geometry(benchmark, pipeline):
+    assert len(run_stage(benchmark, pipeline, 'geometry').features) == pipeline.amount_fields
+
+
+def test_catalogue(benchmark, pipeline):
+    assert len(run_stage(benchmark, pipeline, 'catalogue_fields')) == pipeline.amount_fields
+
+
+def test_timeseries(benchmark, pipeline):
+    assert run_stage(benchmark, pipeline, 'timeseries')
+
+
+def test_RO_selection(benchmark, pipeline):
+    assert run_stage(benchmark, pipeline, 'RO_selection')['field'].nunique() == pipeline.amount_fields
+
+
+def test_udf(benchmark, pipeline):
+    run_stage(benchmark, pipeline, 'udf')
+
+
+def test_total(benchmark, pipeline):
+    assert run_stage(benchmark, pipeline, 'total') == pipeline.amount_fields
+
+
+def test_total_chunked(benchmark, amount_fields_chunked, workdir, crop_calendars_folder):
+    with PipelineBenchmark(amount_fields_chunked, workdir) as pipeline:
+        amount_result = benchmark.pedantic(pipeline.total, args=(CHUNK_SIZE,), rounds=1, iterations=1)
+    assert amount_result == amount_fields_chunked
+    benchmark.extra_info.update({'fields': amount_fields_chunked, 'chunk_size': CHUNK_SIZE,
+                                 'fields_per_s': amount_fields_chunked / benchmark.stats.stats.total,
+                                 'maxrss_MB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024})
@@ -0,0 +1,69 @@
+# Tests of the persistent cache of the catalogue responses (catalogue_cache.py): the expiry of
+# the recent requests after ttl (the historical requests don't expire), the eviction of the least
+# recently used responses and the connections to the database, which are closed after each operation.
+
+import datetime
+import sqlite3
+import types
+import pytest
+
+from Crop_calendars import catalogue_cache
+from Crop_calendars.catalogue_cache import CatalogueCache
+
+URL = 'https://services.terrascope.be/catalogue/products?collection=urn&start=2019-01-01&end={}&bbox=4.5,50.9,4.6,51.0'
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # the time of the cache, moved forward by the tests
+    clock = types.SimpleNamespace(now=1000000.)
+    monkeypatch.setattr(catalogue_cache, 'time', types.SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def test_cache_ttl(tmp_path, clock):
+    cache = CatalogueCache(str(tmp_path), ttl=3600, recent_days=30)
+    url_recent = URL.format(datetime.date.today())
+    url_historical = URL.format('2019-12-31')
+    cache.put(url_recent, {'features': [1]})
+    cache.put(url_historical, {'features': [2]})
+    clock.now += 3599
+    assert cache.get(url_recent) == {'features': [1]}
+    clock.now += 2
+    assert cache.get(url_recent) is None
+    assert cache.get(url_historical) == {'features': [2]}
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['expired'], stats['entries']) == (2, 1, 1, 1)
+
+
+def test_cache_eviction(tmp_path, clock):
+    cache = CatalogueCache(str(tmp_path), max_size_bytes=10 ** 6)
+    urls = [URL.format('2019-0{}-28'.format(month)) for month in range(1, 5)]
+    for url in urls[:3]:
+        clock.now += 1
+        cache.put(url, {'features': [url] * 10})
+    # the size of a response, the cache fits 3 responses
+    cache.max_size_bytes = cache.stats()['size_bytes'] + 1
+    clock.now += 1
+    assert cache.get(urls[0]) is not None
+    clock.now += 1
+    cache.put(urls[3], {'features': [urls[3]] * 10})
+    # the least recently used response (the second, the first was used after it) is removed
+    assert [cache.get(url) is not None for url in urls] == [True, False, True, True]
+    assert cache.stats()['evictions'] == 1 and cache.stats()['entries'] == 3
+
+
+def test_cache_connections_closed(tmp_path, sqlite_connections):
+    connections = sqlite_connections(catalogue_cache)
+    cache = CatalogueCache(str(tmp_path))
+    cache.put(URL.format('2019-12-31'), {'features': []})
+    cache.get(URL.format('2019-12-31'))
+    cache.get(URL.format('2019-11-30'))
+    cache.stats()
+    cache.clear()
+    assert not connections
+    # also after an error within the operation
+    with pytest.raises(sqlite3.OperationalError):
+        with cache._connect() as conn:
+            conn.execute('SELECT * FROM unknown_table')
+    assert not connections
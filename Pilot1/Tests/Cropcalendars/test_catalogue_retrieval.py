@@ -0,0 +1,103 @@
+# Tests of the catalogue client (OpenSearch) against the stub catalogue of openeo_replay.py:
+# the pages of the products, the retries of failed requests, empty results and the
+# assignment of the products of a cluster request to its fields.
+
+import datetime
+import geojson
+import pytest
+import requests
+
+from Crop_calendars.Terrascope_catalogue_retrieval import OpenSearch
+from Crop_calendars.openeo_replay import StubCatalogueServer
+
+START, END = '2019-01-01', '2019-12-31'
+
+
+# function to get the acquisitions of the orbit passes every 6 days (alternating between 2 RO's)
+def acquisitions(start=START, end=END):
+    start = datetime.date.fromisoformat(start)
+    dates = [start + datetime.timedelta(days=d) for d in range(0, (datetime.date.fromisoformat(end) - start).days + 1, 6)]
+    return {'ASCENDING': {str(date): (88, 161)[d % 2] for d, date in enumerate(dates)},
+            'DESCENDING': {str(date + datetime.timedelta(days=1)): (37, 110)[d % 2] for d, date in enumerate(dates)}}
+
+
+def field(x, y, size=0.001):
+    return geojson.Feature(geometry=geojson.Polygon([[(x, y), (x + size, y), (x + size, y + size), (x, y + size), (x, y)]]), properties={})
+
+
+def test_pagination():
+    with StubCatalogueServer(acquisitions(), items_per_page=7) as catalogue:
+        open_search = OpenSearch(catalogue.url, max_workers=3)
+        features = open_search.retrieveProductsFeatures([open_search.getRequestProducts('urn', catalogue.url, start=START, end=END)])[0]
+        amount_products = sum(len(item) for item in acquisitions().values())
+        assert len(features) == amount_products
+        assert len(set(f['id'] for f in features)) == amount_products
+        # the first page and the other pages
+        assert catalogue.stats['requests'] == -(-amount_products // 7)
+
+
+def test_pagination_several_requests():
+    with StubCatalogueServer(acquisitions(), items_per_page=10) as catalogue:
+        open_search = OpenSearch(catalogue.url)
+        requests_products = [open_search.getRequestProducts('urn', catalogue.url, start=start, end=end)
+                             for start, end in [(START, '2019-03-31'), ('2019-04-01', END), (START, END)]]
+        features_requests = open_search.retrieveProductsFeatures(requests_products)
+        assert len(features_requests[0]) + len(features_requests[1]) == len(features_requests[2])
+
+
+def test_retries():
+    with StubCatalogueServer(acquisitions(), items_per_page=1000, fail_requests=2) as catalogue:
+        open_search = OpenSearch(catalogue.url, max_retries=3, backoff_factor=0)
+        descending, ascending = open_search.findProducts('urn', catalogue.url, start=START, end=END)
+        assert descending == acquisitions()['DESCENDING']
+        assert ascending == acquisitions()['ASCENDING']
+        assert catalogue.stats['requests'] == 2 + 1
+
+
+def test_retries_exhausted():
+    with StubCatalogueServer(acquisitions(), items_per_page=1000, fail_requests=10) as catalogue:
+        open_search = OpenSearch(catalogue.url, max_retries=2, backoff_factor=0)
+        with pytest.raises(requests.exceptions.RetryError):
+            open_search.findProducts('urn', catalogue.url, start=START, end=END)
+        assert catalogue.stats['requests'] == 1 + 2
+
+
+def test_empty_results():
+    with StubCatalogueServer(acquisitions()) as catalogue:
+        open_search = OpenSearch(catalogue.url)
+        request_products = open_search.getRequestProducts('urn', catalogue.url, start='2020-01-01', end='2020-12-31')
+        assert open_search.retrieveProductsFeatures([request_products]) == [[]]
+        assert open_search.findProducts('urn', catalogue.url, start='2020-01-01', end='2020-12-31') == ({}, {})
+        assert catalogue.stats['requests'] == 2
+
+
+def test_fields_clusters():
+    # 3 nearby fields and 1 field further away
+    fields = [field(4.5, 50.9), field(4.502, 50.9), field(4.5, 50.902), field(5.5, 51.1)]
+    with StubCatalogueServer(acquisitions(), items_per_page=1000) as catalogue:
+        metadata_clusters = OpenSearch(catalogue.url, cluster_size=0.1).OpenSearch_metadata_retrieval_fields(START, END, fields)
+        requests_clusters = catalogue.stats['requests']
+    with StubCatalogueServer(acquisitions(), items_per_page=1000) as catalogue:
+        metadata_fields = OpenSearch(catalogue.url, cluster_size=None).OpenSearch_metadata_retrieval_fields(START, END, fields)
+        requests_fields = catalogue.stats['requests']
+    assert metadata_clusters == metadata_fields
+    assert metadata_fields[0] == (acquisitions()['DESCENDING'], acquisitions()['ASCENDING'])
+    # the collections and a request per cluster or per field
+    assert (requests_clusters, requests_fields) == (1 + 2, 1 + 4)
+
+
+def test_fields_footprints():
+    # the products of RO 88 and 37 only cover the west, the products of 161 and 110 cover all fields but the last
+    footprints = {88: (2.5, 49.4, 5.0, 51.6), 37: (2.5, 49.4, 5.0, 51.6)}
+    acquisitions_east = {orbit_pass: {date: RO for date, RO in acquisitions_pass.items() if RO not in footprints}
+                         for orbit_pass, acquisitions_pass in acquisitions().items()}
+    # 2 fields in the west, a field on the edge of the footprint of 88 and 37, a field in the east and a field outside all footprints
+    fields = [field(4.5, 50.9), field(4.6, 50.95), field(4.9995, 50.9), field(5.5, 51.1), field(8.0, 51.0)]
+    # per field and all fields in a single request (cell of 10 degrees)
+    for cluster_size, amount_requests in [(None, 1 + 5), (10, 1 + 1)]:
+        with StubCatalogueServer(acquisitions(), items_per_page=1000, footprints=footprints) as catalogue:
+            metadata_fields = OpenSearch(catalogue.url, cluster_size=cluster_size).OpenSearch_metadata_retrieval_fields(START, END, fields)
+            assert catalogue.stats['requests'] == amount_requests
+        assert metadata_fields[:3] == [(acquisitions()['DESCENDING'], acquisitions()['ASCENDING'])] * 3
+        assert metadata_fields[3] == (acquisitions_east['DESCENDING'], acquisitions_east['ASCENDING'])
+        assert metadata_fields[4] == ({}, {})
@@ -0,0 +1,93 @@
+# The mask of create_mask with separable kernels must be the same as with the 2D kernels (also
+# at the borders of the raster) and the parcel-aware mask the same as the full mask within the
+# parcels, checked with the NumPy reference (create_mask_numpy) on a synthetic raster. create_mask
+# loads a single bbox around all parcels (parcels_extent) instead of a window per parcel: within
+# the parcels the mask is the same, the bbox contains the reach of the kernels around the parcels.
+
+import numpy as np
+import pytest
+import shapely.geometry
+
+from Crop_calendars.benchmark_mask import synthetic_scl
+from Crop_calendars.create_mask import KERNEL_SIZE_CLOUD, RESOLUTION_SCL, convolve_gaussian_numpy, create_mask_numpy, makekernel, makekernel_1d, parcels_extent
+
+TOLERANCE = 1e-12
+
+
+@pytest.fixture(scope='module')
+def scl_parcels():
+    # smaller than the cloud kernel, so that all pixels are within its reach of the border
+    return synthetic_scl(128, amount_clouds=4, amount_parcels=10, seed=1)
+
+
+@pytest.mark.parametrize('iwindowsize', [17, 161])
+def test_kernel_separable(iwindowsize):
+    kernel_vect = makekernel_1d(iwindowsize)
+    np.testing.assert_allclose(np.outer(kernel_vect, kernel_vect), makekernel(iwindowsize), rtol=0, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize('iwindowsize', [17, 161])
+def test_convolve_separable_borders(iwindowsize):
+    raster = np.random.RandomState(0).uniform(size=(64, 96)) > 0.7
+    np.testing.assert_allclose(convolve_gaussian_numpy(raster, iwindowsize, 'separable'),
+                               convolve_gaussian_numpy(raster, iwindowsize, 'direct'), rtol=0, atol=TOLERANCE)
+
+
+def test_mask_separable(scl_parcels):
+    scl, _ = scl_parcels
+    convolved_valid_direct, convolved_cloud_direct, mask_direct = create_mask_numpy(scl, 'direct')
+    convolved_valid, convolved_cloud, mask = create_mask_numpy(scl, 'separable')
+    np.testing.assert_allclose(convolved_valid, convolved_valid_direct, rtol=0, atol=TOLERANCE)
+    np.testing.assert_allclose(convolved_cloud, convolved_cloud_direct, rtol=0, atol=TOLERANCE)
+    np.testing.assert_array_equal(mask, mask_direct)
+    # the raster has masked and kept pixels
+    assert 0 < mask.sum() < mask.size
+
+
+def test_mask_parcels(scl_parcels):
+    scl, parcels = scl_parcels
+    _, _, mask_full = create_mask_numpy(scl, 'direct')
+    convolved_valid, convolved_cloud, mask_parcels = create_mask_numpy(scl, 'separable', parcels)
+    in_parcels = parcels > 0
+    np.testing.assert_array_equal(mask_parcels[in_parcels], mask_full[in_parcels])
+    assert not np.isnan(convolved_valid[in_parcels]).any() and not np.isnan(convolved_cloud[in_parcels]).any()
+
+
+def test_mask_parcels_window(scl_parcels):
+    # a single parcel far from the other parcels: its window is smaller than the raster
+    scl = np.tile(scl_parcels[0], (3, 3))
+    parcels = np.zeros(scl.shape, dtype=np.int32)
+    parcels[190:200, 200:215] = 1
+    assert 190 - KERNEL_SIZE_CLOUD // 2 > 0
+    _, _, mask_full = create_mask_numpy(scl, 'separable')
+    _, _, mask_parcels = create_mask_numpy(scl, 'separable', parcels)
+    np.testing.assert_array_equal(mask_parcels[parcels > 0], mask_full[parcels > 0])
+    assert mask_parcels[parcels == 0].all()
+
+
+def test_mask_parcels_single_window(scl_parcels):
+    # two parcels far apart: the single window around them (as parcels_extent) contains the pixels between them
+    scl = np.tile(scl_parcels[0], (3, 3))
+    parcels = np.zeros(scl.shape, dtype=np.int32)
+    parcels[20:30, 20:35] = 1
+    parcels[330:340, 300:310] = 2
+    _, _, mask_full = create_mask_numpy(scl, 'separable')
+    _, _, mask_parcels = create_mask_numpy(scl, 'separable', parcels)
+    _, _, mask_single = create_mask_numpy(scl, 'separable', parcels, per_parcel=False)
+    in_parcels = parcels > 0
+    np.testing.assert_array_equal(mask_single[in_parcels], mask_parcels[in_parcels])
+    np.testing.assert_array_equal(mask_single[20:340, 20:310], mask_full[20:340, 20:310])
+    # the pixels between the parcels are only processed in the single window
+    assert mask_parcels[parcels == 0].all() and not mask_single[parcels == 0].all()
+
+
+@pytest.mark.parametrize('latitude', [0., 50.9, -60.])
+def test_parcels_extent(latitude):
+    parcels = shapely.geometry.MultiPolygon([shapely.geometry.box(4.5, latitude, 4.51, latitude + 0.01),
+                                             shapely.geometry.box(5.2, latitude + 0.3, 5.21, latitude + 0.31)])
+    west, south, east, north = parcels_extent(parcels)
+    # the bbox of all parcels, extended (at least) with the reach of the cloud kernel
+    reach_m = (KERNEL_SIZE_CLOUD // 2) * RESOLUTION_SCL
+    meters_lon = 111320. * np.cos(np.radians(max(abs(latitude), abs(latitude + 0.31))))
+    assert (4.5 - west) * meters_lon >= reach_m - 1e-6 and (east - 5.21) * meters_lon >= reach_m - 1e-6
+    assert (latitude - south) * 111320. >= reach_m - 1e-6 and (north - latitude - 0.31) * 111320. >= reach_m - 1e-6
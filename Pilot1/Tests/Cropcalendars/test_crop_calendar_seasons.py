@@ -0,0 +1,81 @@
+# Tests of the detection of the crop calendar events per season (create_crop_calendars_seasons)
+# on windows with given model probabilities: events in two seasons, the peaks of both orbit
+# passes combined into one event, a plateau, a peak at the edge of the series and peaks below
+# thr_detection. And the settings per event from the context (get_crop_calendar_events).
+
+import numpy as np
+import pandas as pd
+
+from Crop_calendars.crop_calendar_udf import create_crop_calendars_seasons, get_crop_calendar_events
+
+AMOUNT_WINDOWS = 60 # windows every 6 days from 2019-01-01 until 2019-12-21
+SEASONS = [{'season': 'first', 'start': '2019-01-01', 'end': '2019-06-30'},
+           {'season': 'second', 'start': '2019-07-01', 'end': '2019-12-31'}]
+
+
+# function to create the windows (as the output of the NN model) of the fields with the
+# probabilities per field and orbit pass given as {index of the window: probability}
+def windows_probabilities(probabilities_fields):
+    dates = pd.date_range('2019-01-01', periods=AMOUNT_WINDOWS, freq='6D').date
+    df = []
+    for loc_field, probabilities_passes in enumerate(probabilities_fields):
+        for loc_orbit_pass, probabilities_pass in enumerate(probabilities_passes):
+            probabilities = np.zeros(AMOUNT_WINDOWS)
+            probabilities[list(probabilities_pass)] = list(probabilities_pass.values())
+            df.append(pd.DataFrame({'prediction_date_window': dates, 'loc_field': loc_field, 'loc_orbit_pass': loc_orbit_pass,
+                                    'NN_model_probability_Harvest': probabilities}))
+    return pd.concat(df, ignore_index=True)
+
+
+def test_crop_calendars_seasons():
+    df = windows_probabilities([
+        # an event in both seasons, the peaks of the orbit passes 6 days apart are one event,
+        # the peaks of the same orbit pass 60 days apart are two events
+        ({19: 0.6, 20: 0.9, 21: 0.7, 40: 0.8, 50: 0.7}, {21: 0.95, 40: 0.6}),
+        # a plateau (the first window of the plateau) and a peak at the end of the series
+        ({9: 0.6, 10: 0.9, 11: 0.9, 12: 0.9, 13: 0.6, 58: 0.7, 59: 0.8}, {}),
+        # a peak at the start of the series and a peak below thr_detection
+        ({0: 0.95, 1: 0.7, 45: 0.45}, {45: 0.4}),
+        # no peaks above thr_detection
+        ({10: 0.3, 20: 0.49}, {30: 0.2}),
+    ])
+    df_crop_calendars = create_crop_calendars_seasons(df, ['a', 'b', 'c', 'd'], SEASONS, thr_detection=0.5)
+    assert list(df_crop_calendars.columns) == ['Harvest_dates_first', 'Harvest_dates_second']
+    assert df_crop_calendars.loc['a'].tolist() == [['2019-05-04'], ['2019-08-29', '2019-10-28']]
+    assert df_crop_calendars.loc['b'].tolist() == [['2019-03-02'], ['2019-12-21']]
+    assert df_crop_calendars.loc['c'].tolist() == [['2019-01-01'], []]
+    assert df_crop_calendars.loc['d'].tolist() == [[], []]
+
+
+def test_crop_calendars_seasons_edges():
+    # the probability increases until the end of the first season and decreases in the second
+    # season: the seasons are separate series, the last window of the first season and the
+    # first window of the second season are both a peak
+    df = windows_probabilities([({28: 0.6, 29: 0.7, 30: 0.8, 31: 0.9, 32: 0.5}, {})])
+    df_crop_calendars = create_crop_calendars_seasons(df, ['a'], SEASONS, thr_detection=0.5)
+    assert df_crop_calendars.loc['a'].tolist() == [['2019-06-30'], ['2019-07-06']]
+    # the peaks of the orbit passes 24 days apart: one event, unless min_days_between_events is lower
+    df = windows_probabilities([({20: 0.9}, {24: 0.9})])
+    assert create_crop_calendars_seasons(df, ['a'], SEASONS, 0.5).loc['a'].tolist() == [['2019-05-13'], []]
+    assert create_crop_calendars_seasons(df, ['a'], SEASONS, 0.5, min_days_between_events=20).loc['a'].tolist() == [['2019-05-01', '2019-05-25'], []]
+    # another event than Harvest and a field without windows
+    df = df.rename(columns={'NN_model_probability_Harvest': 'NN_model_probability_Emergence'})
+    df_crop_calendars = create_crop_calendars_seasons(df, ['a', 'b'], SEASONS[:1], 0.5, crop_calendar_event='Emergence')
+    assert df_crop_calendars.to_dict('list') == {'Emergence_dates_first': [['2019-05-13'], []]}
+
+
+def test_crop_calendar_events():
+    context = {'crop_calendar_event': 'Harvest', 'window_values': 5, 'metrics_crop_event': ['cropSAR', 'VH_VV_{}'], 'thr_detection': 0.75,
+               'index_window_above_thr': 2, 'NN_model_backend': 'keras', 'path_harvest_model': 'harvest.h5'}
+    # without list of events, the single event of the context
+    assert get_crop_calendar_events(context) == [{'crop_calendar_event': 'Harvest', 'window_values': 5, 'metrics_crop_event': ['cropSAR', 'VH_VV_{}'],
+                                                  'thr_detection': 0.75, 'index_window_above_thr': 2, 'NN_model_backend': 'keras',
+                                                  'path_model': 'harvest.h5'}]
+    # the settings which are not given for an event are taken from the context
+    context['crop_calendar_events'] = [{'crop_calendar_event': 'Emergence', 'path_model': 'emergence.npz', 'window_values': 3,
+                                        'NN_model_backend': 'numpy'},
+                                       {'crop_calendar_event': 'Harvest'}]
+    emergence, harvest = get_crop_calendar_events(context)
+    assert emergence == {'crop_calendar_event': 'Emergence', 'window_values': 3, 'metrics_crop_event': ['cropSAR', 'VH_VV_{}'],
+                         'thr_detection': 0.75, 'index_window_above_thr': 2, 'NN_model_backend': 'numpy', 'path_model': 'emergence.npz'}
+    assert harvest['path_model'] == 'harvest.h5' and harvest['window_values'] == 5
@@ -0,0 +1,56 @@
+# Tests of the cropsar curves of the fields processed in chunks (get_cropsar_TS with the
+# cropsar stub): in sequence or in a pool of processes and with a chunk size which doesn't
+# divide the amount of fields, the curves must be identical to those of all fields at once
+# and to the curve of each field on its own, also when the columns of the time series are not
+# in the order of the fields or a field has no time series.
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from Crop_calendars.benchmark_pipeline import METRICS_ORDER
+from Crop_calendars.crop_calendar_udf import get_cropsar_TS, run_cropsar_stub
+
+AMOUNT_FIELDS = 23
+FIELD_MISSING = 12
+
+
+# function to generate the time series of the fields (as timeseries_json_to_pandas: a column per
+# field and band) with missing values, dates without S2 data and the columns not in field order
+@pytest.fixture(scope='module')
+def ts_df():
+    random = np.random.RandomState(0)
+    dates = pd.date_range('2019-01-01', periods=120, freq='D').date
+    values = random.uniform(0, 200, (len(dates), AMOUNT_FIELDS, len(METRICS_ORDER)))
+    values[random.rand(*values.shape) < 0.2] = np.nan
+    index_fAPAR = METRICS_ORDER.index('fAPAR')
+    values[random.rand(len(dates)) < 0.5, :, index_fAPAR] = np.nan
+    # a field without fAPAR
+    values[:, 5, index_fAPAR] = np.nan
+    ts_df = pd.DataFrame(values.reshape(len(dates), -1), index=dates,
+                         columns=pd.MultiIndex.from_product([[str(s) for s in range(AMOUNT_FIELDS)], [str(b) for b in range(len(METRICS_ORDER))]]))
+    ts_df = ts_df.drop(columns=str(FIELD_MISSING), level=0)
+    return ts_df.iloc[::-1, random.permutation(ts_df.shape[1])]
+
+
+# the curve of a field on its own
+def cropsar_field(ts_df, s):
+    df_S2 = ts_df.loc[:, (str(s), str(METRICS_ORDER.index('fAPAR')))].sort_index().to_frame().T * 0.005
+    return run_cropsar_stub(df_S2, None, None)[0][0].values
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 10, AMOUNT_FIELDS, 100])
+@pytest.mark.parametrize('max_workers', [None, 2])
+def test_cropsar_chunks(ts_df, chunk_size, max_workers):
+    ids_fields = ['field_{}'.format(s) for s in range(AMOUNT_FIELDS)]
+    df_cropsar = get_cropsar_TS(ts_df, ids_fields, METRICS_ORDER, 0.005, cropsar_backend='stub')
+    assert list(df_cropsar.columns) == [id_field + '_cropSAR' for id_field in ids_fields]
+    assert df_cropsar.shape[0] == 120
+    for s in range(AMOUNT_FIELDS):
+        if s == FIELD_MISSING:
+            assert df_cropsar.iloc[:, s].isnull().all()
+        else:
+            np.testing.assert_array_equal(df_cropsar.iloc[:, s].values, cropsar_field(ts_df, s))
+    df_cropsar_chunks = get_cropsar_TS(ts_df, ids_fields, METRICS_ORDER, 0.005, chunk_size=chunk_size, max_workers=max_workers,
+                                       cropsar_backend='stub')
+    pd.testing.assert_frame_equal(df_cropsar_chunks, df_cropsar, check_exact=True)
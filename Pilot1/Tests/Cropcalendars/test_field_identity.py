@@ -0,0 +1,29 @@
+# Tests of the content addressed field id: the same field and settings give the same id,
+# independent of the precision of the coordinates, for all geojson geometry types.
+
+import geojson
+
+from Crop_calendars.field_identity import field_id, normalize_geometry
+
+PARAMETERS = {'window_values': 5, 'thr_detection': 0.75}
+POLYGON = geojson.Polygon([[(5.0834941864, 51.1968938283), (5.0832366943, 51.1967324716), (5.0838804245, 51.1956164058),
+                            (5.0834941864, 51.1968938283)]])
+
+
+def test_field_id_precision():
+    polygon_rounded = geojson.Polygon([[[round(x, 8), round(y, 8)] for x, y in POLYGON['coordinates'][0]]])
+    assert field_id(polygon_rounded, '2019-01-01', '2019-12-31', PARAMETERS) == field_id(POLYGON, '2019-01-01', '2019-12-31', PARAMETERS)
+
+
+def test_field_id_settings():
+    id_field = field_id(POLYGON, '2019-01-01', '2019-12-31', PARAMETERS)
+    assert field_id(POLYGON, '2019-01-01', '2020-12-31', PARAMETERS) != id_field
+    assert field_id(POLYGON, '2019-01-01', '2019-12-31', dict(PARAMETERS, thr_detection=0.8)) != id_field
+
+
+def test_field_id_geometry_collection():
+    collection = geojson.GeometryCollection([POLYGON, geojson.Point((5.08, 51.19))])
+    assert normalize_geometry(collection)['geometries'][1] == {'type': 'Point', 'coordinates': [5.08, 51.19]}
+    id_field = field_id(collection, '2019-01-01', '2019-12-31', PARAMETERS)
+    assert id_field != field_id(POLYGON, '2019-01-01', '2019-12-31', PARAMETERS)
+    assert field_id(None, '2019-01-01', '2019-12-31', PARAMETERS) != id_field
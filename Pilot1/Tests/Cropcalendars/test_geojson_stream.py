@@ -0,0 +1,98 @@
+# Tests of the streaming of geojson feature collections (geojson_stream.py): the features
+# read in small blocks, the chunks of which the last is partial and the output file of which
+# the writing is interrupted after a chunk and continued at the offset of the checkpoint
+# (writer.tell()), which must be the same file as when the writing wasn't interrupted.
+
+import json
+import pytest
+
+from Crop_calendars.geojson_stream import GeoJSONStreamWriter, iter_feature_chunks, iter_features, load_checkpoint, save_checkpoint
+
+AMOUNT_FEATURES = 23
+CHUNK_SIZE = 10
+
+
+# a field of the features file, with coordinates which geojson doesn't round
+def feature(s):
+    x = 4.5 + s * 0.002
+    return {'type': 'Feature', 'properties': {'id': str(s), 'name': 'field "{}"'.format(s), 'Harvest_date': '2019-07-{:02d}'.format(s + 1)},
+            'geometry': {'type': 'Polygon', 'coordinates': [[[round(x, 4), 50.9], [round(x + 0.0014, 4), 50.9], [round(x + 0.0014, 4), 50.9014],
+                                                                   [round(x, 4), 50.9014], [round(x, 4), 50.9]]]}}
+
+
+@pytest.fixture
+def gjson_path(tmp_path):
+    gjson_path = str(tmp_path / 'fields.geojson')
+    with open(gjson_path, 'w') as gjson_file:
+        json.dump({'type': 'FeatureCollection', 'name': 'fields', 'features': [feature(s) for s in range(AMOUNT_FEATURES)]}, gjson_file, indent=2)
+    return gjson_path
+
+
+# function to write the chunks of the features, returns the content of the output file
+def write_chunks(out_path, chunks):
+    with GeoJSONStreamWriter(out_path) as writer:
+        for chunk in chunks:
+            writer.write_features(chunk.features)
+    with open(out_path, 'r', encoding='utf8') as out_file:
+        return out_file.read()
+
+
+@pytest.mark.parametrize('block_size', [7, 64, 1024 ** 2])
+def test_iter_features(gjson_path, block_size):
+    features = list(iter_features(gjson_path, block_size=block_size))
+    assert features == [feature(s) for s in range(AMOUNT_FEATURES)]
+    chunks = list(iter_feature_chunks(iter(features), chunk_size=CHUNK_SIZE))
+    assert [len(chunk.features) for chunk in chunks] == [10, 10, 3]
+    assert [f for chunk in chunks for f in chunk.features] == features
+
+
+def test_iter_feature_chunks_area(gjson_path):
+    # the fields are about 100 x 155 m, 3 fields per chunk of 50000 m²
+    chunks = list(iter_feature_chunks(iter_features(gjson_path), chunk_area=50000))
+    assert [len(chunk.features) for chunk in chunks] == [3] * 7 + [2]
+    chunks = list(iter_feature_chunks(iter_features(gjson_path), chunk_size=2, chunk_area=50000))
+    assert [len(chunk.features) for chunk in chunks] == [2] * 11 + [1]
+
+
+# the writing is interrupted after chunk k: the chunk which was being written (k + 1, of which
+# the last is partial) is only partly in the file, the file is not closed with the end of the
+# features array. The run is continued with the chunks after k at the offset of the checkpoint.
+# After the last chunk (k = 2) only the end of the features array is written, the part of a
+# feature behind the offset must be removed
+@pytest.mark.parametrize('k', [0, 1, 2])
+def test_writer_resume(gjson_path, tmp_path, k):
+    chunks = list(iter_feature_chunks(iter_features(gjson_path), chunk_size=CHUNK_SIZE))
+    content = write_chunks(str(tmp_path / 'uninterrupted.geojson'), chunks)
+    assert json.loads(content)['features'] == [feature(s) for s in range(AMOUNT_FEATURES)]
+
+    out_path = str(tmp_path / 'interrupted.geojson')
+    checkpoint_path = str(tmp_path / 'interrupted.checkpoint.json')
+    writer = GeoJSONStreamWriter(out_path)
+    for c in range(k + 1):
+        writer.write_features(chunks[c].features)
+        save_checkpoint(checkpoint_path, {'settings': None, 'chunks_done': list(range(c + 1)), 'offset': writer.tell(),
+                                          'amount_features': writer.amount_features, 'finished': False})
+    if k + 1 < len(chunks):
+        writer.write_features(chunks[k + 1].features[:2])
+    writer._file.write(',\n{"type": "Feature", "prop')
+    writer._file.close()
+
+    checkpoint = load_checkpoint(checkpoint_path)
+    assert checkpoint['amount_features'] == min((k + 1) * CHUNK_SIZE, AMOUNT_FEATURES)
+    with GeoJSONStreamWriter(out_path, checkpoint['offset'], checkpoint['amount_features']) as writer:
+        for chunk in chunks[k + 1:]:
+            writer.write_features(chunk.features)
+        assert writer.amount_features == AMOUNT_FEATURES
+    with open(out_path, 'r', encoding='utf8') as out_file:
+        assert out_file.read() == content
+    assert list(iter_features(out_path, block_size=16)) == [feature(s) for s in range(AMOUNT_FEATURES)]
+
+
+def test_writer_empty(tmp_path):
+    out_path = str(tmp_path / 'empty.geojson')
+    write_chunks(out_path, [])
+    with open(out_path, 'r', encoding='utf8') as out_file:
+        assert json.load(out_file) == {'type': 'FeatureCollection', 'features': []}
+    assert list(iter_features(out_path)) == []
+    assert load_checkpoint(str(tmp_path / 'missing.json')) == {'settings': None, 'chunks_done': [], 'offset': None, 'amount_features': 0,
+                                                               'finished': False}
@@ -0,0 +1,67 @@
+# Tests of the state of the incremental update: the probabilities of the previous windows
+# which are reused per field (previous_window_probabilities of the UDF) and the key of the
+# fields in the store, which changes with the parameters but not with the end date, and the
+# store of the states (FieldStateStore), which closes its connections after each operation.
+
+import numpy as np
+import pandas as pd
+import geojson
+
+from Crop_calendars import field_state_store
+from Crop_calendars.crop_calendar_udf import previous_window_probabilities
+from Crop_calendars.field_identity import field_id
+from Crop_calendars.field_state_store import FieldStateStore, new_field_state
+
+IDS_FIELDS = ['a', 'b']
+WINDOW_VALUES = 5
+DATES = ['2019-05-01', '2019-05-07', '2019-05-13']
+
+
+def windows_state():
+    return {id_field: {'Harvest': {'descending': [[date, 0.1 * (d + 1)] for d, date in enumerate(DATES)], 'ascending': []}}
+            for id_field in IDS_FIELDS}
+
+
+def windows():
+    return pd.DataFrame([(f, 0, date) for f in range(len(IDS_FIELDS)) for date in DATES],
+                        columns=['loc_field', 'loc_orbit_pass', 'prediction_date_window'])
+
+
+def test_previous_windows():
+    probabilities = previous_window_probabilities(windows(), IDS_FIELDS, windows_state(), 'Harvest', WINDOW_VALUES)
+    np.testing.assert_allclose(probabilities, [0.1, 0.2, 0.3] * 2)
+
+
+def test_previous_windows_update_from():
+    # the window of 2019-05-13 ends on 2019-05-25
+    probabilities = previous_window_probabilities(windows(), IDS_FIELDS, windows_state(), 'Harvest', WINDOW_VALUES, '2019-05-25')
+    np.testing.assert_allclose(probabilities, [0.1, 0.2, np.nan] * 2)
+
+
+def test_previous_windows_update_from_fields():
+    # a field with new data doesn't cause the update of the windows of the other fields and
+    # the fields without date (new fields) are predicted completely
+    probabilities = previous_window_probabilities(windows(), IDS_FIELDS, windows_state(), 'Harvest', WINDOW_VALUES, {'a': '2019-05-19'})
+    np.testing.assert_allclose(probabilities, [0.1, np.nan, np.nan] + [np.nan] * 3)
+    probabilities = previous_window_probabilities(windows(), IDS_FIELDS, windows_state(), 'Harvest', WINDOW_VALUES,
+                                                  {'a': '2019-05-19', 'b': '2019-06-30'})
+    np.testing.assert_allclose(probabilities, [0.1, np.nan, np.nan, 0.1, 0.2, 0.3])
+
+
+def test_state_key():
+    geometry = geojson.Polygon([[(4.5, 50.9), (4.501, 50.9), (4.501, 50.901), (4.5, 50.9)]])
+    parameters = {'window_values': WINDOW_VALUES, 'thr_detection': 0.75}
+    key = field_id(geometry, '2019-01-01', None, parameters)
+    assert key == field_id(geometry, '2019-01-01', None, dict(parameters))
+    assert key != field_id(geometry, '2019-01-01', None, dict(parameters, thr_detection=0.8))
+    assert key != field_id(geometry, '2019-02-01', None, parameters)
+
+
+def test_state_store(tmp_path, sqlite_connections):
+    connections = sqlite_connections(field_state_store)
+    store = FieldStateStore(str(tmp_path))
+    state = dict(new_field_state('2019-01-01'), last_date='2019-05-13', windows_state=windows_state()['a'])
+    store.put_many({'a': state, 'b': new_field_state('2019-01-01')})
+    assert FieldStateStore(str(tmp_path)).get_many(['a', 'c']) == {'a': state}
+    assert len(store) == 2
+    assert not connections
@@ -0,0 +1,106 @@
+# Tests of JobOrchestrator with fake openEO jobs: submitting, polling (with the cached
+# status), failed jobs and the timeout.
+
+import time
+import pytest
+
+from Crop_calendars.job_orchestration import JobFailedException, JobOrchestrator
+from Crop_calendars.pipeline_metrics import PipelineMetrics
+
+
+# fake batch job which goes through the given statuses, one per poll
+class FakeJob():
+    def __init__(self, statuses, result=None):
+        self.job_id = 'fake-{}'.format(id(self))
+        self.statuses = list(statuses)
+        self.result = result
+        self.started = False
+        self.polls = 0
+
+    def start_job(self):
+        self.started = True
+
+    def status(self):
+        self.polls += 1
+        return self.statuses[min(self.polls, len(self.statuses)) - 1]
+
+    def get_result(self):
+        return self
+
+    def load_json(self):
+        return self.result
+
+
+# fake datacube of which send_job creates the fake job
+class FakeCube():
+    def __init__(self, statuses, result=None):
+        self.job = FakeJob(statuses, result)
+
+    def send_job(self):
+        return self.job
+
+
+def test_submit():
+    metrics = PipelineMetrics()
+    orchestrator = JobOrchestrator(poll_interval=0, metrics=metrics)
+    job = orchestrator.submit('timeseries', FakeCube(['finished']))
+    assert job.started
+    assert job.polls == 0
+    assert orchestrator.statuses() == {'timeseries': 'queued'}
+    assert metrics.to_dict()['counters']['openeo_jobs'] == 1
+
+
+def test_poll_after_submit():
+    # a job which is finished at the first poll doesn't wait for the poll interval
+    orchestrator = JobOrchestrator(poll_interval=60)
+    cube = FakeCube(['finished'], {'a': 1})
+    orchestrator.submit('timeseries', cube)
+    start = time.time()
+    assert orchestrator.result('timeseries') == {'a': 1}
+    assert time.time() - start < 1
+    assert cube.job.polls == 1
+
+
+def test_poll():
+    orchestrator = JobOrchestrator(poll_interval=0.01, max_poll_interval=0.01)
+    cubes = {'timeseries': FakeCube(['queued', 'running', 'running', 'finished'], 'timeseries'),
+             'angle': FakeCube(['running', 'finished'], 'angle')}
+    for name, cube in cubes.items():
+        orchestrator.submit(name, cube)
+    assert orchestrator.wait() == {'timeseries': 'timeseries', 'angle': 'angle'}
+    assert orchestrator.statuses() == {'timeseries': 'finished', 'angle': 'finished'}
+    # finished jobs are not polled anymore
+    assert (cubes['timeseries'].job.polls, cubes['angle'].job.polls) == (4, 2)
+    orchestrator.wait()
+    assert (cubes['timeseries'].job.polls, cubes['angle'].job.polls) == (4, 2)
+
+
+def test_poll_cached():
+    orchestrator = JobOrchestrator(poll_interval=60)
+    cube = FakeCube(['running', 'finished'])
+    orchestrator.submit('timeseries', cube)
+    assert orchestrator.status('timeseries') == 'running'
+    # polled less than poll_interval ago
+    assert orchestrator.status('timeseries') == 'running'
+    assert cube.job.polls == 1
+
+
+@pytest.mark.parametrize('status_failed', ['error', 'canceled'])
+def test_failure(status_failed):
+    orchestrator = JobOrchestrator(poll_interval=0)
+    orchestrator.submit('timeseries', FakeCube(['running', status_failed]))
+    orchestrator.submit('angle', FakeCube(['finished'], 'angle'))
+    results = orchestrator.wait()
+    assert isinstance(results['timeseries'], JobFailedException)
+    assert results['angle'] == 'angle'
+    with pytest.raises(JobFailedException):
+        orchestrator.result('timeseries')
+
+
+def test_timeout():
+    orchestrator = JobOrchestrator(poll_interval=0.01, max_poll_interval=0.01, timeout=0.1)
+    orchestrator.submit('timeseries', FakeCube(['running']))
+    start = time.time()
+    with pytest.raises(TimeoutError):
+        orchestrator.wait()
+    assert time.time() - start < 1
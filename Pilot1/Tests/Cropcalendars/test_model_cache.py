@@ -0,0 +1,72 @@
+# Tests of the cache of the loaded NN models per process (load_model_cached of the UDF): hits and
+# misses, a model file which changed (modification time) is loaded again, the least recently used
+# model is dropped when the cache is full and the error of the loader for a path which doesn't exist.
+
+import os
+import sys
+import numpy as np
+import pytest
+
+from Crop_calendars import crop_calendar_udf
+from Crop_calendars.crop_calendar_udf import NumpyDenseModel, get_model_cache_stats, load_model_cached
+
+
+@pytest.fixture(autouse=True)
+def model_registry(monkeypatch):
+    # a new registry per test
+    monkeypatch.delitem(sys.modules, '_cropcalendars_model_registry', raising=False)
+
+
+# function to write a dense model (a single layer) for the numpy backend
+def write_model(path, weight):
+    np.savez(path, activations=np.array(['sigmoid']), kernel_0=np.full((10, 1), weight, dtype=np.float32),
+             bias_0=np.zeros(1, dtype=np.float32))
+    return path
+
+
+def test_model_cache_hits(tmp_path):
+    path_model = write_model(str(tmp_path / 'model.npz'), 0.1)
+    model = load_model_cached(path_model, backend='numpy')
+    assert isinstance(model, NumpyDenseModel)
+    assert load_model_cached(path_model, backend='numpy') is model
+    stats = get_model_cache_stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (1, 1, 0)
+
+
+def test_model_cache_mtime(tmp_path):
+    path_model = write_model(str(tmp_path / 'model.npz'), 0.1)
+    model = load_model_cached(path_model, backend='numpy')
+    # the model file is replaced
+    write_model(path_model, 0.2)
+    mtime = os.path.getmtime(path_model) + 10
+    os.utime(path_model, (mtime, mtime))
+    model_changed = load_model_cached(path_model, backend='numpy')
+    assert model_changed is not model
+    assert model_changed.kernels[0][0, 0] == np.float32(0.2)
+    assert get_model_cache_stats()['misses'] == 2
+
+
+def test_model_cache_lru(tmp_path):
+    paths = {name: write_model(str(tmp_path / '{}.npz'.format(name)), 0.1) for name in 'abc'}
+    models = {name: load_model_cached(paths[name], max_models=2, backend='numpy') for name in 'ab'}
+    # a is used after b, so b is the least recently used model when c is loaded
+    assert load_model_cached(paths['a'], max_models=2, backend='numpy') is models['a']
+    load_model_cached(paths['c'], max_models=2, backend='numpy')
+    assert get_model_cache_stats()['evictions'] == 1
+    assert load_model_cached(paths['a'], max_models=2, backend='numpy') is models['a']
+    assert load_model_cached(paths['b'], max_models=2, backend='numpy') is not models['b']
+    stats = get_model_cache_stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (2, 4, 2)
+
+
+def test_model_cache_missing(tmp_path, monkeypatch):
+    path_model = str(tmp_path / 'missing.npz')
+    with pytest.raises(ValueError, match='Unknown NN model backend'):
+        load_model_cached(path_model, backend='unknown')
+
+    # the error of the loader
+    def load_NN_model(NN_model_dir, backend='keras'):
+        raise IOError('Unable to open file {}'.format(NN_model_dir))
+    monkeypatch.setattr(crop_calendar_udf, 'load_NN_model', load_NN_model)
+    with pytest.raises(IOError, match='Unable to open file'):
+        load_model_cached(path_model, backend='keras')
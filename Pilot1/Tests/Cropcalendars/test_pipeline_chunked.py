@@ -0,0 +1,69 @@
+# Smoke test of the chunked pipeline (generate_cropcalendars_chunked) with the replayed openEO
+# backend and the stub catalogue, without pytest-benchmark (see test_benchmark_pipeline.py):
+# the fields are processed in chunks, of which the last is partial, and the crop calendars are
+# the same as when all fields are processed at once, also when the run is interrupted and resumed.
+
+import json
+from pathlib import Path
+import pytest
+
+from Crop_calendars.benchmark_pipeline import PARAMETERS_EVENT, PipelineBenchmark
+from Crop_calendars.Crop_calendars_openeo_integration import ChunksFailedException
+
+PATH_CROP_CALENDARS = Path(__file__).resolve().parents[2] / 'src' / 'Crop_calendars'
+AMOUNT_FIELDS = 23
+CHUNK_SIZE = 10
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    # the UDF is read from the Crop_calendars folder
+    monkeypatch.chdir(str(PATH_CROP_CALENDARS))
+    with PipelineBenchmark(AMOUNT_FIELDS, str(tmp_path)) as pipeline:
+        yield pipeline
+
+
+def test_pipeline_chunked(pipeline, tmp_path):
+    assert pipeline.total(CHUNK_SIZE) == AMOUNT_FIELDS
+    with open(str(tmp_path / 'cropcalendars_{}.geojson'.format(AMOUNT_FIELDS))) as out_file:
+        features_chunked = json.load(out_file)['features']
+
+    features = pipeline.generator.generate_cropcalendars(pipeline.start, pipeline.end, pipeline.gjson_path, **PARAMETERS_EVENT).features
+    # the chunks are written in the order in which they finish
+    properties_chunked = {feature['properties']['id']: feature['properties'] for feature in features_chunked}
+    assert properties_chunked == {feature['properties']['id']: dict(feature['properties']) for feature in features}
+    assert any(feature['properties']['Harvest_date'] for feature in features_chunked)
+
+
+# the run is interrupted by a failed chunk (the second, one chunk at a time), the finished
+# chunks are in the checkpoint and the next run only processes the failed chunk
+def test_pipeline_chunked_resume(pipeline, tmp_path, monkeypatch):
+    out_path = str(tmp_path / 'cropcalendars_resumed.geojson')
+    checkpoint_path = out_path + '.checkpoint.json'
+    prepare_fields = pipeline.generator.prepare_fields
+    calls = []
+
+    def prepare_fields_failing(gj_chunk):
+        calls.append(len(gj_chunk.features))
+        if len(calls) == 2:
+            raise RuntimeError('interrupted')
+        return prepare_fields(gj_chunk)
+    monkeypatch.setattr(pipeline.generator, 'prepare_fields', prepare_fields_failing)
+    with pytest.raises(ChunksFailedException) as failed:
+        pipeline.generator.generate_cropcalendars_chunked(pipeline.start, pipeline.end, pipeline.gjson_path, out_path, chunk_size=CHUNK_SIZE,
+                                                          max_jobs_in_flight=1, checkpoint_path=checkpoint_path, **PARAMETERS_EVENT)
+    assert failed.value.amount_features == AMOUNT_FIELDS - CHUNK_SIZE
+    with open(checkpoint_path) as checkpoint_file:
+        assert json.load(checkpoint_file)['chunks_done'] == [0, 2]
+
+    assert pipeline.generator.generate_cropcalendars_chunked(pipeline.start, pipeline.end, pipeline.gjson_path, out_path, chunk_size=CHUNK_SIZE,
+                                                             max_jobs_in_flight=1, checkpoint_path=checkpoint_path,
+                                                             **PARAMETERS_EVENT) == AMOUNT_FIELDS
+    assert calls == [10, 10, 3, 10]
+    assert pipeline.total(CHUNK_SIZE) == AMOUNT_FIELDS
+    with open(out_path) as out_file, open(str(tmp_path / 'cropcalendars_{}.geojson'.format(AMOUNT_FIELDS))) as out_file_uninterrupted:
+        features_resumed = json.load(out_file)['features']
+        features_uninterrupted = json.load(out_file_uninterrupted)['features']
+    assert len(features_resumed) == AMOUNT_FIELDS
+    assert {feature['properties']['id']: feature for feature in features_resumed} == \
+           {feature['properties']['id']: feature for feature in features_uninterrupted}
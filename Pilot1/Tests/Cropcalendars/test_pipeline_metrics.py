@@ -0,0 +1,83 @@
+# Tests of PipelineMetrics: the timers of the stages and the metrics of the UDF runs,
+# which are summed per stage so that they don't grow with the amount of UDF runs, and the
+# profiles of the stages, of which only one is active at a time (also with threads).
+
+import os
+import threading
+
+from Crop_calendars.pipeline_metrics import PipelineMetrics
+
+
+def udf_metrics(total_s, profiles=None):
+    metrics = {'stages': {'decode': {'runs': 1, 'total_s': total_s, 'max_s': total_s},
+                          'inference': {'runs': 2, 'total_s': 2 * total_s, 'max_s': total_s}},
+               'counters': {'windows': 10}}
+    if profiles is not None:
+        metrics['profiles'] = profiles
+    return metrics
+
+
+def test_stage():
+    metrics = PipelineMetrics()
+    for _ in range(3):
+        with metrics.stage('catalogue'):
+            pass
+    metrics.count('fields', 5)
+    metrics_dict = metrics.to_dict()
+    assert metrics_dict['stages']['catalogue']['runs'] == 3
+    assert metrics_dict['counters'] == {'fields': 5}
+
+
+def test_udf_metrics_summed():
+    metrics = PipelineMetrics()
+    for total_s in [1., 3.]:
+        metrics.add_udf_metrics(udf_metrics(total_s))
+    metrics.add_udf_metrics(None)
+    assert metrics.to_dict()['udf'] == {'runs': 2,
+                                        'stages': {'decode': {'runs': 2, 'total_s': 4., 'max_s': 3.},
+                                                   'inference': {'runs': 4, 'total_s': 8., 'max_s': 3.}},
+                                        'counters': {'windows': 20}}
+
+
+def test_udf_profiles(tmp_path):
+    metrics = PipelineMetrics(str(tmp_path))
+    metrics.add_udf_metrics(udf_metrics(1., {'decode_1': 'profile decode'}))
+    assert 'profiles' not in metrics.to_dict()['udf']
+    with open(os.path.join(str(tmp_path), 'udf_decode_1_1.txt')) as profile_file:
+        assert profile_file.read() == 'profile decode'
+
+
+def test_profile_single(tmp_path):
+    metrics = PipelineMetrics(str(tmp_path))
+    # a stage within a profiled stage is only timed
+    with metrics.stage('chunk'):
+        with metrics.stage('catalogue'):
+            pass
+    with metrics.stage('catalogue'):
+        pass
+    assert sorted(os.listdir(str(tmp_path))) == ['catalogue_2.prof', 'chunk_1.prof']
+    assert metrics.to_dict()['counters'] == {'profiles_skipped': 1}
+
+
+def test_profile_threads(tmp_path):
+    metrics = PipelineMetrics(str(tmp_path))
+    started = threading.Event()
+    finish = threading.Event()
+
+    def stage_thread():
+        with metrics.stage('catalogue'):
+            started.set()
+            finish.wait(10)
+    thread = threading.Thread(target=stage_thread)
+    thread.start()
+    started.wait(10)
+    # the stage in the main thread runs while the stage of the other thread is profiled
+    with metrics.stage('timeseries_wait'):
+        pass
+    finish.set()
+    thread.join()
+    with metrics.stage('timeseries_wait'):
+        pass
+    assert sorted(os.listdir(str(tmp_path))) == ['catalogue_1.prof', 'timeseries_wait_2.prof']
+    assert metrics.to_dict()['stages']['timeseries_wait']['runs'] == 2
+    assert metrics.to_dict()['counters'] == {'profiles_skipped': 1}
@@ -0,0 +1,25 @@
+# Tests of the persistent cache of the crop calendar results per field (result_cache.py): the
+# results of the fields in the cache are returned (in batches), and the connections to the
+# database are closed after each operation.
+
+import sqlite3
+import pytest
+
+from Crop_calendars import result_cache
+from Crop_calendars.result_cache import FieldResultCache
+
+
+def test_result_cache(tmp_path, sqlite_connections):
+    connections = sqlite_connections(result_cache)
+    cache = FieldResultCache(str(tmp_path))
+    cache.put_many({'field_{}'.format(s): {'Harvest_date': '2019-07-{:02d}'.format(s + 1)} for s in range(7)})
+    results = cache.get_many(['field_{}'.format(s) for s in range(5, 10)], batch_size=2)
+    assert results == {'field_5': {'Harvest_date': '2019-07-06'}, 'field_6': {'Harvest_date': '2019-07-07'}}
+    # the results are kept in the database
+    assert FieldResultCache(str(tmp_path)).get_many(['field_0']) == {'field_0': {'Harvest_date': '2019-07-01'}}
+    assert cache.stats() == {'hits': 2, 'misses': 3, 'entries': 7}
+    assert not connections
+    with pytest.raises(sqlite3.OperationalError):
+        with cache._connect() as conn:
+            conn.execute('SELECT * FROM unknown_table')
+    assert not connections
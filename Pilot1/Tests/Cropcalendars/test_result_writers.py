@@ -0,0 +1,66 @@
+# Tests of the writers of the crop calendar results (result_writers.py): the declared
+# types of the crop calendar columns in GeoParquet, which don't depend on the first
+# chunk, and the check of the dependencies of an output format before the processing.
+
+import datetime
+import sys
+import types
+import pytest
+
+from Crop_calendars.result_writers import FlatGeobufWriter, crop_calendar_properties, get_writer_class, open_writer
+
+
+def feature(x, **properties):
+    return {'type': 'Feature', 'properties': properties,
+            'geometry': {'type': 'Polygon', 'coordinates': [[[x, 50.], [x + 0.001, 50.], [x + 0.001, 50.001], [x, 50.]]]}}
+
+
+def test_crop_calendar_properties():
+    assert crop_calendar_properties('Harvest') == {'id': 'string', 'Harvest_date': 'date'}
+    events = [{'crop_calendar_event': 'Emergence'}, {'crop_calendar_event': 'Harvest'}]
+    seasons = [{'season': '2019', 'start': '2019-01-01', 'end': '2019-12-31'}]
+    assert crop_calendar_properties(None, events, seasons) == {'id': 'string', 'Emergence_dates_2019': 'dates', 'Harvest_dates_2019': 'dates'}
+
+
+def test_parquet_schema(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    pa = pytest.importorskip('pyarrow')
+    out_path = str(tmp_path / 'fields.parquet')
+    with open_writer(out_path, properties=crop_calendar_properties('Harvest')) as writer:
+        # the first chunk has no crop calendar dates and an integer property
+        writer.write_features([feature(4.5, id='a', Harvest_date=None, area=1, name=None)])
+        writer.write_features([feature(4.6, id='b', Harvest_date='2019-07-01', area='large', name='field b'),
+                               feature(4.7, id=3, Harvest_date=float('nan'), area=2),
+                               feature(4.8, id='d', Harvest_date='2019-08-01', area=2.5)])
+    table = pq.read_table(out_path)
+    assert table.schema.field('id').type == pa.string()
+    assert table.schema.field('Harvest_date').type == pa.date32()
+    assert table.schema.field('area').type == pa.int64()
+    assert table.schema.field('name').type == pa.string()
+    assert table.column('id').to_pylist() == ['a', 'b', '3', 'd']
+    assert table.column('Harvest_date').to_pylist() == [None, datetime.date(2019, 7, 1), None, datetime.date(2019, 8, 1)]
+    # the values which aren't integers are written as null
+    assert table.column('area').to_pylist() == [1, None, 2, None]
+    assert table.column('name').to_pylist() == [None, 'field b', None, None]
+
+
+def test_parquet_empty(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    out_path = str(tmp_path / 'fields.parquet')
+    with open_writer(out_path, properties=crop_calendar_properties('Harvest')):
+        pass
+    assert pq.read_table(out_path).column_names == ['id', 'Harvest_date', 'geometry']
+
+
+def test_flatgeobuf_not_supported(monkeypatch):
+    # a fiona of which GDAL (< 3.1) has no FlatGeobuf driver
+    fiona = types.ModuleType('fiona')
+    fiona.supported_drivers = {'GeoJSON': 'raw'}
+    fiona.__gdal_version__ = '3.0.4'
+    monkeypatch.setitem(sys.modules, 'fiona', fiona)
+    with pytest.raises(ValueError, match='GDAL >= 3.1'):
+        get_writer_class('fields.fgb')
+    with pytest.raises(ValueError, match='GDAL >= 3.1'):
+        get_writer_class('fields.out', 'flatgeobuf')
+    fiona.supported_drivers['FlatGeobuf'] = 'raw'
+    assert get_writer_class('fields.fgb') is FlatGeobufWriter
@@ -0,0 +1,67 @@
+# Tests of the strided windows of the NN model (sliding_windows_metrics) against the windows
+# cut with a loop as before: the first and last window of the dates, more windows than fit
+# in the dates, the NaN padding of the dates without data and inputs which are views.
+
+import numpy as np
+import pytest
+
+from Crop_calendars.crop_calendar_udf import sliding_windows_metrics
+
+
+# the windows of a (dates x metrics) array with a loop: per window the
+# values of the first metric, followed by the values of the second metric, ...
+def windows_loop(values, window_values, amount_windows):
+    return np.array([np.concatenate([values[w:w + window_values, m] for m in range(values.shape[1])])
+                     for w in range(amount_windows)]).reshape(amount_windows, values.shape[1] * window_values)
+
+
+def values_padded(amount_dates, amount_fields, amount_metrics, seed=0):
+    random = np.random.RandomState(seed)
+    values = random.uniform(-1, 1, (amount_dates, amount_fields, amount_metrics))
+    # dates without data (as the dates which are missing in the time series) and missing metrics
+    values[random.rand(amount_dates) < 0.3] = np.nan
+    values[random.rand(*values.shape) < 0.1] = np.nan
+    # no data at the start and the end of the dates
+    values[:3] = np.nan
+    values[-2:] = np.nan
+    return values
+
+
+@pytest.mark.parametrize('window_values', [1, 2, 5])
+@pytest.mark.parametrize('amount_metrics', [1, 3])
+def test_sliding_windows_loop(window_values, amount_metrics):
+    values = values_padded(20, 4, amount_metrics)
+    # up to the last window which ends at the last date
+    for amount_windows in [1, 7, 20 - window_values, 20 - window_values + 1]:
+        windows = sliding_windows_metrics(values, window_values, amount_windows)
+        assert windows.shape == (4, amount_windows, amount_metrics * window_values)
+        for f in range(4):
+            np.testing.assert_array_equal(windows[f], windows_loop(values[:, f], window_values, amount_windows))
+            np.testing.assert_array_equal(sliding_windows_metrics(values[:, f], window_values, amount_windows), windows[f])
+    # the first windows are padding only, the last window ends with the padding of the end
+    windows = sliding_windows_metrics(values, window_values, 20 - window_values + 1)
+    assert np.isnan(windows[:, :max(3 - window_values + 1, 0)]).all()
+    assert np.isnan(windows[:, -1].reshape(4, amount_metrics, window_values)[:, :, -min(window_values, 2):]).all()
+
+
+def test_sliding_windows_amount():
+    values = values_padded(10, 2, 3)
+    # the windows which don't fit in the dates aren't read beyond the data
+    windows = sliding_windows_metrics(values, 4, 20)
+    assert windows.shape == (2, 7, 12)
+    np.testing.assert_array_equal(windows[1], windows_loop(values[:, 1], 4, 7))
+    assert sliding_windows_metrics(values, 4, 0).shape == (2, 0, 12)
+    assert sliding_windows_metrics(values, 4, -3).shape == (2, 0, 12)
+    assert sliding_windows_metrics(values, 11, 1).shape == (2, 0, 33)
+
+
+def test_sliding_windows_view():
+    # a selection of fields and metrics of a larger array (not contiguous)
+    values = values_padded(30, 6, 5)
+    view = values[::2, 1::2, [4, 0, 2]]
+    windows = sliding_windows_metrics(view, 3, 13)
+    for f in range(view.shape[1]):
+        np.testing.assert_array_equal(windows[f], windows_loop(view[:, f], 3, 13))
+    # the windows are a copy, the time series is not changed through them
+    windows[:] = 0
+    assert not (values == 0).any()
@@ -0,0 +1,39 @@
+# the modules are imported as Crop_calendars.<module>, so the src folder is added to the path
+import sqlite3
+import sys
+import types
+from pathlib import Path
+import pytest
+
+PATH_SRC = Path(__file__).resolve().parents[1] / 'src'
+if str(PATH_SRC) not in sys.path:
+    sys.path.insert(0, str(PATH_SRC))
+
+
+# the amounts of fields of the benchmarks of the pipeline (see Cropcalendars/test_benchmark_pipeline.py),
+# comma separated, e.g. --benchmark-fields-chunked 100000
+def pytest_addoption(parser):
+    parser.addoption('--benchmark-fields', default='10,100', help='amounts of fields of the benchmarks of the pipeline stages')
+    parser.addoption('--benchmark-fields-chunked', default='1000', help='amounts of fields of the benchmark of the chunked pipeline')
+
+
+# fixture to keep track of the sqlite connections of a module (which uses sqlite3.connect):
+# sqlite_connections(module) returns the set of the connections which are open
+@pytest.fixture
+def sqlite_connections(monkeypatch):
+    open_connections = set()
+
+    class TrackedConnection(sqlite3.Connection):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            open_connections.add(self)
+
+        def close(self):
+            open_connections.discard(self)
+            super().close()
+
+    def track(module):
+        monkeypatch.setattr(module, 'sqlite3', types.SimpleNamespace(
+            connect=lambda *args, **kwargs: sqlite3.connect(*args, factory=TrackedConnection, **kwargs)))
+        return open_connections
+    return track
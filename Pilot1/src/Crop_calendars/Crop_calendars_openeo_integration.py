@@ -6,17 +6,25 @@ from openeo import Job
 from openeo.rest.conversions import timeseries_json_to_pandas
 
 import os
-import statistics
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 import collections
 from Crop_calendars.Terrascope_catalogue_retrieval import OpenSearch
 
 from shapely.geometry.polygon import Polygon
 
 from Crop_calendars.create_mask import create_mask
-from Crop_calendars.prepare_geometry import prepare_geometry,remove_small_poly
+from Crop_calendars.RO_selection import RO_angle_table, select_RO_fields, RO_selection_to_dicts
+from Crop_calendars.job_orchestration import JobOrchestrator, JobFailedException
+from Crop_calendars.geojson_stream import input_fingerprint, iter_features, iter_feature_chunks, load_checkpoint, save_checkpoint
+from Crop_calendars.result_writers import crop_calendar_properties, get_writer_class
+from Crop_calendars.prepare_geometry import prepare_geometry_fields,remove_rejected_poly
+from Crop_calendars.udf_transport import encode_context_fields, encode_timeseries
+from Crop_calendars.field_identity import field_id
+from Crop_calendars.field_state_store import FieldStateStore, new_field_state
+from Crop_calendars.result_cache import FieldResultCache
+from Crop_calendars.pipeline_metrics import PipelineMetrics
 
 import geojson
-import uuid
 import json
 from openeo.rest.datacube import DataCube
 
@@ -29,8 +37,18 @@ from openeo.rest.datacube import DataCube
 #   combine cropsar + coherence to determine cropcalendar
 #   return cropcalendar output in your own json format
 
+# raised by generate_cropcalendars_chunked after the other chunks are
+# written if chunks failed, they are processed again in the next run
+class ChunksFailedException(Exception):
+    def __init__(self, message, amount_features, chunks_failed):
+        super().__init__(message)
+        self.amount_features = amount_features
+        self.chunks_failed = chunks_failed
+
 class Cropcalendars():
-    def __init__(self, fAPAR_rescale_Openeo, coherence_rescale_Openeo, path_harvest_model,VH_VV_range_normalization, fAPAR_range_normalization, metrics_order, connection = None):
+    def __init__(self, fAPAR_rescale_Openeo, coherence_rescale_Openeo, path_harvest_model,VH_VV_range_normalization, fAPAR_range_normalization, metrics_order, connection = None, NN_model_backend = 'keras', open_search = None, poll_interval = 5, single_pass = False, udf_transport = 'json',
+                 cropsar_chunk_size = None, cropsar_max_workers = None, cropsar_backend = 'cropsar', profile_dir = None,
+                 parcel_mask = False, result_cache_dir = None, udf_metrics = True, print_metrics = True):
         # crop calendar independant variables
         self.fAPAR_rescale_Openeo = fAPAR_rescale_Openeo
         self.coherence_rescale_Openeo = coherence_rescale_Openeo
@@ -38,6 +56,38 @@ class Cropcalendars():
         self.VH_VV_range_normalization = VH_VV_range_normalization
         self.fAPAR_range_normalization  = fAPAR_range_normalization
         self.metrics_order = metrics_order
+        # 'keras' uses the .h5 model, 'numpy' the weights exported with convert_NN_model.py
+        # so that the udf doesn't need tensorflow
+        self.NN_model_backend = NN_model_backend
+
+        # the interval (s) at which the status of the openeo jobs is requested
+        self.poll_interval = poll_interval
+        # single_pass: compute the time series of all bands once and use them for both
+        # the relative orbit selection and the UDF, instead of separate angle jobs
+        self.single_pass = single_pass
+        # 'json' sends the UDF context (and in single pass mode the time series) as nested
+        # json dicts, 'npy' as compact arrays which the UDF doesn't need to parse
+        self.udf_transport = udf_transport
+        # cropsar is run in the UDF on chunks of cropsar_chunk_size fields (optionally in
+        # cropsar_max_workers processes) to limit its memory use, 'stub' replaces cropsar
+        # by an interpolation of the fAPAR to run the UDF without cropsar (offline tests)
+        self.cropsar_chunk_size = cropsar_chunk_size
+        self.cropsar_max_workers = cropsar_max_workers
+        self.cropsar_backend = cropsar_backend
+        # timers and counters of the stages of the pipeline (and of the UDF), see pipeline_metrics.py.
+        # With a profile_dir the stages are also profiled with cProfile. udf_metrics: the UDF
+        # returns the timers of its stages (summed in self.metrics), print_metrics: each run
+        # (generate_cropcalendars, _chunked, _incremental) prints the metrics once at its end
+        self.profile_dir = profile_dir
+        self.metrics = PipelineMetrics(profile_dir)
+        self.udf_metrics = udf_metrics
+        self.print_metrics = print_metrics
+        # parcel_mask: the S2 mask is only computed for the extent of the fields (buffered
+        # with the reach of the mask kernels) instead of the whole extent of the collection
+        self.parcel_mask = parcel_mask
+        # with a result_cache_dir the result of each field is cached with as key its content
+        # addressed id (see field_id), so fields processed before with the same settings are skipped
+        self._result_cache = None if result_cache_dir is None else FieldResultCache(result_cache_dir)
 
         # openeo connection
         if(connection == None):
@@ -47,7 +97,10 @@ class Cropcalendars():
                 .authenticate_basic('eshape', 'eshape123')
         else:
             self._eoconn = connection
-        self._open_search = OpenSearch()
+        if(open_search == None):
+            self._open_search = OpenSearch()
+        else:
+            self._open_search = open_search
 
     #####################################################
     ################# FUNCTIONS #########################
@@ -60,8 +113,61 @@ class Cropcalendars():
         with open(self.get_resource(relative_path), 'r+', encoding="utf8") as f:
             return f.read()
 
-    def get_bands(self):
-        S2mask = create_mask( self._eoconn)
+    # the angle of both orbit passes taken from the time series of all bands,
+    # so that no separate datacube reads are needed for the angle
+    def get_angle_timeseries(self, ts_df):
+        scale = 0.0005
+        offset = 29
+        orbit_passes = [r'ASCENDING', r'DESCENDING']
+        dict_df_angles_fields = dict()
+        for orbit_pass in orbit_passes:
+            index_angle = self.metrics_order.index('sigma_{}_angle'.format(orbit_pass.lower()))
+            df_angle_fields = ts_df.loc[:, ts_df.columns.get_level_values(1).astype(str) == str(index_angle)]
+            df_angle_fields.columns = [str(item) + '_angle' for item in df_angle_fields.columns.get_level_values(0)]
+            df_angle_fields = df_angle_fields*scale + offset
+            dict_df_angles_fields.update({'{}'.format(orbit_pass): df_angle_fields})
+        return dict_df_angles_fields
+
+    # the parameters which are ingested in the UDF
+    def get_udf_context(self, window_values, thr_detection, crop_calendar_event, metrics_crop_event, index_window_above_thr, df_RO_selection,
+                        unique_ids_fields, crop_calendar_events = None, seasons = None):
+        orbit_passes = ['ASCENDING', 'DESCENDING']
+        # Default parameters are ingested in the UDF
+        context_to_udf = dict({'window_values': window_values, 'thr_detection': thr_detection, 'crop_calendar_event': crop_calendar_event,
+                               'metrics_crop_event': metrics_crop_event, 'VH_VV_range_normalization': self.VH_VV_range_normalization,
+                               'fAPAR_range_normalization': self.fAPAR_range_normalization, 'fAPAR_rescale_Openeo': self.fAPAR_rescale_Openeo,
+                               'coherence_rescale_Openeo': self.coherence_rescale_Openeo,
+                               'index_window_above_thr': index_window_above_thr,
+                               'metrics_order': self.metrics_order, 'path_harvest_model': self.path_harvest_model,
+                               'NN_model_backend': self.NN_model_backend, 'cropsar_chunk_size': self.cropsar_chunk_size,
+                               'cropsar_max_workers': self.cropsar_max_workers, 'cropsar_backend': self.cropsar_backend,
+                               'return_metrics': self.udf_metrics, 'profile_udf': self.udf_metrics and self.profile_dir is not None})
+        if crop_calendar_events:
+            # several crop calendar events (e.g. emergence, harvest) are determined on the same time series,
+            # per event a dict with its model (path_model) and the settings that differ from the ones above
+            context_to_udf['crop_calendar_events'] = crop_calendar_events
+        if seasons:
+            # the time series of start-end are split in seasons and all events per season are
+            # determined, instead of a single date for the whole period (see yearly_seasons)
+            context_to_udf['seasons'] = seasons
+        if self.udf_transport == 'npy':
+            context_to_udf['fields_encoded'] = encode_context_fields(df_RO_selection, unique_ids_fields, orbit_passes)
+        else:
+            dict_ascending_orbits_field, dict_descending_orbits_field = RO_selection_to_dicts(df_RO_selection, unique_ids_fields, orbit_passes)
+            context_to_udf.update({'RO_ascending_selection_per_field': dict_ascending_orbits_field, 'RO_descending_selection_per_field': dict_descending_orbits_field,
+                                   'unique_ids_fields': unique_ids_fields})
+        return context_to_udf
+
+    # function to start the job of the UDF on a time series (json) which was already computed
+    def submit_udf_timeseries(self, orchestrator, name, timeseries_json, context_to_udf):
+        udf = self.load_udf('crop_calendar_udf.py')
+        if self.udf_transport == 'npy':
+            timeseries_json = encode_timeseries(timeseries_json)
+        return orchestrator.submit(name, self._eoconn.datacube_from_process("run_udf", data = timeseries_json, udf = udf, runtime = 'Python',
+                                                                            context = context_to_udf))
+
+    def get_bands(self, parcels = None):
+        S2mask = create_mask( self._eoconn, parcels if self.parcel_mask else None)
         fapar = self._eoconn.load_collection('TERRASCOPE_S2_FAPAR_V2', bands=['FAPAR_10M'])
 
         fapar_masked = fapar.mask(S2mask)
@@ -76,31 +182,313 @@ class Cropcalendars():
         all_bands = sigma_ascending.merge(sigma_descending).merge(fapar_masked)  # .merge(coherence)
         return all_bands
 
+    # function to split the period start-end in seasons of a year that start
+    # at season_start (month-day), the season is named after its first year
+    @staticmethod
+    def yearly_seasons(start, end, season_start = '01-01'):
+        seasons = []
+        for year in range(int(start[:4]) - 1, int(end[:4]) + 1):
+            start_season = max(pd.Timestamp('{}-{}'.format(year, season_start)), pd.Timestamp(start))
+            end_season = min(pd.Timestamp('{}-{}'.format(year + 1, season_start)) - pd.Timedelta(days=1), pd.Timestamp(end))
+            if start_season <= end_season:
+                seasons.append({'season': str(year), 'start': start_season.strftime('%Y-%m-%d'), 'end': end_season.strftime('%Y-%m-%d')})
+        return seasons
+
     @classmethod
     def load_geometry(cls, gjson_path):
         # LOAD THE FIELDS FOR WHICH THE TIMESERIES
         # SHOULD BE EXTRACTED FOR THE CROP CALENDARS
         with open(gjson_path) as f:
             gj = geojson.load(f)
-        ### Buffer the fields 10 m inwards before requesting the TS from OpenEO
-        polygons_inw_buffered, poly_too_small_buffer = prepare_geometry(gj)
-        #TODO this is a bit confusing: I woud expect to continue with polygons_inw_buffered here
-        gj = remove_small_poly(gj, poly_too_small_buffer)
-
-        return gj,polygons_inw_buffered
+        return cls.prepare_fields(gj)
 
-    def generate_cropcalendars(self, start, end, gjson_path, window_values, thr_detection, crop_calendar_event, metrics_crop_event, index_window_above_thr):
+    @classmethod
+    def prepare_fields(cls, gj):
+        ### Buffer the fields 10 m inwards before requesting the TS from OpenEO
+        polygons_inw_buffered, rejection_reasons = prepare_geometry_fields(gj)
+        # the fields which can't be used (e.g. too small for the inward buffer) are removed
+        # from the geojson, so that gj and polygons_inw_buffered contain the same fields
+        gj, gj_rejected = remove_rejected_poly(gj, rejection_reasons)
+        if gj_rejected.features:
+            print('{} FIELDS REMOVED: {}'.format(len(gj_rejected.features), dict(collections.Counter(
+                item.properties['rejection_reason'] for item in gj_rejected.features))))
+
+        return gj,polygons_inw_buffered,gj_rejected
+
+    def generate_cropcalendars(self, start, end, gjson_path, window_values, thr_detection, crop_calendar_event, metrics_crop_event, index_window_above_thr,
+                               crop_calendar_events = None, seasons = None):
+        with self.metrics.stage('geometry'):
+            gj, polygons_inw_buffered, gj_rejected = self.load_geometry(gjson_path)
+        gj = self.generate_cropcalendars_fields(start, end, gj, polygons_inw_buffered, window_values, thr_detection,
+                                                crop_calendar_event, metrics_crop_event, index_window_above_thr, crop_calendar_events, seasons)
+        self.report_metrics()
+        return gj
+
+    def generate_cropcalendars_chunked(self, start, end, gjson_path, out_path, window_values, thr_detection, crop_calendar_event, metrics_crop_event,
+                                       index_window_above_thr, chunk_size=500, chunk_area=None, max_jobs_in_flight=2, crop_calendar_events=None,
+                                       seasons=None, checkpoint_path=None, output_format=None):
+        # The fields are read from the geojson file in chunks (of chunk_size fields and/or
+        # chunk_area m²) and each chunk runs the whole pipeline as separate openEO jobs.
+        # At most max_jobs_in_flight chunks are processed together and the result of each
+        # chunk is directly appended to the output geojson, so that the memory use doesn't
+        # depend on the size of the input file. The output format (see result_writers.WRITERS)
+        # is output_format or, if not given, the one of the extension of out_path.
+        # With a checkpoint_path the finished chunks and the position in the output file are
+        # saved after each chunk, so that an interrupted run continues with the other chunks.
+        # The checkpoint is only used if the input file, the chunking (the chunk indexes would
+        # refer to other fields), the time range, the parameters of the fields (see field_id)
+        # and the output file and format are the same, else all chunks are processed again.
+        # The columnar formats (GeoParquet, FlatGeobuf) can't be continued, for them an
+        # interrupted run starts again (with result_cache_dir the finished fields are cached).
+        # Returns the amount of written fields, raises ChunksFailedException if chunks failed
+        def process_chunk(gj_chunk):
+            with self.metrics.stage('geometry'):
+                gj_chunk, polygons_inw_buffered, gj_rejected = self.prepare_fields(gj_chunk)
+            if not gj_chunk.features:
+                return gj_chunk
+            return self.generate_cropcalendars_fields(start, end, gj_chunk, polygons_inw_buffered, window_values, thr_detection,
+                                                      crop_calendar_event, metrics_crop_event, index_window_above_thr, crop_calendar_events, seasons)
+
+        writer_class = get_writer_class(out_path, output_format)
+        checkpoint = load_checkpoint(checkpoint_path)
+        settings = None
+        if checkpoint_path is not None:
+            parameters = self.get_fields_parameters(window_values, thr_detection, crop_calendar_event, metrics_crop_event, index_window_above_thr,
+                                                    crop_calendar_events, seasons)
+            # as it is read from the json checkpoint (lists instead of tuples)
+            settings = json.loads(json.dumps({'input': input_fingerprint(gjson_path), 'chunk_size': chunk_size, 'chunk_area': chunk_area,
+                                              'start': start, 'end': end, 'parameters': parameters,
+                                              'output': os.path.abspath(out_path), 'writer': writer_class.__name__}))
+            if (checkpoint['chunks_done'] or checkpoint['finished']) and checkpoint.get('settings') != settings:
+                print('CHECKPOINT {} DOES NOT MATCH THE INPUT FILE, THE SETTINGS OR THE OUTPUT, ALL CHUNKS ARE PROCESSED AGAIN'.format(checkpoint_path))
+                checkpoint = load_checkpoint(None)
+        if checkpoint['finished'] and os.path.exists(out_path):
+            print('{} ALREADY PROCESSED ({} FIELDS)'.format(gjson_path, checkpoint['amount_features']))
+            self.metrics.count('fields_skipped', checkpoint['amount_features'])
+            return checkpoint['amount_features']
+        if checkpoint['finished']:
+            checkpoint = load_checkpoint(None)
+        if checkpoint['chunks_done'] and not writer_class.resumable:
+            print('{} CAN NOT BE RESUMED, ALL CHUNKS ARE PROCESSED AGAIN'.format(out_path))
+            checkpoint = load_checkpoint(None)
+        chunks_done = set(checkpoint['chunks_done'])
+        chunks_failed = 0
+        with writer_class(out_path, checkpoint['offset'], checkpoint['amount_features'],
+                          crop_calendar_properties(crop_calendar_event, crop_calendar_events, seasons)) as writer, \
+                ThreadPoolExecutor(max_workers=max_jobs_in_flight) as executor:
+            jobs_in_flight = dict()
+
+            def write_finished(return_when):
+                nonlocal chunks_failed
+                finished, _ = wait(jobs_in_flight, return_when=return_when)
+                for job_chunk in finished:
+                    c = jobs_in_flight.pop(job_chunk)
+                    try:
+                        writer.write_features(job_chunk.result().features)
+                    except Exception as e:
+                        chunks_failed += 1
+                        print('PROCESSING OF CHUNK {} FAILED: {}'.format(c, e))
+                        continue
+                    chunks_done.add(c)
+                    save_checkpoint(checkpoint_path, {'settings': settings, 'chunks_done': sorted(chunks_done), 'offset': writer.tell(),
+                                                      'amount_features': writer.amount_features, 'finished': False})
+
+            for c, gj_chunk in enumerate(iter_feature_chunks(iter_features(gjson_path), chunk_size=chunk_size, chunk_area=chunk_area)):
+                if c in chunks_done:
+                    continue
+                if len(jobs_in_flight) >= max_jobs_in_flight:
+                    write_finished(FIRST_COMPLETED)
+                jobs_in_flight[executor.submit(process_chunk, gj_chunk)] = c
+            write_finished(ALL_COMPLETED)
+        # with failed chunks the checkpoint of the last written chunk
+        # is kept, so that the failed chunks are processed in the next run
+        if chunks_failed == 0:
+            save_checkpoint(checkpoint_path, {'settings': settings, 'chunks_done': sorted(chunks_done), 'offset': None,
+                                              'amount_features': writer.amount_features, 'finished': True})
+        print('{} FIELDS WRITTEN TO {}, {} CHUNKS FAILED'.format(writer.amount_features, out_path, chunks_failed))
+        if chunks_failed:
+            self.metrics.count('chunks_failed', chunks_failed)
+        self.report_metrics()
+        if chunks_failed:
+            raise ChunksFailedException('{} chunks of {} failed'.format(chunks_failed, gjson_path), writer.amount_features, chunks_failed)
+        return writer.amount_features
+
+    def generate_cropcalendars_incremental(self, start, end, gjson_path, store_dir, window_values, thr_detection, crop_calendar_event, metrics_crop_event,
+                                           index_window_above_thr, crop_calendar_events=None, seasons=None, margin_days=60):
+        # Incremental update of the crop calendars, e.g. a weekly update during the season. The time series,
+        # the RO's of the acquisitions and the window probabilities of the fields are kept in a store in
+        # store_dir, so that only the dates after the last stored date of a field are extracted. The windows
+        # of a field that end before its new dates minus margin_days (cropsar uses the data around a date,
+        # so also the curve before the new dates can change) are not predicted again. The field id (and key
+        # in the store) is the field_id of its geometry, start and the parameters without end, which moves
+        # with each update, so that the stored state isn't used after the model or parameters changed.
+        with self.metrics.stage('geometry'):
+            gj, polygons_inw_buffered, gj_rejected = self.load_geometry(gjson_path)
+        store = FieldStateStore(store_dir)
+        parameters = self.get_fields_parameters(window_values, thr_detection, crop_calendar_event, metrics_crop_event, index_window_above_thr,
+                                                crop_calendar_events, seasons)
+        keys_fields = [field_id(feature.geometry, start, None, parameters) for feature in gj.features]
+        # the fields with the same geometry are processed once
+        loc_keys = dict()
+        for s, key in enumerate(keys_fields):
+            loc_keys.setdefault(key, s)
+        states = store.get_many(loc_keys.keys())
+
+        # the first date to extract per field: the day after the last stored date,
+        # fields which are new or were processed for another start start from start
+        fetch_from = dict()
+        for key in loc_keys:
+            if key not in states or states[key]['start'] != start or states[key]['last_date'] is None:
+                states[key] = new_field_state(start)
+                fetch_from[key] = start
+            else:
+                fetch_from[key] = (pd.Timestamp(states[key]['last_date']) + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+        groups = dict()
+        for key in loc_keys:
+            if fetch_from[key] <= end:
+                groups.setdefault(fetch_from[key], []).append(key)
+        print('{} FIELDS, {} TO UPDATE FROM {}'.format(len(loc_keys), sum(len(keys) for keys in groups.values()), sorted(groups.keys())))
+
+        # extract the new dates and get the RO's of the new acquisitions, per group of fields with the same first date
+        orchestrator = JobOrchestrator(poll_interval=self.poll_interval, metrics=self.metrics)
+        for fetch_start, keys_group in groups.items():
+            geo = shapely.geometry.GeometryCollection(
+                [shapely.geometry.shape(polygons_inw_buffered[loc_keys[key]]).buffer(0) for key in keys_group])
+            orchestrator.submit('timeseries_{}'.format(fetch_start), self.get_bands(geo).filter_temporal(fetch_start, end).polygonal_mean_timeseries(geo))
+        keys_update = []
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            orbits_retrieval = {fetch_start: executor.submit(self.metrics.timed, 'catalogue', self._open_search.OpenSearch_metadata_retrieval_fields,
+                                                             fetch_start, end, [gj.features[loc_keys[key]] for key in keys_group])
+                                for fetch_start, keys_group in groups.items()}
+            for fetch_start, keys_group in groups.items():
+                with self.metrics.stage('timeseries_wait'):
+                    timeseries_json = orchestrator.result('timeseries_{}'.format(fetch_start))
+                orbits_group = orbits_retrieval[fetch_start].result()
+                for k, key in enumerate(keys_group):
+                    dates_field = [date for date in timeseries_json if timeseries_json[date][k]]
+                    for date in dates_field:
+                        states[key]['timeseries'][date] = timeseries_json[date][k]
+                    if isinstance(orbits_group[k], tuple):
+                        for loc_pass in range(2):
+                            states[key]['orbits'][loc_pass].update(orbits_group[k][loc_pass])
+                    if dates_field:
+                        states[key]['last_date'] = max(states[key]['timeseries'].keys())[:10]
+                        keys_update.append(key)
+
+        if keys_update:
+            # the UDF runs on the complete time series of the updated fields
+            dates = sorted(set(date for key in keys_update for date in states[key]['timeseries']))
+            timeseries_json = {date: [states[key]['timeseries'].get(date, []) for key in keys_update] for date in dates}
+            with self.metrics.stage('RO_selection'):
+                angle_fields = self.get_angle_timeseries(timeseries_json_to_pandas(timeseries_json))
+                orbits_fields = [tuple(states[key]['orbits']) for key in keys_update]
+                orbit_passes = ['ASCENDING', 'DESCENDING']
+                df_RO_selection = select_RO_fields(RO_angle_table(orbits_fields, angle_fields, orbit_passes))
+
+            context_to_udf = self.get_udf_context(window_values, thr_detection, crop_calendar_event, metrics_crop_event, index_window_above_thr,
+                                                  df_RO_selection, keys_update, crop_calendar_events, seasons)
+            context_to_udf['windows_state'] = {key: states[key]['windows_state'] for key in keys_update if states[key]['windows_state']}
+            # per field, so that a new field doesn't cause a complete update of the other fields
+            context_to_udf['windows_update_from'] = {key: (pd.Timestamp(fetch_from[key]) - pd.Timedelta(days=margin_days)).strftime('%Y-%m-%d')
+                                                     for key in keys_update}
+            context_to_udf['return_windows_state'] = True
+            self.submit_udf_timeseries(orchestrator, 'udf', timeseries_json, context_to_udf)
+            with self.metrics.stage('udf_wait'):
+                crop_calendars = orchestrator.result('udf')
+            self.metrics.add_udf_metrics(crop_calendars.pop('_metrics', None))
+            windows_state = crop_calendars.pop('_windows_state')
+            crop_calendars_df = pd.DataFrame.from_dict(crop_calendars)
+            for key, properties in crop_calendars_df.to_dict(orient='index').items():
+                states[key]['properties'] = properties
+                states[key]['windows_state'] = windows_state.get(key, dict())
+            store.put_many({key: states[key] for key in keys_update})
+
+        #### ASSIGN THE (UPDATED OR STORED) CROP CALENDAR EVENTS AS PROPERTIES TO THE FIELDS
+        with self.metrics.stage('merge_results'):
+            for feature, key in zip(gj.features, keys_fields):
+                feature.properties['id'] = key
+                feature.properties.update(states[key]['properties'])
+        self.metrics.count('fields', len(gj.features))
+        self.metrics.count('fields_updated', len(keys_update))
+        self.report_metrics()
+        return gj
+
+    # function to print the metrics of the pipeline (see pipeline_metrics.py) at the end of a run
+    def report_metrics(self):
+        if self.print_metrics:
+            print('PIPELINE METRICS: {}'.format(self.metrics.to_json()))
+
+    # the settings which determine the crop calendar result of a field, part of its id
+    def get_fields_parameters(self, window_values, thr_detection, crop_calendar_event, metrics_crop_event, index_window_above_thr,
+                              crop_calendar_events = None, seasons = None):
+        return {'window_values': window_values, 'thr_detection': thr_detection, 'crop_calendar_event': crop_calendar_event,
+                'metrics_crop_event': metrics_crop_event, 'index_window_above_thr': index_window_above_thr,
+                'path_harvest_model': self.path_harvest_model, 'metrics_order': self.metrics_order,
+                'VH_VV_range_normalization': self.VH_VV_range_normalization, 'fAPAR_range_normalization': self.fAPAR_range_normalization,
+                'fAPAR_rescale_Openeo': self.fAPAR_rescale_Openeo, 'crop_calendar_events': crop_calendar_events, 'seasons': seasons}
+
+    def generate_cropcalendars_fields(self, start, end, gj, polygons_inw_buffered, window_values, thr_detection, crop_calendar_event, metrics_crop_event, index_window_above_thr,
+                                      crop_calendar_events = None, seasons = None):
+        # define an unique id per field that will be needed to estimate the crop calendars properly for each field:
+        # the hash of its geometry and the settings, so that the same field gets the same id in each run
+        parameters = self.get_fields_parameters(window_values, thr_detection, crop_calendar_event, metrics_crop_event, index_window_above_thr,
+                                                crop_calendar_events, seasons)
+        ids_fields = [field_id(feature.geometry, start, end, parameters) for feature in gj.features]
+        properties_fields = dict() if self._result_cache is None else self._result_cache.get_many(set(ids_fields))
+        # the fields which are not cached are processed, the fields with the same geometry once
+        loc_process = dict()
+        for s, id_field in enumerate(ids_fields):
+            if id_field not in properties_fields:
+                loc_process.setdefault(id_field, s)
+        print('{} FIELDS, {} CACHED, {} TO PROCESS'.format(len(ids_fields), sum(id_field in properties_fields for id_field in ids_fields),
+                                                          len(loc_process)))
+        if loc_process:
+            crop_calendars = self.run_pipeline_fields(start, end, [gj.features[s] for s in loc_process.values()],
+                                                      [polygons_inw_buffered[s] for s in loc_process.values()], list(loc_process.keys()),
+                                                      window_values, thr_detection, crop_calendar_event, metrics_crop_event, index_window_above_thr,
+                                                      crop_calendar_events, seasons)
+            properties_process = pd.DataFrame.from_dict(crop_calendars).to_dict(orient='index')
+            if self._result_cache is not None:
+                self._result_cache.put_many(properties_process)
+            properties_fields.update(properties_process)
+
+        #### FINALLY ASSIGN THE CROP CALENDAR EVENTS AS PROPERTIES TO THE GEOJSON FILE WITH THE FIELDS
+        with self.metrics.stage('merge_results'):
+            for feature, id_field in zip(gj.features, ids_fields):
+                feature.properties['id'] = id_field
+                feature.properties.update(properties_fields[id_field])
+        self.metrics.count('fields', len(gj.features))
+        self.metrics.count('fields_processed', len(loc_process))
+        return gj
+
+    # function to run the pipeline (catalogue, time series, RO selection and UDF) for the
+    # fields with the given ids, returns the crop calendar result of the UDF (json)
+    def run_pipeline_fields(self, start, end, features, polygons_inw_buffered, unique_ids_fields, window_values, thr_detection, crop_calendar_event,
+                            metrics_crop_event, index_window_above_thr, crop_calendar_events = None, seasons = None):
             ##### FUNCTION TO BUILD A DATACUBE IN OPENEO
 
-            def get_angle(geo, start, end):
+            def submit_angle(orchestrator, geo, start, end):
+                # start the jobs for both orbit passes together
+                orbit_passes = [r'ASCENDING', r'DESCENDING']
+                for orbit_pass in orbit_passes:
+                    angle = self._eoconn.load_collection('S1_GRD_SIGMA0_{}'.format(orbit_pass), bands = ['angle']).band('angle')
+                    try:
+                        orchestrator.submit('angle_{}'.format(orbit_pass), angle.filter_temporal(start,end).polygonal_mean_timeseries(geo))
+                    except Exception as e:
+                        print('SUBMITTING THE ANGLE JOB FOR {} FAILED: {}'.format(orbit_pass, e))
+
+            def get_angle(orchestrator, geo, start, end):
                 scale = 0.0005
                 offset = 29
                 orbit_passes = [r'ASCENDING', r'DESCENDING']
                 dict_df_angles_fields = dict()
+                angle_jobs = orchestrator.wait([name for name in orchestrator.statuses() if name.startswith('angle_')])
                 for orbit_pass in orbit_passes:
                     angle = self._eoconn.load_collection('S1_GRD_SIGMA0_{}'.format(orbit_pass), bands = ['angle']).band('angle')
                     try:
-                        angle_fields = angle.filter_temporal(start,end).polygonal_mean_timeseries(geo).send_job().start_and_wait().get_result().load_json()
+                        angle_fields = angle_jobs.get('angle_{}'.format(orbit_pass), JobFailedException('Angle job not submitted'))
+                        if isinstance(angle_fields, Exception):
+                            raise angle_fields
                         df_angle_fields = timeseries_json_to_pandas(angle_fields)
                     except Exception:
                         print('RUNNING IN EXECUTE MODE WAS NOT POSSIBLE ... TRY BATCH MODE')
@@ -119,103 +507,62 @@ class Cropcalendars():
                 return dict_df_angles_fields
 
 
-            # def to find the optimal orbit
-
-            def find_optimal_RO_per_pass(dict_orbit_metadata_frequency_info, dict_angle_orbit_pass):
-                RO_orbit_counter = collections.Counter(list(dict_orbit_metadata_frequency_info.values()))
-                RO_steepest_angle = max(dict_angle_orbit_pass, key=lambda x: dict_angle_orbit_pass[x])
-                # see if the orbit with steepest angle has not a lot fewer coverages compared to the orbit with the maximum coverages. In case this orbit has more than 80% less
-                # coverage another orbit is selected
-                if RO_orbit_counter.get(RO_steepest_angle) < int(max(list(RO_orbit_counter.values())) * 0.80):
-                    RO_orbit_selection = statistics.mode(list(dict_orbit_metadata_frequency_info.values()))
-                else:
-                    RO_orbit_selection = RO_steepest_angle
-                list_orbit_passes = sorted(list(
-                    (key) for key, value in dict_orbit_metadata_frequency_info.items() if value == RO_orbit_selection))
-                dict_metadata_RO_selection = {list_orbit_passes[0].strftime('%Y-%m-%d'): RO_orbit_selection}
-                return dict_metadata_RO_selection, RO_orbit_selection
-            def Opensearch_OpenEO_RO_selection(angle_fields,gj,orbit_passes, s):
-                # get some info on the RO intersecting the fields by using the Opensearch for filtering data in Terrascope
-                dict_descending_orbits_field, dict_ascending_orbits_field = self._open_search.OpenSearch_metadata_retrieval(start, end, gj.features[s])
-                for orbit_pass in orbit_passes:
-                    if orbit_pass == 'ASCENDING':
-                        df_RO_pass = pd.DataFrame(data = dict_ascending_orbits_field.values(), columns = (['RO']), index = dict_ascending_orbits_field.keys())
-                    else:
-                        df_RO_pass = pd.DataFrame(data = dict_descending_orbits_field.values(), columns = (['RO']), index = dict_descending_orbits_field.keys())
-
-                    df_RO_pass.index = pd.to_datetime(df_RO_pass.index)
-                    df_RO_pass = df_RO_pass.tz_localize(None)
-                    df_angle_pass = angle_fields['{}'.format(orbit_pass)].iloc[:,s]
-                    df_angle_pass.index = pd.to_datetime(df_angle_pass.index)
-                    df_angle_pass = df_angle_pass.tz_localize(None)
-                    df_pass_combine  = df_RO_pass.merge(df_angle_pass, left_index= True, right_index= True, how = 'inner') # join the RO orbit and angle dataframe based on their index date
-                    dict_angle_pass = df_pass_combine.set_index('RO').T.reset_index(drop=True).to_dict(orient='records')[0]
-                    columns_df = list(df_pass_combine.columns.values)
-                    columns_df = [item for item in columns_df if not 'angle' in item]
-                    dict_metadata_pass = df_pass_combine[columns_df].to_dict()[columns_df[0]]
-                    if orbit_pass == 'ASCENDING':
-                        dict_metadata_ascending_RO_selection, RO_ascending_selection = find_optimal_RO_per_pass(
-                            dict_metadata_pass, dict_angle_pass)
-
-                    else:
-                        dict_metadata_descending_RO_selection, RO_descending_selection = find_optimal_RO_per_pass(
-                            dict_metadata_pass, dict_angle_pass)
-
-                return dict_metadata_ascending_RO_selection, dict_metadata_descending_RO_selection
-
             ###############################################################
             ###################### MAIN SCRIPT ############################
             ###############################################################
 
-            gj, polygons_inw_buffered = self.load_geometry(gjson_path)
             geo = shapely.geometry.GeometryCollection(
                 [shapely.geometry.shape(feature).buffer(0) for feature in polygons_inw_buffered])
 
-            # get some info on the indicence angle covering the fields
-            angle_fields = get_angle(geo, start, end)
+            # the angle jobs and the catalogue requests don't depend on each other: the jobs
+            # are started first and the catalogue is queried while the backend is processing
+            orchestrator = JobOrchestrator(poll_interval=self.poll_interval, metrics=self.metrics)
+            if self.single_pass:
+                # a single job computes the time series of all bands, which are used
+                # both for the angle (RO selection) and as input for the UDF
+                timeseries = self.get_bands(geo).filter_temporal(start,end).polygonal_mean_timeseries(geo)
+                orchestrator.submit('timeseries', timeseries)
+            else:
+                submit_angle(orchestrator, geo, start, end)
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                # get some info on the RO intersecting the fields by using the Opensearch
+                # for filtering data in Terrascope, all fields are retrieved together
+                orbits_fields_retrieval = executor.submit(self.metrics.timed, 'catalogue', self._open_search.OpenSearch_metadata_retrieval_fields,
+                                                          start, end, features)
+                # get some info on the indicence angle covering the fields
+                with self.metrics.stage('timeseries_wait'):
+                    if self.single_pass:
+                        timeseries_json = orchestrator.result('timeseries')
+                    else:
+                        orchestrator.wait([name for name in orchestrator.statuses() if name.startswith('angle_')])
+                if self.single_pass:
+                    angle_fields = self.get_angle_timeseries(timeseries_json_to_pandas(timeseries_json))
+                else:
+                    angle_fields = get_angle(orchestrator, geo, start, end)
+                orbits_fields = orbits_fields_retrieval.result()
             orbit_passes = ['ASCENDING', 'DESCENDING']
 
             # Find the most suitable ascending/descending orbits based
-            # on its availability and incidence angle
-            # define an unique id per field that will be needed
-            # to estimate the crop calendars properly for each field
-            unique_ids_fields = []
-            dict_ascending_orbits_field = dict()
-            dict_descending_orbits_field = dict()
-            for s in range(len(gj.features)):
-                gj.features[s].properties['id'] = str(uuid.uuid1())
-                unique_ids_fields.extend([gj.features[s].properties['id']])
-                RO_ascending_selection, RO_descending_selection = Opensearch_OpenEO_RO_selection(angle_fields, gj, orbit_passes, s)
-                dict_ascending_orbits_field.update({gj.features[s].properties['id']: RO_ascending_selection})
-                dict_descending_orbits_field.update({gj.features[s].properties['id']: RO_descending_selection})
-
-            # get the datacube containing the time series data
-            bands_ts = self.get_bands()
-
+            # on its availability and incidence angle, for all fields together
+            with self.metrics.stage('RO_selection'):
+                df_RO_selection = select_RO_fields(RO_angle_table(orbits_fields, angle_fields, orbit_passes))
 
             ##### POST PROCESSING TIMESERIES USING A UDF
-            timeseries = bands_ts.filter_temporal(start,end).polygonal_mean_timeseries(geo)
-            udf = self.load_udf('crop_calendar_udf.py')
-
-            # Default parameters are ingested in the UDF
-            context_to_udf = dict({'window_values': window_values, 'thr_detection': thr_detection, 'crop_calendar_event': crop_calendar_event,
-                                   'metrics_crop_event': metrics_crop_event, 'VH_VV_range_normalization': self.VH_VV_range_normalization,
-                                   'fAPAR_range_normalization': self.fAPAR_range_normalization, 'fAPAR_rescale_Openeo': self.fAPAR_rescale_Openeo,
-                                   'coherence_rescale_Openeo': self.coherence_rescale_Openeo,
-                                   'RO_ascending_selection_per_field': dict_ascending_orbits_field, 'RO_descending_selection_per_field': dict_descending_orbits_field,
-                                   'unique_ids_fields': unique_ids_fields, 'index_window_above_thr': index_window_above_thr,
-                                   'metrics_order': self.metrics_order, 'path_harvest_model': self.path_harvest_model})
-            job:Job = timeseries.process("run_udf",data = timeseries._pg, udf = udf, runtime = 'Python', context = context_to_udf).send_job()
-            crop_calendars = job.start_and_wait().get_result().load_json()
-            crop_calendars_df = pd.DataFrame.from_dict(crop_calendars)
-
-
-            #### FINALLY ASSIGN THE CROP CALENDAR EVENTS AS PROPERTIES TO THE GEOJSON FILE WITH THE FIELDS
-            for s in range(len(gj.features)):
-                for c in range(crop_calendars_df.shape[1]):  # the amount of crop calendar events which were determined
-                    gj.features[s].properties[crop_calendars_df.columns[c]] = \
-                    crop_calendars_df.loc[crop_calendars_df.index == unique_ids_fields[s]][crop_calendars_df.columns[c]].values[0]  # the date of the event
-            return gj
+            context_to_udf = self.get_udf_context(window_values, thr_detection, crop_calendar_event, metrics_crop_event, index_window_above_thr,
+                                                  df_RO_selection, unique_ids_fields, crop_calendar_events, seasons)
+            if self.single_pass:
+                # the UDF runs on the time series which were already computed
+                self.submit_udf_timeseries(orchestrator, 'udf', timeseries_json, context_to_udf)
+            else:
+                udf = self.load_udf('crop_calendar_udf.py')
+                # get the datacube containing the time series data
+                bands_ts = self.get_bands(geo)
+                timeseries = bands_ts.filter_temporal(start,end).polygonal_mean_timeseries(geo)
+                orchestrator.submit('udf', timeseries.process("run_udf",data = timeseries._pg, udf = udf, runtime = 'Python', context = context_to_udf))
+            with self.metrics.stage('udf_wait'):
+                crop_calendars = orchestrator.result('udf')
+            self.metrics.add_udf_metrics(crop_calendars.pop('_metrics', None))
+            return crop_calendars
 
 
 
@@ -1,6 +1,5 @@
 import os
 from Crop_calendars.Crop_calendars_openeo_integration import Cropcalendars
-import json
 def main():
     ######## DEFAULT PARAMETERS ##########
     metrics_order =  ['sigma_ascending_VH', 'sigma_ascending_VV','sigma_ascending_angle','sigma_descending_VH', 'sigma_descending_VV','sigma_descending_angle', 'fAPAR']  # The index position of the metrics returned from the OpenEO datacube
@@ -16,10 +15,12 @@ def main():
     start = '2020-01-01'
     end = '2020-10-31'
     # the folder in which you want to store the output result
-    outdir = r'C:\Test\'
+    outdir = r'C:\Test'
 
     #the name of the output file containing the crop calendar
-    #info for the fields
+    #info for the fields, the format is chosen on the extension:
+    #.json/.geojson (geojson), .geojsons (GeoJSON sequence),
+    #.parquet (GeoParquet) or .fgb (FlatGeobuf)
 
     outname = r'Test.json'#r'Extract_LPIS_test.json'
 
@@ -31,14 +32,13 @@ def main():
     metrics_crop_event = ['cropSAR', 'VH_VV_{}'] # the metrics used to determine the crop calendar event
 
     ###### INITIATE THE CLASS AND RUN THE CROP CALENDAR MODEL
-    # The output contains an updated geojson file with
-    # in its properties the derived crop calendar events
-    gj_cropcalendars_info = generator.generate_cropcalendars(start = start, end = end, gjson_path = gjson_path, window_values= window_values, thr_detection= thr_detection,
-                                                             crop_calendar_event= crop_calendar_event, metrics_crop_event = metrics_crop_event,
-                                                             index_window_above_thr = index_window_above_thr) # returns the geometry collection with as attribute the crop calendars per field ID
-    ### The output file location (json format) which you want to use to store the result
-    with open(os.path.join(outdir, outname),"w") as file:
-        file.write(json.dumps(gj_cropcalendars_info))
+    # The output file contains the fields with
+    # in its properties the derived crop calendar events,
+    # the fields are processed and written in chunks
+    generator.generate_cropcalendars_chunked(start = start, end = end, gjson_path = gjson_path, out_path = os.path.join(outdir, outname),
+                                             window_values= window_values, thr_detection= thr_detection,
+                                             crop_calendar_event= crop_calendar_event, metrics_crop_event = metrics_crop_event,
+                                             index_window_above_thr = index_window_above_thr) # writes the fields with as attribute the crop calendars per field ID
 
 
 if __name__ == '__main__':
@@ -0,0 +1,70 @@
+# Selection of the most suitable relative orbit (RO) per orbit pass for all fields at once.
+# The selection works on a long table with a row per field, orbit pass and acquisition date
+# with the RO (from the catalogue) and the incidence angle (from openEO) of the acquisition.
+
+import numpy as np
+import pandas as pd
+
+# function to build the long table (field, pass, date, RO, angle) from the catalogue
+# metadata per field ((descending, ascending) dicts of date: RO) and the angle time series
+# per orbit pass (a column per field, in the same order as the fields). Only the acquisitions
+# available in both are kept and the rows keep the order of the catalogue metadata
+def RO_angle_table(orbits_fields, angle_fields, orbit_passes=('ASCENDING', 'DESCENDING')):
+    df_RO = []
+    df_angle = []
+    for orbit_pass in orbit_passes:
+        loc_pass = 1 if orbit_pass == 'ASCENDING' else 0
+        fields = [s for s in range(len(orbits_fields)) for _ in orbits_fields[s][loc_pass]]
+        df_RO.append(pd.DataFrame({'field': np.asarray(fields, dtype=int), 'pass': orbit_pass,
+                                   'date': [date for s in range(len(orbits_fields)) for date in orbits_fields[s][loc_pass].keys()],
+                                   'RO': [RO for s in range(len(orbits_fields)) for RO in orbits_fields[s][loc_pass].values()]}))
+
+        df_angle_pass = angle_fields[orbit_pass].copy()
+        df_angle_pass.columns = np.arange(df_angle_pass.shape[1])
+        df_angle_pass.index = pd.to_datetime(df_angle_pass.index)
+        if df_angle_pass.index.tz is not None:
+            df_angle_pass = df_angle_pass.tz_localize(None)
+        df_angle_pass = df_angle_pass.stack(dropna=False).rename('angle').rename_axis(['date', 'field']).reset_index()
+        df_angle_pass['pass'] = orbit_pass
+        df_angle.append(df_angle_pass)
+
+    df_RO = pd.concat(df_RO, ignore_index=True)
+    df_RO['date'] = pd.to_datetime(df_RO['date'])
+    if df_RO['date'].dt.tz is not None:
+        df_RO['date'] = df_RO['date'].dt.tz_localize(None)
+    return df_RO.merge(pd.concat(df_angle, ignore_index=True), on=['field', 'pass', 'date'], how='inner')
+
+# function to select per field and orbit pass the RO with the steepest incidence angle, unless
+# the amount of acquisitions of this RO is lower than 80% of the RO with the most acquisitions,
+# then the RO with the most acquisitions is taken. Returns a table with per field and pass
+# the selected RO and the date of its first acquisition. Same rules as before per field:
+# the angle of a RO is the one of its last acquisition and ties are resolved in the order
+# in which the RO's occur in the table. Acquisitions without angle are not used for the angle
+def select_RO_fields(df_RO_angle, coverage_ratio=0.80):
+    keys = ['field', 'pass']
+    df_RO_angle = df_RO_angle.reset_index(drop=True)
+    df_RO_angle['order'] = np.arange(df_RO_angle.shape[0])
+
+    df_per_RO = df_RO_angle.groupby(keys + ['RO'], sort=False).agg(
+        count=('order', 'size'), first_order=('order', 'min'), first_date=('date', 'min'))
+    df_per_RO['angle'] = df_RO_angle.drop_duplicates(keys + ['RO'], keep='last').set_index(keys + ['RO'])['angle']
+    df_per_RO = df_per_RO.reset_index().sort_values('first_order')
+    df_per_RO['max_count'] = df_per_RO.groupby(keys)['count'].transform('max')
+
+    RO_mode = df_per_RO.sort_values(['count', 'first_order'], ascending=[False, True]).drop_duplicates(keys).set_index(keys)
+    RO_steepest = df_per_RO.dropna(subset=['angle']).sort_values(['angle', 'first_order'], ascending=[False, True])\
+        .drop_duplicates(keys).set_index(keys).reindex(RO_mode.index)
+
+    # see if the orbit with steepest angle has not a lot fewer coverages compared to the orbit with the maximum coverages
+    use_mode = RO_steepest['RO'].isnull() | (RO_steepest['count'] < np.floor(RO_steepest['max_count'] * coverage_ratio))
+    df_selection = RO_steepest[['RO', 'first_date']].where(~use_mode, RO_mode[['RO', 'first_date']])
+    return df_selection.reset_index()
+
+# function to convert the selection to the dicts used in the UDF context:
+# per orbit pass {id field: {first date of the RO: RO}}
+def RO_selection_to_dicts(df_selection, unique_ids_fields, orbit_passes=('ASCENDING', 'DESCENDING')):
+    dicts_passes = {orbit_pass: dict() for orbit_pass in orbit_passes}
+    for field, orbit_pass, RO, first_date in df_selection[['field', 'pass', 'RO', 'first_date']].itertuples(index=False):
+        dicts_passes[orbit_pass][unique_ids_fields[field]] = {pd.Timestamp(first_date).strftime('%Y-%m-%d'): int(RO)}
+    return [{id_field: dicts_passes[orbit_pass][id_field] for id_field in unique_ids_fields if id_field in dicts_passes[orbit_pass]}
+            for orbit_pass in orbit_passes]
@@ -8,13 +8,110 @@ import re
 import sys
 import dateutil.parser as dp
 import numpy as np
-from shapely.geometry import Polygon
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from shapely.geometry import Polygon, box, shape
+from shapely.geometry.base import BaseGeometry
+from shapely.strtree import STRtree
+from urllib3.util.retry import Retry
+from Crop_calendars.catalogue_cache import CatalogueCache
+
+
+def coord_to_bbox(gj_poly):
+
+    ###################### DEFINE GEOMETRY OF POLGYON #######################
+    #########################################################################
+    if gj_poly.geometry.type == 'Polygon':
+        x_coord = [float(item[0]) for item in gj_poly.geometry['coordinates'][0]]
+        y_coord = [float(item[1]) for item in gj_poly.geometry['coordinates'][0]]
+    elif gj_poly.geometry.type == 'MultiPolygon':
+        x_coord = [float(item[0]) for item in gj_poly.geometry['coordinates'][0][0]]
+        y_coord = [float(item[1]) for item in gj_poly.geometry['coordinates'][0][0]]
+
+    field = Polygon(zip(x_coord, y_coord))
+    minx, miny, maxx, maxy = field.bounds
+    return minx, miny, maxx, maxy
+
+# function to group the fields in clusters of nearby fields, based on the cell
+# of a regular grid (in degrees) in which the center of their bbox falls
+def cluster_bboxes_grid(bboxes, cell_size):
+    clusters = dict()
+    for b in range(len(bboxes)):
+        minx, miny, maxx, maxy = bboxes[b]
+        cell = (int(np.floor((minx + maxx) / 2 / cell_size)), int(np.floor((miny + maxy) / 2 / cell_size)))
+        clusters.setdefault(cell, []).append(b)
+    return list(clusters.values())
+
+# function to check which products of the catalogue overlap with the bbox of each field.
+# The footprints of the products are built once and indexed in an STRtree, so that
+# per field only the products with an overlapping envelope are checked
+def products_intersecting_bboxes(features, bboxes):
+    footprints = []
+    loc_footprints = []
+    products_always = [] # without footprint the product can't be assigned, so keep it
+    for p, f in enumerate(features):
+        if f.get('geometry'):
+            footprints.append(shape(f['geometry']))
+        elif f.get('bbox'):
+            footprints.append(box(*f['bbox'][:4]))
+        else:
+            products_always.append(p)
+            continue
+        loc_footprints.append(p)
+    tree = STRtree(footprints) if footprints else None
+    # shapely < 2 returns the geometries of the tree, shapely 2 their index
+    loc_geometries = {id(footprint): i for i, footprint in enumerate(footprints)}
+    features_fields = []
+    for bbox in bboxes:
+        bbox_field = box(*bbox)
+        products_field = list(products_always)
+        if tree is not None:
+            for item in tree.query(bbox_field):
+                i = loc_geometries[id(item)] if isinstance(item, BaseGeometry) else int(item)
+                if footprints[i].intersects(bbox_field):
+                    products_field.append(loc_footprints[i])
+        features_fields.append([features[p] for p in sorted(products_field)])
+    return features_fields
 
 
 class OpenSearch:
 
-    def __init__(self):
+    # The catalogue requests go through a single pooled session (keep-alive)
+    # and the pages of the products are retrieved concurrently by at most
+    # max_workers threads. Failed requests are retried with an exponential backoff.
+    # Nearby fields (in the same grid cell of cluster_size degrees) are retrieved with a
+    # single request for their combined bbox, cluster_size None gives a request per field.
+    # With a cache_dir the responses are stored in a persistent CatalogueCache
+    def __init__(self, ElasticSearchURL='https://services.terrascope.be/catalogue/', max_workers=8, max_retries=5,
+                 backoff_factor=0.5, timeout=60, cluster_size=0.1, cache_dir=None, cache_ttl=24 * 3600):
         self._collections = None
+        self._cache = None if cache_dir is None else CatalogueCache(cache_dir, ttl=cache_ttl)
+        self.ElasticSearchURL = ElasticSearchURL
+        self.cluster_size = cluster_size
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        retries = Retry(total=max_retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retries)
+        self._session = requests.Session()
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def _get_json(self, url):
+        if self._cache is not None:
+            response_json = self._cache.get(url)
+            if response_json is not None:
+                return response_json
+        response = self._session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        response_json = response.json()
+        if self._cache is not None:
+            self._cache.put(url, response_json)
+        return response_json
+
+    def cacheStats(self):
+        'report of the persistent cache (hits, misses, entries, size), None without cache'
+        return None if self._cache is None else self._cache.stats()
 
     def getCollectionParameters(self, ElasticSearchURL, printURL=False):
         if self._collections is None:
@@ -23,8 +120,7 @@ class OpenSearch:
             if printURL:
                 print(ElasticSearchURL + 'collections')
 
-            CatalogCollections = requests.get(ElasticSearchURL + 'collections')
-            CollJson = CatalogCollections.json()
+            CollJson = self._get_json(ElasticSearchURL + 'collections')
             collections = []
             featJson = CollJson['features']
 
@@ -48,144 +144,174 @@ class OpenSearch:
 
         return self._collections
 
+    def getRequestProducts(self, urn, ElasticSearchURL, start=datetime.datetime(2015, 1, 1, 0, 0, 0).isoformat(),
+                           end=datetime.datetime(2023, 12, 31, 23, 59, 59).isoformat(), latmin=-90.0, latmax=90.0,
+                           lonmin=-180.0, lonmax=180.0, ccmin=0.0, ccmax=100.0,
+                           prstart=datetime.datetime(2015, 1, 1, 0, 0, 0).isoformat(),
+                           prend=datetime.datetime(2021, 12, 31, 23, 59, 59).isoformat(),
+                           tID='', onTerrascope=True, printURL=False):
+        'build the request (without the start index of the page) for the products in the catalogue'
+        bbox = str(lonmin) + ',' + str(latmin) + ',' + str(lonmax) + ',' + str(latmax)
+        requestbasestring = ElasticSearchURL + 'products?collection=' + urn + "&start=" + str(start) + "&end=" + str(
+            end) + '&bbox=' + bbox
+        requestbasestring = requestbasestring + '&modificationDate=[' + str(prstart) + ',' + str(prend) + "["
 
-    def OpenSearch_metadata_retrieval(self, start, end, geo):
+        if 'S2' in urn:  # cloud cover is not relevant for S1 products
+            requestbasestring = requestbasestring + '&cloudCover=[' + str(ccmin) + ',' + str(ccmax) + ']'
+            if tID != '':  # there are tile IDs only for S2 products
+                requestbasestring = requestbasestring + '&sortKeys=title,,0,0&tileId=' + tID
+            else:
+                requestbasestring = requestbasestring + '&sortKeys=title,,0,0'
+        if onTerrascope:
+            requestbasestring = requestbasestring + '&accessedFrom=MEP'
+        if printURL:
+            print(requestbasestring + '&startIndex=1')  # printing this is useful if you want to paste it in a browser
+        return requestbasestring
 
-        def coord_to_bbox(gj_poly):
-
-            ###################### DEFINE GEOMETRY OF POLGYON #######################
-            #########################################################################
-            if gj_poly.geometry.type == 'Polygon':
-                x_coord = [float(item[0]) for item in gj_poly.geometry['coordinates'][0]]
-                y_coord = [float(item[1]) for item in gj_poly.geometry['coordinates'][0]]
-            elif gj_poly.geometry.type == 'MultiPolygon':
-                x_coord = [float(item[0]) for item in gj_poly.geometry['coordinates'][0][0]]
-                y_coord = [float(item[1]) for item in gj_poly.geometry['coordinates'][0][0]]
-
-            field = Polygon(zip(x_coord, y_coord))
-            minx, miny, maxx, maxy = field.bounds
-            return minx, miny, maxx, maxy
-
-        def findProducts(urn, ElasticSearchURL, start=datetime.datetime(2015, 1, 1, 0, 0, 0).isoformat(),
-                         end=datetime.datetime(2023, 12, 31, 23, 59, 59).isoformat(),latmin = -90.0, latmax = 90.0, lonmin = -180.0, lonmax = 180.0,
-                        ccmin=0.0, ccmax=100.0,
-                         prstart=datetime.datetime(2015, 1, 1, 0, 0, 0).isoformat(),
-                         prend=datetime.datetime(2021, 12, 31, 23, 59, 59).isoformat(),
-                         tID='', onTerrascope=True, printURL=False):
-            dict_metadata_ascending = dict()
-            dict_metadata_descending = dict()
-            productsList = []
-            bbox = str(lonmin) + ',' + str(latmin) + ',' + str(lonmax) + ',' + str(latmax)
-            requestbasestring = ElasticSearchURL + 'products?collection=' + urn + "&start=" + str(start) + "&end=" + str(
-                end) + '&bbox=' + bbox
-            requestbasestring = requestbasestring + '&modificationDate=[' + str(prstart) + ',' + str(prend) + "["
-
-            if 'S2' in urn:  # cloud cover is not relevant for S1 products
-                requestbasestring = requestbasestring + '&cloudCover=[' + str(ccmin) + ',' + str(ccmax) + ']'
-                if tID != '':  # there are tile IDs only for S2 products
-                    requestbasestring = requestbasestring + '&sortKeys=title,,0,0&tileId=' + tID
-                else:
-                    requestbasestring = requestbasestring + '&sortKeys=title,,0,0'
-            if onTerrascope:
-                requestbasestring = requestbasestring + '&accessedFrom=MEP'
-            if printURL:
-                print(requestbasestring + '&startIndex=1')  # printing this is useful if you want to paste it in a browser
-
-            products = requests.get(requestbasestring + '&startIndex=1')
-            productsJson = products.json()
-            numProducts = productsJson['totalResults']
-            print(str(numProducts) + ' products found between ' + str(start) + ' and ' + str(end) + ' produced between ' + str(
-                prstart) + ' and ' + str(prend))
-            itemsPerPage = int(productsJson['itemsPerPage'])
-
-            if numProducts > 10000:
-                print('too many results (max 10000 allowed), please narrow down your search')
-                return (['too many results'])
+    def retrieveProductsFeatures(self, requestsbasestring):
+        'get the features of all the pages of the product requests, None if a request has too many results'
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # first page of each request, this one also gives the amount of pages
+            first_pages = list(executor.map(self._get_json, [item + '&startIndex=1' for item in requestsbasestring]))
+            features_requests = []
+            requests_next_pages = []
+            for r in range(len(requestsbasestring)):
+                numProducts = first_pages[r]['totalResults']
+                print(str(numProducts) + ' products found for ' + requestsbasestring[r])
+                if numProducts > 10000:
+                    print('too many results (max 10000 allowed), please narrow down your search')
+                    features_requests.append(None)
+                    continue
+                features_requests.append([first_pages[r]['features']])
+                if numProducts == 0:
+                    continue
+                itemsPerPage = int(first_pages[r]['itemsPerPage'])
+                for ind in range(1, -(-numProducts // itemsPerPage)):
+                    startindex = ind * itemsPerPage + 1
+                    requests_next_pages.append((r, requestsbasestring[r] + '&startIndex=' + str(startindex)))
+            # the other pages of all requests together
+            next_pages = executor.map(self._get_json, [item[1] for item in requests_next_pages])
+            for (r, _), productsJson in zip(requests_next_pages, next_pages):
+                features_requests[r].append(productsJson['features'])
+        return [None if item is None else [f for page in item for f in page] for item in features_requests]
+
+    @staticmethod
+    def metadataProducts(features):
+        'split the relative orbits of the products per orbit pass with the date of the product as key'
+        dict_metadata_ascending = dict()
+        dict_metadata_descending = dict()
+        for f in features:
+            productdetail = {}
+            # productdetail['productID'] = f['id']
+            # productdetail['bbox'] = f['bbox']
+            productdetail['productDate'] = f['properties']['date'].rsplit('T')[0] # only take the rounded data wihtout info on hours
+
+            #productdetail['productPublishedDate'] = f['properties']['published']
+            productdetail['productTitle'] = f['properties']['title']
+            productdetail['relativeOrbit'] = \
+            f['properties']['acquisitionInformation'][1]['acquisitionParameters']['relativeOrbitNumber']
+            #productdetail['productType'] = f['properties']['productInformation']['productType']
+
+            # if 'S2' in f['id']:
+            #     productdetail['cloudcover'] = f['properties']['productInformation']['cloudCover']
+            #     productdetail['tileID'] = f['properties']['acquisitionInformation'][1]['acquisitionParameters'][
+            #         'tileId']
+            # else:
+            #     productdetail['cloudcover'] = ''
+            #     productdetail['tileID'] = ''
+
+            # filelist = []
+            # linkkeys = f['properties']['links'].keys()
+            #
+            # for l in linkkeys:
+            #     for fil in f['properties']['links'][l]:
+            #         filedetails = {}
+            #         filedetails['filetype'] = l
+            #
+            #         if onTerrascope:
+            #             filedetails['filepath'] = fil['href'][7:]
+            #         else:
+            #             filedetails['filepath'] = fil['href']
+            #
+            #         if l == 'previews':
+            #             filedetails['category'] = fil['category']
+            #             filedetails['title'] = fil['category']
+            #
+            #         if (l == 'alternates') | (l == 'data'):
+            #             filedetails['category'] = fil['title']
+            #             filedetails['title'] = fil['title']
+            #
+            #         if l == 'related':
+            #             filedetails['category'] = fil['category']
+            #             filedetails['title'] = fil['title']
+            #         filedetails['length'] = fil['length']
+            #         filelist.append(filedetails)
+            #
+            # productdetail['files'] = filelist
+            if 'DESCENDING' in productdetail['productTitle']:
+                dict_metadata_descending.update({productdetail['productDate']:  productdetail['relativeOrbit'] })
             else:
-                if numProducts > 0:
-                    for ind in range(int(numProducts / itemsPerPage) + 1):
-                        startindex = ind * itemsPerPage + 1
-                        products = requests.get(requestbasestring + '&startIndex=' + str(startindex))
-                        productsJson = products.json()
-                        features = productsJson['features']
-
-                        for f in features:
-                            productdetail = {}
-                            # productdetail['productID'] = f['id']
-                            # productdetail['bbox'] = f['bbox']
-                            productdetail['productDate'] = f['properties']['date'].rsplit('T')[0] # only take the rounded data wihtout info on hours
-
-                            #productdetail['productPublishedDate'] = f['properties']['published']
-                            productdetail['productTitle'] = f['properties']['title']
-                            productdetail['relativeOrbit'] = \
-                            f['properties']['acquisitionInformation'][1]['acquisitionParameters']['relativeOrbitNumber']
-                            #productdetail['productType'] = f['properties']['productInformation']['productType']
-
-                            # if 'S2' in f['id']:
-                            #     productdetail['cloudcover'] = f['properties']['productInformation']['cloudCover']
-                            #     productdetail['tileID'] = f['properties']['acquisitionInformation'][1]['acquisitionParameters'][
-                            #         'tileId']
-                            # else:
-                            #     productdetail['cloudcover'] = ''
-                            #     productdetail['tileID'] = ''
-
-                            # filelist = []
-                            # linkkeys = f['properties']['links'].keys()
-                            #
-                            # for l in linkkeys:
-                            #     for fil in f['properties']['links'][l]:
-                            #         filedetails = {}
-                            #         filedetails['filetype'] = l
-                            #
-                            #         if onTerrascope:
-                            #             filedetails['filepath'] = fil['href'][7:]
-                            #         else:
-                            #             filedetails['filepath'] = fil['href']
-                            #
-                            #         if l == 'previews':
-                            #             filedetails['category'] = fil['category']
-                            #             filedetails['title'] = fil['category']
-                            #
-                            #         if (l == 'alternates') | (l == 'data'):
-                            #             filedetails['category'] = fil['title']
-                            #             filedetails['title'] = fil['title']
-                            #
-                            #         if l == 'related':
-                            #             filedetails['category'] = fil['category']
-                            #             filedetails['title'] = fil['title']
-                            #         filedetails['length'] = fil['length']
-                            #         filelist.append(filedetails)
-                            #
-                            # productdetail['files'] = filelist
-                            productsList.append(productdetail)
-                            if 'DESCENDING' in productdetail['productTitle']:
-                                dict_metadata_descending.update({productdetail['productDate']:  productdetail['relativeOrbit'] })
-                            else:
-                                dict_metadata_ascending.update({productdetail['productDate']:  productdetail['relativeOrbit'] })
-                    return dict_metadata_descending, dict_metadata_ascending
-
-        # URL catalogue
-        esOpsURL='https://services.terrascope.be/catalogue/' #ops environment
-        collectionInformation=self.getCollectionParameters(esOpsURL,printURL=True)
+                dict_metadata_ascending.update({productdetail['productDate']:  productdetail['relativeOrbit'] })
+        return dict_metadata_descending, dict_metadata_ascending
+
+    def findProducts(self, urn, ElasticSearchURL, **kwargs):
+        'RO metadata (descending, ascending) of the products of a single request'
+        features = self.retrieveProductsFeatures([self.getRequestProducts(urn, ElasticSearchURL, **kwargs)])[0]
+        if features is None:
+            return (['too many results'])
+        return self.metadataProducts(features)
+
+    def getS1ProductType(self):
+        collectionInformation=self.getCollectionParameters(self.ElasticSearchURL,printURL=True)
 
         S1_SIGMA_list = []
         for f in collectionInformation:
             if 'S1_GRD_SIGMA' in f['id']:
                S1_SIGMA_list.append(f['id'])
+        return S1_SIGMA_list[0]
 
+    def OpenSearch_metadata_retrieval_fields(self, start, end, geos):
+        'retrieve the RO metadata of several fields at once, returns per field the descending and ascending RO metadata'
         #### some parameters to define for retrieving metadata from the S1 SIGMA catalogue
-        producttype   = S1_SIGMA_list[0]
+        producttype   = self.getS1ProductType()
         startdate     = datetime.datetime.strptime(start,'%Y-%m-%d').date()
         enddate       = datetime.datetime.strptime(end,'%Y-%m-%d').date()
 
-        minx, miny, maxx, maxy = coord_to_bbox(geo)
-        # latitudemin   = -90
-        # latitudemax   = 90
-        # longitudemin  = -180
-        # longitudemax  = 180
-        dict_metadata_descending, dict_metadata_ascending = \
-            findProducts(ElasticSearchURL= esOpsURL,urn=producttype,
-                               start = startdate,
-                               end   = enddate,
-                               latmin=miny, latmax=maxy, lonmin=minx, lonmax=maxx)
-        return dict_metadata_descending, dict_metadata_ascending
+        def request_bbox(minx, miny, maxx, maxy):
+            return self.getRequestProducts(ElasticSearchURL=self.ElasticSearchURL, urn=producttype,
+                                           start=startdate, end=enddate,
+                                           latmin=miny, latmax=maxy, lonmin=minx, lonmax=maxx)
+
+        bboxes = [coord_to_bbox(geo) for geo in geos]
+        if self.cluster_size is None:
+            clusters = [[b] for b in range(len(bboxes))]
+        else:
+            clusters = cluster_bboxes_grid(bboxes, self.cluster_size)
+        # one request for the combined bbox of the fields in a cluster
+        bboxes_clusters = [(min(bboxes[b][0] for b in cluster), min(bboxes[b][1] for b in cluster),
+                            max(bboxes[b][2] for b in cluster), max(bboxes[b][3] for b in cluster)) for cluster in clusters]
+        features_clusters = self.retrieveProductsFeatures([request_bbox(*item) for item in bboxes_clusters])
+        print('{} CATALOGUE REQUESTS FOR {} FIELDS'.format(len(clusters), len(geos)))
+        if self._cache is not None:
+            print('CATALOGUE CACHE: {}'.format(self._cache.stats()))
+
+        features_fields = [None] * len(geos)
+        clusters_too_many = []
+        for c in range(len(clusters)):
+            if features_clusters[c] is None:
+                clusters_too_many.append(c)
+            elif len(clusters[c]) == 1:
+                features_fields[clusters[c][0]] = features_clusters[c]
+            else:
+                # assign the products back to the fields based on their footprint
+                for b, features in zip(clusters[c], products_intersecting_bboxes(features_clusters[c], [bboxes[b] for b in clusters[c]])):
+                    features_fields[b] = features
+        # clusters with too many products are requested again per field
+        fields_too_many = [b for c in clusters_too_many if len(clusters[c]) > 1 for b in clusters[c]]
+        if fields_too_many:
+            for b, features in zip(fields_too_many, self.retrieveProductsFeatures([request_bbox(*bboxes[b]) for b in fields_too_many])):
+                features_fields[b] = features
+        return [(['too many results']) if item is None else self.metadataProducts(item) for item in features_fields]
+
+    def OpenSearch_metadata_retrieval(self, start, end, geo):
+        return self.OpenSearch_metadata_retrieval_fields(start, end, [geo])[0]
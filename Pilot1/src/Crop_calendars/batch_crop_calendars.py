@@ -0,0 +1,158 @@
+# Command line entry point to determine the crop calendars of many field files (e.g. the
+# fields per municipality). The inputs are geojson files, directories with geojson files
+# or manifests (text files with a geojson path per line). At most --workers files are
+# processed together, each in chunks (see Cropcalendars.generate_cropcalendars_chunked)
+# with a checkpoint per file in the output directory, so that a run which was interrupted
+# continues with the chunks that are not finished yet when it is started again.
+# usage: python batch_crop_calendars.py inputs [inputs ...] --outdir DIR --start 2020-01-01 --end 2020-10-31
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from Crop_calendars.Crop_calendars_openeo_integration import ChunksFailedException, Cropcalendars
+from Crop_calendars.Terrascope_catalogue_retrieval import OpenSearch
+from Crop_calendars.result_writers import WRITERS, check_writer_class
+
+METRICS_ORDER = ['sigma_ascending_VH', 'sigma_ascending_VV', 'sigma_ascending_angle', 'sigma_descending_VH', 'sigma_descending_VV',
+                 'sigma_descending_angle', 'fAPAR']
+# the extension of the output files per output format
+OUTPUT_EXTENSIONS = {output_format: extensions[0] for output_format, (_, extensions) in WRITERS.items()}
+
+# function to get the geojson files of the inputs (files, directories or manifests)
+def collect_inputs(inputs):
+    gjson_paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            gjson_paths.extend(sorted(glob.glob(os.path.join(item, '*.geojson')) + glob.glob(os.path.join(item, '*.json'))))
+        elif item.endswith('.geojson') or item.endswith('.json'):
+            gjson_paths.append(item)
+        else:
+            # manifest, relative paths are relative to the manifest
+            with open(item, 'r') as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        gjson_paths.append(os.path.join(os.path.dirname(os.path.abspath(item)), line))
+    # the same file is processed once
+    return list(dict.fromkeys(os.path.abspath(path) for path in gjson_paths))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Determine the crop calendars of the fields of several geojson files')
+    parser.add_argument('inputs', nargs='+', help='geojson files, directories with geojson files or manifests with a geojson path per line')
+    parser.add_argument('--outdir', required=True, help='directory for the output files and the checkpoints')
+    parser.add_argument('--start', required=True, help='start of the time range (YYYY-MM-DD)')
+    parser.add_argument('--end', required=True, help='end of the time range (YYYY-MM-DD)')
+    parser.add_argument('--workers', type=int, default=2, help='amount of files processed together')
+    parser.add_argument('--output-format', default='geojson', choices=list(OUTPUT_EXTENSIONS),
+                        help='format of the output files, the crop calendar dates are a date column in parquet and flatgeobuf')
+    parser.add_argument('--chunk-size', type=int, default=500, help='amount of fields per chunk (openEO jobs)')
+    parser.add_argument('--max-jobs-in-flight', type=int, default=2, help='amount of chunks processed together per file')
+    parser.add_argument('--model', default=r'/data/users/Public/bontek/e_shape/model/model_update1.0_iteration24.h5',
+                        help='NN model (.h5, or .npz with --NN-model-backend numpy)')
+    parser.add_argument('--NN-model-backend', default='keras', choices=['keras', 'numpy'])
+    parser.add_argument('--single-pass', action='store_true', help='compute the time series once for the RO selection and the UDF')
+    parser.add_argument('--udf-transport', default='json', choices=['json', 'npy'])
+    parser.add_argument('--cropsar-backend', default='cropsar', choices=['cropsar', 'stub'], help='stub runs the UDF without cropsar (offline tests)')
+    parser.add_argument('--cropsar-chunk-size', type=int, default=None, help='amount of fields per cropsar run in the UDF')
+    parser.add_argument('--result-cache-dir', default=None, help='cache of the result per field, fields processed before are skipped')
+    parser.add_argument('--catalogue-cache-dir', default=None, help='cache of the catalogue responses')
+    parser.add_argument('--metrics', action='store_true', help='add the metrics of the pipeline and the UDF stages to the summary')
+    parser.add_argument('--window-values', type=int, default=5)
+    parser.add_argument('--thr-detection', type=float, default=0.75)
+    parser.add_argument('--index-window-above-thr', type=int, default=2)
+    parser.add_argument('--crop-calendar-event', default='Harvest')
+    parser.add_argument('--metrics-crop-event', nargs='+', default=['cropSAR', 'VH_VV_{}'])
+    return parser.parse_args(argv)
+
+# the name of the output and checkpoint file of an input file in the output directory
+def output_name(gjson_path):
+    return os.path.splitext(os.path.basename(gjson_path))[0]
+
+# function to process one input file, returns the amount of fields written and the processing time
+def process_file(generator, gjson_path, args):
+    name = output_name(gjson_path)
+    out_path = os.path.join(args.outdir, '{}_cropcalendars{}'.format(name, OUTPUT_EXTENSIONS[args.output_format]))
+    # the checkpoint belongs to the output file, so that another output format has its own checkpoint
+    checkpoint_path = out_path + '.checkpoint.json'
+    start_file = time.time()
+    amount_fields = generator.generate_cropcalendars_chunked(args.start, args.end, gjson_path, out_path, args.window_values, args.thr_detection,
+                                                             args.crop_calendar_event, args.metrics_crop_event, args.index_window_above_thr,
+                                                             chunk_size=args.chunk_size, max_jobs_in_flight=args.max_jobs_in_flight,
+                                                             checkpoint_path=checkpoint_path, output_format=args.output_format)
+    return amount_fields, time.time() - start_file
+
+def main(argv=None, connection=None, open_search=None):
+    args = parse_args(argv)
+    gjson_paths = collect_inputs(args.inputs)
+    # input files with the same name would write to the same output and checkpoint
+    paths_names = dict()
+    for gjson_path in gjson_paths:
+        paths_names.setdefault(output_name(gjson_path), []).append(gjson_path)
+    duplicates = [paths for paths in paths_names.values() if len(paths) > 1]
+    if duplicates:
+        for paths in duplicates:
+            print('INPUT FILES WITH THE SAME NAME: {}'.format(', '.join(paths)))
+        print('RENAME THE INPUT FILES OR PROCESS THEM WITH ANOTHER --outdir')
+        return 2
+    # the dependencies of the output format are checked before the processing
+    try:
+        check_writer_class(WRITERS[args.output_format][0])
+    except ValueError as e:
+        print('OUTPUT FORMAT {} NOT SUPPORTED: {}'.format(args.output_format, e))
+        return 2
+    os.makedirs(args.outdir, exist_ok=True)
+    if open_search is None:
+        open_search = OpenSearch(cache_dir=args.catalogue_cache_dir)
+    generator = Cropcalendars(fAPAR_rescale_Openeo=0.005, coherence_rescale_Openeo=0.004, path_harvest_model=args.model,
+                              VH_VV_range_normalization=[-13, -3.5], fAPAR_range_normalization=[0, 1], metrics_order=METRICS_ORDER,
+                              connection=connection, NN_model_backend=args.NN_model_backend, open_search=open_search,
+                              single_pass=args.single_pass, udf_transport=args.udf_transport, cropsar_chunk_size=args.cropsar_chunk_size,
+                              cropsar_backend=args.cropsar_backend, result_cache_dir=args.result_cache_dir,
+                              udf_metrics=args.metrics, print_metrics=False)
+
+    print('{} INPUT FILES, {} WORKERS'.format(len(gjson_paths), args.workers))
+    start_run = time.time()
+    files_failed = []
+    amount_fields = 0
+    chunks_failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(process_file, generator, gjson_path, args): gjson_path for gjson_path in gjson_paths}
+        for future in futures:
+            try:
+                amount_fields_file, time_file = future.result()
+                amount_fields += amount_fields_file
+                print('FINISHED {}: {} FIELDS IN {:.1f} s'.format(futures[future], amount_fields_file, time_file))
+            except ChunksFailedException as e:
+                # the fields of the other chunks are written, the failed chunks are processed in the next run
+                files_failed.append(futures[future])
+                amount_fields += e.amount_features
+                chunks_failed += e.chunks_failed
+                print('PROCESSING OF {} INCOMPLETE: {}'.format(futures[future], e))
+            except Exception as e:
+                files_failed.append(futures[future])
+                print('PROCESSING OF {} FAILED: {}'.format(futures[future], e))
+
+    #### THROUGHPUT SUMMARY
+    time_run = time.time() - start_run
+    metrics = generator.metrics.to_dict()
+    # the fields of the files which were already processed are not part of the throughput
+    fields_skipped = metrics['counters'].get('fields_skipped', 0)
+    summary = {'files': len(gjson_paths), 'files_failed': len(files_failed), 'chunks_failed': chunks_failed, 'fields': amount_fields,
+               'fields_skipped': fields_skipped, 'fields_processed': metrics['counters'].get('fields_processed', 0), 'time_s': time_run,
+               'fields_per_s': (amount_fields - fields_skipped) / time_run if time_run > 0 else None,
+               'openeo_jobs': metrics['counters'].get('openeo_jobs', 0),
+               'result_cache': None if generator._result_cache is None else generator._result_cache.stats(),
+               'catalogue_cache': open_search.cacheStats() if hasattr(open_search, 'cacheStats') else None}
+    if args.metrics:
+        # the metrics of all files, printed once at the end of the run
+        summary['metrics'] = metrics
+    print('THROUGHPUT SUMMARY: {}'.format(json.dumps(summary)))
+    return 1 if files_failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
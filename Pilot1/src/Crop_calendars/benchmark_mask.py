@@ -0,0 +1,70 @@
+# Validation and benchmark of the mask of create_mask with the NumPy reference
+# (create_mask_numpy) on synthetic scene classification rasters: the direct 2D kernels
+# as used before, the separable kernels (as now sent to openEO), the fft convolution and
+# the parcel-aware mode which only processes the windows around the parcels.
+# usage: python benchmark_mask.py [raster size ...]
+
+import sys
+import time
+import numpy as np
+
+from Crop_calendars.create_mask import create_mask_numpy
+
+# function to create a scene classification raster with mostly vegetation/bare soil,
+# some water and unclassified pixels and clouds with their shadow, and a raster
+# with amount_parcels rectangular parcels (of 5 to 20 pixels)
+def synthetic_scl(size, amount_clouds=8, amount_parcels=20, seed=0):
+    rng = np.random.RandomState(seed)
+    scl = rng.choice([4, 5], size=(size, size), p=[0.7, 0.3]).astype(np.uint8)
+    scl[rng.uniform(size=scl.shape) < 0.01] = 7
+    scl[rng.uniform(size=scl.shape) < 0.005] = 6
+    rows, cols = np.mgrid[0:size, 0:size]
+    for _ in range(amount_clouds):
+        row, col, radius = rng.randint(0, size), rng.randint(0, size), rng.randint(3, max(size // 20, 4))
+        cloud = (rows - row) ** 2 + (cols - col) ** 2 < radius ** 2
+        shadow = (rows - row - radius) ** 2 + (cols - col - radius) ** 2 < radius ** 2
+        scl[shadow & ~cloud] = 3
+        scl[cloud] = rng.choice([8, 9, 10])
+    parcels = np.zeros(scl.shape, dtype=np.int32)
+    for p in range(amount_parcels):
+        height, width = rng.randint(5, 21, size=2)
+        row, col = rng.randint(0, size - height), rng.randint(0, size - width)
+        parcels[row:row + height, col:col + width] = p + 1
+    return scl, parcels
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+# function to compare the methods with the first one (the direct 2D kernels): the largest difference
+# after the kernels and the amount of pixels with a different mask (within the parcels
+# for the parcel-aware mode)
+def benchmark(size, methods=('direct', 'separable', 'fft', 'parcels'), seed=0):
+    scl, parcels = synthetic_scl(size, seed=seed)
+    results = dict()
+    for method in methods:
+        if method == 'parcels':
+            results[method] = timed(create_mask_numpy, scl, 'separable', parcels)
+        else:
+            results[method] = timed(create_mask_numpy, scl, method)
+    reference = results[methods[0]][0]
+    in_parcels = parcels > 0
+    report = dict()
+    for method in methods:
+        (convolved_valid, convolved_cloud, mask), time_method = results[method]
+        compare = in_parcels if method == 'parcels' else np.ones(scl.shape, dtype=bool)
+        report[method] = {'time_s': time_method,
+                          'max_diff': max(np.abs(convolved_valid - reference[0])[compare].max(), np.abs(convolved_cloud - reference[1])[compare].max()),
+                          'pixels_different': int((mask != reference[2])[compare].sum()), 'pixels_masked': int(mask[compare].sum())}
+    return report
+
+if __name__ == '__main__':
+    sizes = [int(item) for item in sys.argv[1:]] or [256, 512, 4096]
+    print('{:>6} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('SIZE', 'METHOD', 'TIME (s)', 'MAX DIFF', 'DIFFERENT', 'MASKED'))
+    for size in sizes:
+        # the direct 2D kernels are too slow for large rasters, then the separable kernels are the reference
+        methods = ('direct', 'separable', 'fft', 'parcels') if size <= 1024 else ('separable', 'fft', 'parcels')
+        for method, result in benchmark(size, methods).items():
+            print('{:>6} {:>10} {:>10.3f} {:>10.1e} {:>10} {:>10}'.format(size, method, result['time_s'], result['max_diff'],
+                                                                         result['pixels_different'], result['pixels_masked']))
@@ -0,0 +1,172 @@
+# Offline benchmark of the stages of the crop calendar pipeline, with the replayed openEO
+# backend and the stub catalogue of openeo_replay.py. For a synthetic set of fields it
+# measures the preparation of the geometries, the catalogue requests, the extraction of
+# the time series, the RO selection and the UDF, and the whole of generate_cropcalendars.
+# The numpy model is exported from the .h5 model in the Tests folder (see convert_NN_model.py)
+# and cropsar is replaced by its stub, so only the packages of the UDF are needed.
+# For large amounts of fields only the whole pipeline is timed, in chunks (--chunk-size).
+# The stages are also benchmarked with pytest-benchmark, see Tests/Cropcalendars/test_benchmark_pipeline.py
+# usage: python benchmark_pipeline.py [amount of fields ...] [--chunk-size 500] (from the Crop_calendars folder)
+
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+import geojson
+import numpy as np
+import shapely.geometry
+from openeo.rest.conversions import timeseries_json_to_pandas
+
+from Crop_calendars.Crop_calendars_openeo_integration import Cropcalendars
+from Crop_calendars.RO_selection import RO_angle_table, select_RO_fields
+from Crop_calendars.Terrascope_catalogue_retrieval import OpenSearch
+from Crop_calendars.convert_NN_model import export_NN_model_npz
+from Crop_calendars.job_orchestration import JobOrchestrator
+from Crop_calendars.openeo_replay import ReplayConnection, StubCatalogueServer
+
+PATH_NN_MODEL = Path(__file__).resolve().parents[2] / 'Tests' / 'Cropcalendars' / 'Model' / 'model_update1.0_iteration24.h5'
+METRICS_ORDER = ['sigma_ascending_VH', 'sigma_ascending_VV', 'sigma_ascending_angle', 'sigma_descending_VH', 'sigma_descending_VV',
+                 'sigma_descending_angle', 'fAPAR']
+PARAMETERS_EVENT = dict(window_values=5, thr_detection=0.75, crop_calendar_event='Harvest', metrics_crop_event=['cropSAR', 'VH_VV_{}'],
+                        index_window_above_thr=2)
+
+# function to write a geojson with amount_fields square fields (of about 100 x 100 m)
+# on a regular grid in the north of Belgium
+def synthetic_fields_geojson(amount_fields, gjson_path, size=0.0014, spacing=0.002, x_origin=4.5, y_origin=50.9):
+    amount_columns = int(np.ceil(np.sqrt(amount_fields)))
+    features = []
+    for s in range(amount_fields):
+        x = x_origin + (s % amount_columns) * spacing
+        y = y_origin + (s // amount_columns) * spacing
+        features.append(geojson.Feature(geometry=shapely.geometry.mapping(shapely.geometry.box(x, y, x + size, y + size)), properties={}))
+    with open(gjson_path, 'w') as gjson_file:
+        geojson.dump(geojson.FeatureCollection(features), gjson_file)
+
+# the replayed pipeline for a synthetic set of amount_fields fields, of which the stages of
+# generate_cropcalendars_fields (single pass mode) can be run one by one: each stage runs
+# the stages it needs if they didn't run yet. Used as context manager (stub catalogue)
+class PipelineBenchmark():
+    def __init__(self, amount_fields, workdir, start='2019-01-01', end='2019-12-31', udf_transport='npy', cropsar_backend='stub'):
+        self.amount_fields = amount_fields
+        self.workdir = workdir
+        self.start = start
+        self.end = end
+        self.gjson_path = os.path.join(workdir, 'fields_{}.geojson'.format(amount_fields))
+        if not os.path.exists(self.gjson_path):
+            synthetic_fields_geojson(amount_fields, self.gjson_path)
+        self.path_model = os.path.join(workdir, 'model.npz')
+        if not os.path.exists(self.path_model):
+            export_NN_model_npz(str(PATH_NN_MODEL), self.path_model)
+        self.connection = ReplayConnection()
+        self.catalogue = StubCatalogueServer(self.connection.acquisitions(start, end))
+        self.generator = None
+        self.udf_transport = udf_transport
+        self.cropsar_backend = cropsar_backend
+        self.gj = None
+        self.orbits_fields = None
+        self.timeseries_json = None
+        self.df_RO_selection = None
+
+    def __enter__(self):
+        self.catalogue.__enter__()
+        self.generator = Cropcalendars(fAPAR_rescale_Openeo=0.005, coherence_rescale_Openeo=0.004, path_harvest_model=self.path_model,
+                                       VH_VV_range_normalization=[-13, -3.5], fAPAR_range_normalization=[0, 1], metrics_order=METRICS_ORDER,
+                                       connection=self.connection, NN_model_backend='numpy', open_search=OpenSearch(self.catalogue.url),
+                                       poll_interval=0, single_pass=True, udf_transport=self.udf_transport,
+                                       cropsar_backend=self.cropsar_backend, print_metrics=False)
+        return self
+
+    def __exit__(self, *args):
+        self.catalogue.__exit__(*args)
+
+    def geometry(self):
+        self.gj, self.polygons_inw_buffered, gj_rejected = self.generator.load_geometry(self.gjson_path)
+        return self.gj
+
+    def catalogue_fields(self):
+        if self.gj is None:
+            self.geometry()
+        self.orbits_fields = self.generator._open_search.OpenSearch_metadata_retrieval_fields(self.start, self.end, self.gj.features)
+        return self.orbits_fields
+
+    def timeseries(self):
+        if self.gj is None:
+            self.geometry()
+        geo = shapely.geometry.GeometryCollection([shapely.geometry.shape(feature).buffer(0) for feature in self.polygons_inw_buffered])
+        orchestrator = JobOrchestrator(poll_interval=0)
+        orchestrator.submit('timeseries', self.generator.get_bands().filter_temporal(self.start, self.end).polygonal_mean_timeseries(geo))
+        self.timeseries_json = orchestrator.result('timeseries')
+        return self.timeseries_json
+
+    def RO_selection(self):
+        if self.orbits_fields is None:
+            self.catalogue_fields()
+        if self.timeseries_json is None:
+            self.timeseries()
+        angle_fields = self.generator.get_angle_timeseries(timeseries_json_to_pandas(self.timeseries_json))
+        self.df_RO_selection = select_RO_fields(RO_angle_table(self.orbits_fields, angle_fields, ['ASCENDING', 'DESCENDING']))
+        return self.df_RO_selection
+
+    def udf(self):
+        if self.df_RO_selection is None:
+            self.RO_selection()
+        unique_ids_fields = [str(s) for s in range(len(self.gj.features))]
+        context_to_udf = self.generator.get_udf_context(df_RO_selection=self.df_RO_selection, unique_ids_fields=unique_ids_fields,
+                                                        **PARAMETERS_EVENT)
+        orchestrator = JobOrchestrator(poll_interval=0)
+        self.generator.submit_udf_timeseries(orchestrator, 'udf', self.timeseries_json, context_to_udf)
+        crop_calendars = orchestrator.result('udf')
+        assert len(crop_calendars['Harvest_date']) == len(self.gj.features)
+        return crop_calendars
+
+    # the whole of generate_cropcalendars, with a chunk_size the fields are processed in
+    # chunks with generate_cropcalendars_chunked (the memory use doesn't depend on the
+    # amount of fields), returns the amount of fields of the result
+    def total(self, chunk_size=None, max_jobs_in_flight=2):
+        if chunk_size is None:
+            return len(self.generator.generate_cropcalendars(self.start, self.end, self.gjson_path, **PARAMETERS_EVENT).features)
+        out_path = os.path.join(self.workdir, 'cropcalendars_{}.geojson'.format(self.amount_fields))
+        return self.generator.generate_cropcalendars_chunked(self.start, self.end, self.gjson_path, out_path, chunk_size=chunk_size,
+                                                             max_jobs_in_flight=max_jobs_in_flight, **PARAMETERS_EVENT)
+
+STAGES = ['geometry', 'catalogue_fields', 'timeseries', 'RO_selection', 'udf', 'total']
+
+def timed(stages, name, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    stages[name] = time.perf_counter() - start
+    return result
+
+# function to time the stages (or with a chunk_size only the chunked total) for amount_fields fields
+def benchmark(amount_fields, workdir, chunk_size=None, **kwargs):
+    stages = dict()
+    with PipelineBenchmark(amount_fields, workdir, **kwargs) as pipeline:
+        if chunk_size is None:
+            for name in STAGES[:-1]:
+                timed(stages, name, getattr(pipeline, name))
+        amount_result = timed(stages, 'total', pipeline.total, chunk_size)
+        stages['catalogue_requests'] = pipeline.catalogue.stats['requests']
+    assert amount_result == amount_fields
+    return stages
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the stages of the crop calendar pipeline (replayed backend)')
+    parser.add_argument('amounts_fields', nargs='*', type=int, default=[10, 1000])
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='only time the whole pipeline, with generate_cropcalendars_chunked (e.g. for 100000 fields)')
+    args = parser.parse_args()
+    # the UDF is read from the Crop_calendars folder
+    os.chdir(Path(__file__).resolve().parent)
+    names_stages = STAGES if args.chunk_size is None else ['total']
+    print('{:>8} '.format('FIELDS') + ' '.join('{:>16}'.format(name) for name in names_stages) + ' {:>9} {:>12}'.format('REQUESTS', 'FIELDS/S'))
+    with tempfile.TemporaryDirectory() as workdir:
+        for amount_fields in args.amounts_fields:
+            # the prints of the pipeline itself are not shown
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                stages = benchmark(amount_fields, workdir, args.chunk_size)
+            print('{:>8} '.format(amount_fields) + ' '.join('{:>16.3f}'.format(stages[name]) for name in names_stages) +
+                  ' {:>9} {:>12.1f}'.format(stages['catalogue_requests'], amount_fields / stages['total']))
+            sys.stdout.flush()
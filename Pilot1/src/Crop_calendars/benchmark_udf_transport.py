@@ -0,0 +1,82 @@
+# Benchmark of the transport of the UDF context and time series: the nested json
+# dicts versus the compact arrays of udf_transport.py. For a synthetic set of fields
+# it measures the size of the json which is sent to the backend and the time to
+# encode it, to parse it and to convert it to the dataframe/context used in the UDF.
+# usage: python benchmark_udf_transport.py [amount of fields ...]
+
+import json
+import sys
+import time
+import uuid
+import numpy as np
+import pandas as pd
+from openeo.rest.conversions import timeseries_json_to_pandas
+
+from Crop_calendars.RO_selection import RO_selection_to_dicts
+from Crop_calendars.crop_calendar_udf import decode_context_fields, timeseries_npy_to_pandas
+from Crop_calendars.udf_transport import encode_context_fields, encode_timeseries
+
+# function to create a time series json (as returned by polygonal_mean_timeseries)
+# and a RO selection table for the given amount of fields
+def synthetic_fields(amount_fields, amount_dates=120, amount_bands=7, seed=0):
+    rng = np.random.RandomState(seed)
+    dates = pd.date_range('2019-01-01', periods=amount_dates, freq='3D')
+    values = rng.uniform(0, 1, size=(amount_dates, amount_fields, amount_bands))
+    values[rng.uniform(size=values.shape) < 0.2] = np.nan
+    timeseries = {date.strftime('%Y-%m-%dT00:00:00Z'): [[None if np.isnan(value) else float(value) for value in field]
+                                                         for field in values[d]] for d, date in enumerate(dates)}
+    unique_ids_fields = [str(uuid.uuid1()) for _ in range(amount_fields)]
+    df_RO_selection = pd.DataFrame({'field': np.tile(np.arange(amount_fields), 2),
+                                    'pass': np.repeat(['ASCENDING', 'DESCENDING'], amount_fields),
+                                    'RO': rng.choice([37, 88, 110, 161], size=2 * amount_fields),
+                                    'first_date': dates[rng.randint(0, 5, size=2 * amount_fields)]})
+    return timeseries, unique_ids_fields, df_RO_selection
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def benchmark(amount_fields):
+    timeseries, unique_ids_fields, df_RO_selection = synthetic_fields(amount_fields)
+    orbit_passes = ['ASCENDING', 'DESCENDING']
+    results = dict()
+
+    # json: nested dicts in the context and per date/field/band values in the time series
+    def encode_json():
+        dict_ascending, dict_descending = RO_selection_to_dicts(df_RO_selection, unique_ids_fields, orbit_passes)
+        return json.dumps({'context': {'RO_ascending_selection_per_field': dict_ascending, 'RO_descending_selection_per_field': dict_descending,
+                                       'unique_ids_fields': unique_ids_fields}, 'data': timeseries})
+    def decode_json(payload):
+        payload = json.loads(payload)
+        return decode_context_fields(payload['context']), timeseries_json_to_pandas(payload['data'])
+
+    # npy: base64 encoded arrays
+    def encode_npy():
+        return json.dumps({'context': {'fields_encoded': encode_context_fields(df_RO_selection, unique_ids_fields, orbit_passes)},
+                           'data': encode_timeseries(timeseries)})
+    def decode_npy(payload):
+        payload = json.loads(payload)
+        return decode_context_fields(payload['context']), timeseries_npy_to_pandas(payload['data'])
+
+    for transport, encode, decode in [('json', encode_json, decode_json), ('npy', encode_npy, decode_npy)]:
+        payload, time_encode = timed(encode)
+        (context, ts_df), time_decode = timed(decode, payload)
+        results[transport] = {'size_MB': len(payload) / 1024 ** 2, 'encode_s': time_encode, 'decode_s': time_decode,
+                              'context': context, 'ts_df': ts_df}
+
+    # both transports should give the same input for the UDF
+    ts_df_json = results['json']['ts_df']
+    ts_df_json.columns = ts_df_json.columns.set_names(['polygon', 'band'])
+    pd.testing.assert_frame_equal(ts_df_json, results['npy']['ts_df'], check_names=False)
+    assert results['json']['context'] == results['npy']['context']
+    return results
+
+if __name__ == '__main__':
+    amounts_fields = [int(item) for item in sys.argv[1:]] or [10, 100, 1000]
+    print('{:>8} {:>6} {:>10} {:>10} {:>10}'.format('FIELDS', 'TYPE', 'SIZE (MB)', 'ENCODE (s)', 'DECODE (s)'))
+    for amount_fields in amounts_fields:
+        results = benchmark(amount_fields)
+        for transport in ['json', 'npy']:
+            print('{:>8} {:>6} {:>10.2f} {:>10.3f} {:>10.3f}'.format(amount_fields, transport, results[transport]['size_MB'],
+                                                                      results[transport]['encode_s'], results[transport]['decode_s']))
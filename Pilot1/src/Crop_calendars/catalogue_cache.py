@@ -0,0 +1,94 @@
+# Persistent cache of the responses of the Terrascope catalogue. The responses are stored
+# in a sqlite database in the cache directory, with as key the request url (which contains
+# the collection, bbox, time window and page). Requests for periods ending before
+# the recent_days limit never expire because the historical acquisitions don't change,
+# the others (and requests without end date) expire after ttl seconds.
+
+import contextlib
+import datetime
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class CatalogueCache:
+
+    def __init__(self, cache_dir, ttl=24 * 3600, recent_days=30, max_size_bytes=512 * 1024 ** 2):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.recent_days = recent_days
+        self.max_size_bytes = max_size_bytes
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, 'catalogue_cache.sqlite')
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value BLOB, created REAL, '
+                         'expires REAL, last_access REAL, size INTEGER)')
+            conn.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # a new connection per operation, so that the cache can be used by several threads.
+        # The transaction is committed (rolled back on an error) and the connection closed
+        with contextlib.closing(sqlite3.connect(self.db_path, timeout=60)) as conn, conn:
+            yield conn
+
+    def _expires(self, url):
+        end = re.search(r'[?&]end=(\d{4}-\d{2}-\d{2})', url)
+        if end is not None:
+            enddate = datetime.datetime.strptime(end.group(1), '%Y-%m-%d').date()
+            if enddate < datetime.date.today() - datetime.timedelta(days=self.recent_days):
+                return None
+        return time.time() + self.ttl
+
+    def get(self, url):
+        with self._connect() as conn:
+            row = conn.execute('SELECT value, expires FROM responses WHERE key = ?', (url,)).fetchone()
+            if row is not None and row[1] is not None and row[1] < time.time():
+                conn.execute('DELETE FROM responses WHERE key = ?', (url,))
+                with self._lock:
+                    self._stats['expired'] += 1
+                row = None
+            if row is None:
+                with self._lock:
+                    self._stats['misses'] += 1
+                return None
+            conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), url))
+        with self._lock:
+            self._stats['hits'] += 1
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def put(self, url, response_json):
+        value = zlib.compress(json.dumps(response_json).encode('utf-8'))
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                         (url, value, now, self._expires(url), now, len(value)))
+            self._evict(conn)
+
+    def _evict(self, conn):
+        # remove the least recently used responses until the cache fits in max_size_bytes
+        size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        while size > self.max_size_bytes:
+            key, size_key = conn.execute('SELECT key, size FROM responses ORDER BY last_access LIMIT 1').fetchone()
+            conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+            size -= size_key
+            self._stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock, self._connect() as conn:
+            conn.execute('DELETE FROM responses')
+
+    def stats(self):
+        with self._connect() as conn:
+            entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({'entries': entries, 'size_bytes': size, 'cache_dir': self.cache_dir})
+        return stats
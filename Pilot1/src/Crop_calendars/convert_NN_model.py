@@ -0,0 +1,72 @@
+# This script exports the weights of a trained (keras .h5) crop calendar NN model
+# to a compact .npz file that can be used by the numpy backend of the udf,
+# so that the udf workers don't need to import tensorflow
+
+import json
+import sys
+import h5py
+import numpy as np
+
+# layers which have no effect when the model is used for prediction
+LAYERS_NO_INFERENCE = ['InputLayer', 'Dropout']
+
+# function to read the configuration of the layers stored in the .h5 model
+def _get_layers_config(model_h5):
+    model_config = model_h5.attrs['model_config']
+    if isinstance(model_config, bytes):
+        model_config = model_config.decode('utf-8')
+    model_config = json.loads(model_config)
+    if model_config['class_name'] != 'Sequential':
+        raise ValueError('Only Sequential models can be exported, got {}'.format(model_config['class_name']))
+    layers_config = model_config['config']
+    # older keras versions store the list of layers directly as config
+    if isinstance(layers_config, dict):
+        layers_config = layers_config['layers']
+    return layers_config
+
+# function to export the weights and activations of
+# the dense layers of the model to a .npz file
+def export_NN_model_npz(NN_model_dir, npz_path):
+    weights_npz = dict()
+    activations = []
+    with h5py.File(NN_model_dir, 'r') as model_h5:
+        model_weights = model_h5['model_weights'] if 'model_weights' in model_h5 else model_h5
+        for layer in _get_layers_config(model_h5):
+            if layer['class_name'] in LAYERS_NO_INFERENCE:
+                continue
+            if layer['class_name'] != 'Dense':
+                raise ValueError('Layer type {} is not supported by the numpy backend'.format(layer['class_name']))
+            layer_weights = model_weights[layer['config']['name']]
+            weight_names = [item.decode('utf-8') if isinstance(item, bytes) else item for item in layer_weights.attrs['weight_names']]
+            kernel = [np.asarray(layer_weights[item]) for item in weight_names if item.rsplit('/')[-1].startswith('kernel')][0]
+            if layer['config'].get('use_bias', True):
+                bias = [np.asarray(layer_weights[item]) for item in weight_names if item.rsplit('/')[-1].startswith('bias')][0]
+            else:
+                bias = np.zeros(kernel.shape[1], dtype=kernel.dtype)
+            weights_npz.update({'kernel_{}'.format(len(activations)): kernel, 'bias_{}'.format(len(activations)): bias})
+            activations.append(layer['config'].get('activation', 'linear'))
+    np.savez(npz_path, activations=np.array(activations), **weights_npz)
+    return npz_path
+
+# function to check if the numpy backend gives the same predictions as the
+# keras (reference) model. Returns the maximum absolute difference
+def check_NN_model_parity(NN_model_dir, npz_path, x_test=None, tolerance=1e-5):
+    #local import, tensorflow and the udf dependencies are only needed for the check
+    from tensorflow.keras.models import load_model
+    from Crop_calendars.crop_calendar_udf import NumpyDenseModel
+
+    keras_model = load_model(NN_model_dir)
+    numpy_model = NumpyDenseModel(npz_path)
+    if x_test is None:
+        # the metrics ingested by the model are rescaled between -1 and 1
+        x_test = np.random.RandomState(0).uniform(-1, 1, (10000, numpy_model.kernels[0].shape[0])).astype(np.float32)
+    max_difference = float(np.max(np.abs(keras_model.predict(x_test) - numpy_model.predict(x_test))))
+    if max_difference > tolerance:
+        raise ValueError('Numpy backend differs {} from the keras model (tolerance {})'.format(max_difference, tolerance))
+    return max_difference
+
+
+if __name__ == '__main__':
+    # usage: python convert_NN_model.py model.h5 model.npz
+    export_NN_model_npz(sys.argv[1], sys.argv[2])
+    print('EXPORTED {} TO {}'.format(sys.argv[1], sys.argv[2]))
@@ -2,29 +2,126 @@ import numpy as np
 import scipy
 from scipy import signal
 
+# the scene classes which are kept (vegetation, not vegetated, water, unclassified)
+# and the cloud (shadow) classes which are removed with a larger buffer
+SCL_CLASSES_VALID = [4, 5, 6, 7]
+SCL_CLASSES_CLOUD = [3, 8, 9, 10]
+KERNEL_SIZE_VALID = 17
+KERNEL_SIZE_CLOUD = 161
+THR_VALID = 0.057
+THR_CLOUD = 0.1
+RESOLUTION_SCL = 20  # m
 
-def create_mask(session):
+
+def makekernel(iwindowsize):
+    kernel_vect = scipy.signal.windows.gaussian(iwindowsize, std=iwindowsize / 3.0, sym=True)
+    kernel = np.outer(kernel_vect, kernel_vect)
+    kernel = kernel / kernel.sum()
+    return kernel
+
+# the normalized 1D gaussian, the kernel of makekernel is its outer product with itself.
+# Convolving the rows and then the columns with it gives the same result as the 2D kernel
+# (also at the borders, which are padded with 0), with 2 x 161 instead of 161² operations per pixel
+def makekernel_1d(iwindowsize):
+    kernel_vect = scipy.signal.windows.gaussian(iwindowsize, std=iwindowsize / 3.0, sym=True)
+    return kernel_vect / kernel_vect.sum()
+
+def apply_kernel_separable(datacube, iwindowsize):
+    kernel_vect = makekernel_1d(iwindowsize)
+    return datacube.apply_kernel(kernel_vect[np.newaxis, :]).apply_kernel(kernel_vect[:, np.newaxis])
+
+# function to get the bbox (west, south, east, north in degrees) of the parcels (shapely geometry
+# in WGS84) buffered with the reach of the largest kernel, the mask within the parcels only
+# depends on the scene classification within this bbox. It is a single bbox around all parcels
+# (a cube has one extent), so unlike the per parcel windows of the NumPy reference the pixels
+# between the parcels are processed as well: the mask within the parcels is the same, but the
+# processed area grows with the spread of the parcels (see create_mask_numpy with per_parcel)
+def parcels_extent(parcels, buffer_m=(KERNEL_SIZE_CLOUD // 2) * RESOLUTION_SCL):
+    west, south, east, north = parcels.bounds
+    buffer_lat = buffer_m / 111320.
+    buffer_lon = buffer_m / (111320. * np.cos(np.radians(max(abs(south), abs(north)))))
+    return west - buffer_lon, south - buffer_lat, east + buffer_lon, north + buffer_lat
+
+
+# with parcels the scene classification is only loaded for the buffered extent of the
+# parcels (a single bbox, see parcels_extent), with separable_kernels the gaussian
+# kernels are applied as two 1D kernels
+def create_mask(session, parcels=None, separable_kernels=True):
     s2_sceneclassification = session.imagecollection("TERRASCOPE_S2_TOC_V2", bands=["SCENECLASSIFICATION_20M"])
+    if parcels is not None:
+        west, south, east, north = parcels_extent(parcels)
+        s2_sceneclassification = s2_sceneclassification.filter_bbox(west=west, south=south, east=east, north=north)
 
     classification = s2_sceneclassification.band('SCENECLASSIFICATION_20M')
 
-    def makekernel(iwindowsize):
-        kernel_vect = scipy.signal.windows.gaussian(iwindowsize, std=iwindowsize / 3.0, sym=True)
-        kernel = np.outer(kernel_vect, kernel_vect)
-        kernel = kernel / kernel.sum()
-        return kernel
+    def apply_gaussian(datacube, iwindowsize):
+        if separable_kernels:
+            return apply_kernel_separable(datacube, iwindowsize)
+        return datacube.apply_kernel(makekernel(iwindowsize))
 
     # in openEO, 1 means mask (remove pixel) 0 means keep pixel
 
     # keep useful pixels, so set to 1 (remove) if smaller than threshold
     first_mask = ~ ((classification == 4) | (classification == 5) | (classification == 6) | (classification == 7))
-    first_mask = first_mask.apply_kernel(makekernel(17)) # make small kernel for buffering around pixels whihc belongs not to the suitable classes
+    first_mask = apply_gaussian(first_mask, KERNEL_SIZE_VALID) # make small kernel for buffering around pixels whihc belongs not to the suitable classes
     # remove pixels smaller than threshold, so pixels with a lot of neighbouring good pixels are retained?
-    first_mask = first_mask > 0.057
+    first_mask = first_mask > THR_VALID
 
     # remove cloud pixels so set to 1 (remove) if larger than threshold
     second_mask = (classification == 3) | (classification == 8) | (classification == 9) | (classification == 10)
-    second_mask = second_mask.apply_kernel(makekernel(161)) # bigger kernel for cloud pixels to remove from a larger area pixels
-    second_mask = second_mask > 0.1
+    second_mask = apply_gaussian(second_mask, KERNEL_SIZE_CLOUD) # bigger kernel for cloud pixels to remove from a larger area pixels
+    second_mask = second_mask > THR_CLOUD
 
     return first_mask | second_mask
+
+
+# function to convolve a raster with the gaussian kernel of makekernel, with the borders
+# padded with 0 as apply_kernel does. method: 'direct' (2D kernel), 'separable' (two
+# 1D kernels) or 'fft' (2D kernel, convolution with the fft)
+def convolve_gaussian_numpy(raster, iwindowsize, method='separable'):
+    #local import, scipy.ndimage is only needed for the local reference
+    from scipy import ndimage
+    raster = raster.astype(np.float64)
+    if method == 'direct':
+        return ndimage.convolve(raster, makekernel(iwindowsize), mode='constant', cval=0.)
+    if method == 'separable':
+        kernel_vect = makekernel_1d(iwindowsize)
+        raster = ndimage.convolve1d(raster, kernel_vect, axis=1, mode='constant', cval=0.)
+        return ndimage.convolve1d(raster, kernel_vect, axis=0, mode='constant', cval=0.)
+    if method == 'fft':
+        return signal.fftconvolve(raster, makekernel(iwindowsize), mode='same')
+    raise ValueError('Unknown convolution method {}'.format(method))
+
+# NumPy reference of create_mask for a scene classification raster (2D array at 20 m),
+# returns the rasters after the gaussian kernels and the mask (True = remove pixel).
+# With parcels (2D array, > 0 in the parcels) only the windows around the parcels are
+# processed: per parcel its bbox extended with the reach of the largest kernel, so
+# that the mask within the parcel bbox is exact, outside these bboxes it is True.
+# With per_parcel False a single window around all parcels is processed, as create_mask
+# does with parcels_extent
+def create_mask_numpy(scl, method='separable', parcels=None, per_parcel=True):
+    if parcels is not None:
+        #local import, scipy.ndimage is only needed for the local reference
+        from scipy import ndimage
+        margin = KERNEL_SIZE_CLOUD // 2
+        mask = np.ones(scl.shape, dtype=bool)
+        convolved_valid = np.full(scl.shape, np.nan)
+        convolved_cloud = np.full(scl.shape, np.nan)
+        labels, _ = ndimage.label(parcels > 0)
+        windows_parcels = ndimage.find_objects(labels)
+        if not per_parcel and windows_parcels:
+            windows_parcels = [(slice(min(rows.start for rows, _ in windows_parcels), max(rows.stop for rows, _ in windows_parcels)),
+                                slice(min(cols.start for _, cols in windows_parcels), max(cols.stop for _, cols in windows_parcels)))]
+        for rows, cols in windows_parcels:
+            rows_ext = slice(max(rows.start - margin, 0), min(rows.stop + margin, scl.shape[0]))
+            cols_ext = slice(max(cols.start - margin, 0), min(cols.stop + margin, scl.shape[1]))
+            window_valid, window_cloud, window_mask = create_mask_numpy(scl[rows_ext, cols_ext], method)
+            window = (slice(rows.start - rows_ext.start, rows.stop - rows_ext.start), slice(cols.start - cols_ext.start, cols.stop - cols_ext.start))
+            convolved_valid[rows, cols] = window_valid[window]
+            convolved_cloud[rows, cols] = window_cloud[window]
+            mask[rows, cols] = window_mask[window]
+        return convolved_valid, convolved_cloud, mask
+
+    convolved_valid = convolve_gaussian_numpy(~np.isin(scl, SCL_CLASSES_VALID), KERNEL_SIZE_VALID, method)
+    convolved_cloud = convolve_gaussian_numpy(np.isin(scl, SCL_CLASSES_CLOUD), KERNEL_SIZE_CLOUD, method)
+    return convolved_valid, convolved_cloud, (convolved_valid > THR_VALID) | (convolved_cloud > THR_CLOUD)
@@ -6,223 +6,703 @@ import pandas as pd
 from openeo.rest.conversions import timeseries_json_to_pandas
 from openeo_udf.api.udf_data import UdfData
 from openeo_udf.api.structured_data import StructuredData
-from cropsar.preprocessing.retrieve_timeseries_openeo import run_cropsar_dataframes
 
 
-from tensorflow.keras.models import load_model
 # import geojson
 # import uuid
 # import json
 
 ######## FUNCTIONS ################
-def get_cropsar_TS(ts_df, unique_ids_fields, metrics_order, fAPAR_rescale_Openeo, Spark = True):
+# stand-in for cropsar with the same in- and output, so that the UDF can be run
+# without cropsar (e.g. to test it offline): the fAPAR of each field (row of df_S2)
+# is linearly interpolated to daily values, the S1 data is not used
+def run_cropsar_stub(df_S2, df_S1_ascending, df_S1_descending):
+    df_fAPAR = df_S2.T
+    df_fAPAR.index = pd.to_datetime(df_fAPAR.index)
+    cropsar_df = df_fAPAR.reindex(pd.date_range(df_fAPAR.index.min(), df_fAPAR.index.max())).interpolate(
+        method='linear', limit_direction='both')
+    cropsar_df.columns = range(cropsar_df.shape[1])
+    return cropsar_df, cropsar_df, cropsar_df
+
+# function to run cropsar (or the stub) on a chunk of fields,
+# returns the cropsar curves of the fields and the processing time
+def run_cropsar_chunk(df_S2, df_S1_ascending, df_S1_descending, cropsar_backend='cropsar'):
+    #local import, file level import has issue in udf inspection
+    import time
+
+    start_chunk = time.time()
+    if cropsar_backend == 'stub':
+        cropsar_df, cropsar_df_q10, cropsar_df_q90 = run_cropsar_stub(df_S2, df_S1_ascending, df_S1_descending)
+    else:
+        #local import, cropsar is not needed for the stub
+        from cropsar.preprocessing.retrieve_timeseries_openeo import run_cropsar_dataframes
+        cropsar_df, cropsar_df_q10, cropsar_df_q90 = run_cropsar_dataframes(df_S2, df_S1_ascending, df_S1_descending)
+    return cropsar_df, time.time() - start_chunk
+
+# function to calculate the cropsar curve of the fields. The fields are processed
+# in chunks of chunk_size fields (all at once if None), so that the memory use
+# of cropsar is limited, and the curves are written in a preallocated array.
+# The columns are sorted on the position of the field, as cropsar returns the
+# curves in the order of its input, a field without time series stays NaN.
+# With max_workers the chunks are processed in a pool of processes, the udf code
+# has to be importable by these processes (which is not the case on the backend)
+def get_cropsar_TS(ts_df, unique_ids_fields, metrics_order, fAPAR_rescale_Openeo, chunk_size = None, max_workers = None, cropsar_backend = 'cropsar'):
+    #local import, file level import has issue in udf inspection
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    ts_df = ts_df.sort_index()
+    # stable sort, the bands of a field stay in their order
+    ts_df = ts_df.iloc[:, np.argsort(np.asarray(ts_df.columns.get_level_values(0).astype(int)), kind='stable')]
+    loc_fields = np.asarray(ts_df.columns.get_level_values(0).astype(int))
+    bands = ts_df.columns.get_level_values(1).astype(str)
     index_fAPAR = metrics_order.index('fAPAR')
-    df_S2 = ts_df.loc[:, ts_df.columns.get_level_values(1).isin([str(index_fAPAR)])].sort_index().T
-    df_S2 *= fAPAR_rescale_Openeo
     index_S1_ascending = metrics_order.index('sigma_ascending_VH')
-    df_S1_ascending = ts_df.loc[:, ts_df.columns.get_level_values(1).isin([str(index_S1_ascending), str(index_S1_ascending+1), str(index_S1_ascending +2)])].sort_index().T
     index_S1_descending = metrics_order.index('sigma_descending_VH')
-    df_S1_descending = ts_df.loc[:, ts_df.columns.get_level_values(1).isin([str(index_S1_descending), str(index_S1_descending+1), str(index_S1_descending +2)])].sort_index().T
-    if Spark:
-        cropsar_df, cropsar_df_q10, cropsar_df_q90 = run_cropsar_dataframes(df_S2, df_S1_ascending, df_S1_descending)
-        cropsar_df = cropsar_df.rename(columns = dict(zip(list(cropsar_df.columns.values), [item+ '_cropSAR' for item in unique_ids_fields])))
-        cropsar_df.index = pd.to_datetime(cropsar_df.index).date
-    return cropsar_df
-# rename the columns to the name of the metric
-# and the id of the field
-def rename_df_columns(df, unique_ids_fields, metrics_order):
-    df.columns.set_levels(unique_ids_fields, level=0, inplace=True)
-    df.columns.set_levels(metrics_order, level=1, inplace=True)
-    df.columns = ['_'.join(col).strip() for col in df.columns.values]
-    return df
+    selection_S2 = np.asarray(bands == str(index_fAPAR))
+    selection_S1_ascending = np.asarray(bands.isin([str(index_S1_ascending), str(index_S1_ascending + 1), str(index_S1_ascending + 2)]))
+    selection_S1_descending = np.asarray(bands.isin([str(index_S1_descending), str(index_S1_descending + 1), str(index_S1_descending + 2)]))
+
+    amount_fields = len(unique_ids_fields)
+    chunk_size = chunk_size or max(amount_fields, 1)
+    chunks = [(start, min(start + chunk_size, amount_fields)) for start in range(0, amount_fields, chunk_size)]
+    fields_chunks = [np.unique(loc_fields[(loc_fields >= start) & (loc_fields < end)]) for start, end in chunks]
+
+    def inputs_chunk(start, end):
+        in_chunk = (loc_fields >= start) & (loc_fields < end)
+        df_S2 = ts_df.loc[:, in_chunk & selection_S2].T * fAPAR_rescale_Openeo
+        return df_S2, ts_df.loc[:, in_chunk & selection_S1_ascending].T, ts_df.loc[:, in_chunk & selection_S1_descending].T
+
+    cropsar_dates = None
+    cropsar_values = None
+    def store_chunk(c, cropsar_chunk, time_chunk):
+        nonlocal cropsar_dates, cropsar_values
+        if cropsar_values is None:
+            # all chunks have the same dates, the output is allocated for all fields on the first chunk
+            cropsar_dates = pd.to_datetime(cropsar_chunk.index).date
+            cropsar_values = np.full((len(cropsar_dates), amount_fields), np.nan)
+        cropsar_chunk.index = pd.to_datetime(cropsar_chunk.index).date
+        cropsar_values[:, fields_chunks[c]] = cropsar_chunk.reindex(cropsar_dates).values
+        print('CROPSAR CHUNK {}/{}: {} FIELDS IN {:.2f} s'.format(c + 1, len(chunks), chunks[c][1] - chunks[c][0], time_chunk))
+
+    if max_workers:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            # at most two chunks per process are prepared at the same time
+            chunks_in_flight = dict()
+            for c, chunk in enumerate(chunks):
+                if len(chunks_in_flight) >= 2 * max_workers:
+                    finished, _ = wait(chunks_in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        store_chunk(chunks_in_flight.pop(future), *future.result())
+                chunks_in_flight[executor.submit(run_cropsar_chunk, *inputs_chunk(*chunk), cropsar_backend)] = c
+            for future in list(chunks_in_flight):
+                store_chunk(chunks_in_flight.pop(future), *future.result())
+    else:
+        for c, chunk in enumerate(chunks):
+            store_chunk(c, *run_cropsar_chunk(*inputs_chunk(*chunk), cropsar_backend))
+
+    return pd.DataFrame(cropsar_values, index=cropsar_dates, columns=[item + '_cropSAR' for item in unique_ids_fields])
+
+# time series of all fields in a (dates x fields x metrics) float64 array.
+# The positions of the fields and metrics are kept in dicts, so that the
+# data of a field or metric is found with an index lookup instead of
+# matching the column names of a wide dataframe. The rescaling is done in
+# float64 (as with the dataframe), the windows are only cast to float32
+# for the NN model (see predict_batched)
+class FieldsTimeSeries():
+    def __init__(self, dates, ids_field, metrics, values):
+        self.dates = np.asarray(dates)
+        self.ids_field = list(ids_field)
+        self.metrics = list(metrics)
+        self.values = values
+        self.loc_fields = {id_field: f for f, id_field in enumerate(self.ids_field)}
+        self.loc_metrics = {metric: m for m, metric in enumerate(self.metrics)}
+
+    # the time series dataframe of openeo has as columns (field index, band index),
+    # the bands are in the order of metrics_order
+    @classmethod
+    def from_timeseries(cls, ts_df, ids_field, metrics_order, dtype=np.float64):
+        loc_fields = ts_df.columns.get_level_values(0).astype(int)
+        loc_bands = ts_df.columns.get_level_values(1).astype(int)
+        values = np.full((ts_df.shape[0], len(ids_field), len(metrics_order)), np.nan, dtype=dtype)
+        values[:, loc_fields, loc_bands] = ts_df.values
+        return cls(ts_df.index, ids_field, metrics_order, values)
+
+    # view (dates x fields) on the values of the metric
+    def metric(self, metric):
+        return self.values[:, :, self.loc_metrics[metric]]
+
+    # function to add metrics after (add_metrics) or in front of (insert_metrics)
+    # the other metrics, values is a (dates x fields x metrics) array
+    def add_metrics(self, metrics, values):
+        self.values = np.concatenate([self.values, values.astype(self.values.dtype)], axis=2)
+        self.metrics.extend(metrics)
+        self.loc_metrics = {metric: m for m, metric in enumerate(self.metrics)}
+        return self
+
+    def insert_metrics(self, metrics, values):
+        self.values = np.concatenate([values.astype(self.values.dtype), self.values], axis=2)
+        self.metrics = list(metrics) + self.metrics
+        self.loc_metrics = {metric: m for m, metric in enumerate(self.metrics)}
+        return self
+
+    # position of the dates in the time series, -1 if not available
+    def get_loc_dates(self, dates):
+        return pd.Index(self.dates).get_indexer(dates)
+
+    # function to put the time series on other dates,
+    # the dates which are not available become nan
+    def reindex_dates(self, dates):
+        loc_dates = self.get_loc_dates(dates)
+        values = np.full((len(dates),) + self.values.shape[1:], np.nan, dtype=self.values.dtype)
+        values[loc_dates >= 0] = self.values[loc_dates[loc_dates >= 0]]
+        return FieldsTimeSeries(dates, self.ids_field, self.metrics, values)
+
+    # the wide dataframe with a '{id field}_{metric}' column per field and
+    # metric. Only needed to inspect the time series, e.g. for debugging
+    def to_dataframe(self):
+        columns = ['{}_{}'.format(id_field, metric) for id_field in self.ids_field for metric in self.metrics]
+        return pd.DataFrame(self.values.reshape(self.values.shape[0], -1), index=self.dates, columns=columns)
 
 # function to calculate the VHVV ratio for the S1 bands
-# + rescale to values between 0 and 1
-def VHVV_calc_rescale(df, ids_field, VH_VV_range):
-    for id in ids_field:
-        for mode in ['ascending', 'descending']:
-            df['{}_VH_VV_{}'.format(id,mode)] = 10 * np.log10(df['{}_sigma_{}_VH'.format(id,mode)] / df['{}_sigma_{}_VV'.format(id,mode)])
-            df['{}_VH_VV_{}'.format(id,mode)] = 2 * (df['{}_VH_VV_{}'.format(id,mode)] - VH_VV_range[0]) / (
-                    VH_VV_range[1] - VH_VV_range[0]) - 1  # rescale
-    return df
-# function to rescale the cropsar fAPAR curve
-def rescale_cropSAR(df, range, ids_field, metric_suffix):
-    df[[item + '_{}'.format(str(metric_suffix)) for item in ids_field]] = 2 * (
-            df[[item + '_{}'.format(str(metric_suffix)) for item in ids_field]] - range[0]) / (range[1] -range[0]) - 1
-    return df
+# + rescale to values between 0 and 1, for all fields at once
+def VHVV_calc_rescale(ts_fields, VH_VV_range):
+    modes = ['ascending', 'descending']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        VH_VV = np.stack([10 * np.log10(ts_fields.metric('sigma_{}_VH'.format(mode)) / ts_fields.metric('sigma_{}_VV'.format(mode)))
+                          for mode in modes], axis=2)
+    VH_VV = 2 * (VH_VV - VH_VV_range[0]) / (VH_VV_range[1] - VH_VV_range[0]) - 1  # rescale
+    return ts_fields.add_metrics(['VH_VV_{}'.format(mode) for mode in modes], VH_VV)
+
+# function to rescale a metric of all fields with the rescaling
+# factor of the metric and convert it to values between -1 and 1
+def rescale_metric(ts_fields, metric, range, rescale_factor=1):
+    values = ts_fields.metric(metric)
+    values[:] = 2 * (values * rescale_factor - range[0]) / (range[1] - range[0]) - 1
+    return ts_fields
+
+# function to prepare the time series (reformatting and rescaling) in the right format
+# to allow the use of the trained NN: the VH/VV ratio, the rescaled fAPAR and in front
+# of the other metrics the rescaled cropsar curve, on the daily dates of the cropsar curve
+def prepare_timeseries(ts_df, ts_df_cropsar, context_param_var):
+    ts_fields = FieldsTimeSeries.from_timeseries(ts_df, context_param_var.get('unique_ids_fields'), context_param_var.get('metrics_order'))
+
+    ts_fields = VHVV_calc_rescale(ts_fields, context_param_var.get('VH_VV_range_normalization'))
+
+    #### rescale the fAPAR to 0 and 1 and convert
+    # it to values between -1 and 1
+    ts_fields = rescale_metric(ts_fields, 'fAPAR', context_param_var.get('fAPAR_range_normalization'), context_param_var.get('fAPAR_rescale_Openeo'))
+
+    #### now merge the cropsar ts with the
+    # time series containing the S1 metrics
+    date_range = pd.date_range(ts_df_cropsar.index[0], ts_df_cropsar.index[-1]).date
+    ts_fields = ts_fields.reindex_dates(date_range)  # need to set the dates on the same frequency
+    values_cropsar = ts_df_cropsar.reindex(date_range)[[item + '_cropSAR' for item in ts_fields.ids_field]].values
+    ts_fields = ts_fields.insert_metrics(['cropSAR'], values_cropsar[:, :, np.newaxis]) # the cropsar metric needs to be the first one to ensure the correct position for applying the NN model
+    # rescale cropsar values
+    return rescale_metric(ts_fields, 'cropSAR', context_param_var.get('fAPAR_range_normalization'))
+
+# function to decode an array which is sent as base64 encoded .npy buffer
+# (see udf_transport.py). The array is a (read-only) view on the decoded bytes
+def decode_array(encoded):
+    #local import, file level import has issue in udf inspection
+    import base64
+    import io
+
+    buffer = base64.b64decode(encoded)
+    header = io.BytesIO(buffer)
+    version = np.lib.format.read_magic(header)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(header)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(header)
+    array = np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)), offset=header.tell())
+    return array.reshape(shape, order='F' if fortran_order else 'C')
+
+# function to convert the encoded time series to the same
+# dataframe as timeseries_json_to_pandas: dates as index and
+# (field index, band index) as columns. The values are not copied
+def timeseries_npy_to_pandas(ts_encoded):
+    dates = decode_array(ts_encoded['dates'])
+    values = decode_array(ts_encoded['values'])
+    columns = pd.MultiIndex.from_product([range(values.shape[1]), range(values.shape[2])], names=['polygon', 'band'])
+    ts_df = pd.DataFrame(values.reshape(values.shape[0], -1), index=pd.Index(dates, name='date'), columns=columns, copy=False)
+    return ts_df
+
+# function to decode the ids of the fields and the selected RO per orbit pass
+# if they are sent as arrays, the context gets the same entries as when
+# they are sent as json dicts
+def decode_context_fields(context):
+    if 'fields_encoded' not in context:
+        return context
+    context = dict(context)
+    fields_encoded = context.pop('fields_encoded')
+    unique_ids_fields = decode_array(fields_encoded['unique_ids_fields']).tolist()
+    context['unique_ids_fields'] = unique_ids_fields
+    for orbit_pass in ['ascending', 'descending']:
+        ROs = decode_array(fields_encoded['RO_{}'.format(orbit_pass)])
+        first_dates = np.datetime_as_string(decode_array(fields_encoded['first_date_{}'.format(orbit_pass)]), unit='D')
+        context['RO_{}_selection_per_field'.format(orbit_pass)] = {unique_ids_fields[f]: {first_dates[f]: int(ROs[f])}
+                                                                   for f in np.flatnonzero(ROs >= 0)}
+    return context
+
+# function to cut a (dates x metrics) or (dates x fields x metrics)
+# array in all the moving windows at once. Each row of the returned
+# matrix contains the window values of the first metric, followed
+# by the window values of the second metric, ... For the array
+# of several fields a matrix of windows is returned per field. The
+# amount of windows is limited to the windows which fit in the dates
+def sliding_windows_metrics(values, window_values, amount_windows):
+    values = np.ascontiguousarray(np.moveaxis(values, 0, -1)) # (fields x) metrics x dates
+    amount_windows = min(max(amount_windows, 0), max(values.shape[-1] - window_values + 1, 0))
+    # strided view ((fields x) metrics x windows x window_values) on
+    # the original data, no copy is made before the final reshape
+    windows = np.lib.stride_tricks.as_strided(values, shape=values.shape[:-1] + (amount_windows, window_values),
+                                              strides=values.strides + (values.strides[-1],), writeable=False)
+    return np.swapaxes(windows, -3, -2).reshape(values.shape[:-2] + (amount_windows, values.shape[-2] * window_values))
 
 # function to create df structure that
-# allows ingestion in NN model
-def prepare_df_NN_model(df, window_values, ids_field, ro_s, metrics_crop_event):
+# allows ingestion in NN model. The windows are created from the
+# first date of the RO until the end of that year, or until end_date
+def prepare_df_NN_model(ts_fields, window_values, ids_field, ro_s, metrics_crop_event, end_date=None):
     #local import, file level import has issue in udf inspection
     from datetime import timedelta
 
     window_width = (window_values - 1) * 6  # days within the window
-    df_harvest_model = []
+    orbit_passes = [r'descending', r'ascending']
     print('{} FIELDS TO COMPILE IN DATASET'.format(len(ids_field)))
-    for id_field in ids_field:
-        ts_descending = pd.date_range('{}'.format(list(ro_s['descending']['{}'.format(id_field)].keys())[0]),
-                                      '{}-12-31'.format(
-                                          list(ro_s['descending']['{}'.format(id_field)].keys())[0].rsplit('-')[0]),
-                                      freq="6D", tz='utc').date
-        ts_ascending = pd.date_range('{}'.format(list(ro_s['ascending']['{}'.format(id_field)].keys())[0]),
-                                     '{}-12-31'.format(
-                                         list(ro_s['ascending']['{}'.format(id_field)].keys())[0].rsplit('-')[0]),
+
+    loc_fields = np.array([ts_fields.loc_fields[id_field] for id_field in ids_field], dtype=int)
+    windows_metrics = []
+    windows_order = [] # per window: position of the field in ids_field * 2 + position of the orbit pass
+    windows_dates = []
+    for p, orbit_pass in enumerate(orbit_passes):
+        # the metrics keep the order in which they are stored in the time series
+        loc_metrics = sorted(ts_fields.loc_metrics[item.format(orbit_pass)] for item in metrics_crop_event
+                             if item.format(orbit_pass) in ts_fields.loc_metrics)
+        # the fields with the same first date of the RO have the same
+        # dates in the time period, their windows are created together
+        fields_first_date = dict()
+        for i, id_field in enumerate(ids_field):
+            fields_first_date.setdefault(list(ro_s[orbit_pass]['{}'.format(id_field)].keys())[0], []).append(i)
+        for first_date, fields in fields_first_date.items():
+            ts_orbit = pd.date_range('{}'.format(first_date), end_date or '{}-12-31'.format(first_date.rsplit('-')[0]),
                                      freq="6D", tz='utc').date
-        ts_orbits = [ts_descending, ts_ascending]
-        orbit_pass = [r'descending', r'ascending']
-        o = 0
-        for ts_orbit in ts_orbits:
-            df_orbit = df.reindex(ts_orbit)
-            metrics_crop_event_orbit_pass = [item.format(orbit_pass[o]) for item in metrics_crop_event]
             # the amount of windows that can be created in the time period
-            moving_window_steps = np.arange(0, df_orbit.shape[
-                0] - window_values - 1)
+            amount_windows = len(ts_orbit) - window_values - 1
             # TODO DEFINE A PERIOD AROUND THE EVENT OF WHICH WINDOWS WILL BE SAMPLED TO AVOID OFF-SEASON EVENT DETECTION
+            if amount_windows <= 0:
+                continue
 
             ### data juggling so that the data of a window is written in a single row
             # and can be interpreted by the model. The amount of columns per row
-            # is determined by the window size and the amount of metrics
-
-            df_id = df_orbit.loc[:, df_orbit.columns.str.contains(id_field)]
-            for p in range(len(moving_window_steps)):
-                df_id_window = pd.DataFrame(df_id.iloc[p:p + window_values, :])
-                # the center date of the window which is in
-                # fact the harvest prediction date if the model returns 1
-                middle_date_window = pd.DataFrame(df_id_window.index[0] + timedelta(window_width / 2),
-                                                  index=[id_field + '_{}'.format(orbit_pass[o])],
-                                                  columns=([
-                                                      'prediction_date_window']))
-                # insert the window data as a row in the dataframe
-                df_id_window = pd.DataFrame(df_id_window.loc[:, df_id_window.columns.isin(
-                    [id_field + '_{}'.format(item) for item in
-                     metrics_crop_event_orbit_pass])].T.values.flatten()).T
-
-                ###### create list of input metrics of window
-                df_id_window = pd.DataFrame(df_id_window)
-                df_id_window.index = [id_field + '_{}'.format(orbit_pass[o])]
-                if df_id_window.isnull().values.all() or df_id_window.isnull().values.all():  # if no data in window => continue .any() no use .all() to allow running
-                    print('NO DATA FOR {} AND IN ORBIT {}'.format(id_field, orbit_pass[o]))
-
-                    continue
-                df_id_window = pd.concat([df_id_window, middle_date_window], axis=1)
-                df_harvest_model.append(df_id_window)
-            o += 1
-
-    df_harvest_model = pd.concat(df_harvest_model, axis=0)
+            # is determined by the window size and the amount of metrics.
+            loc_dates = ts_fields.get_loc_dates(ts_orbit)
+            values_orbit = np.full((len(ts_orbit), len(fields), len(loc_metrics)), np.nan, dtype=ts_fields.values.dtype)
+            values_orbit[loc_dates >= 0] = ts_fields.values[np.ix_(loc_dates[loc_dates >= 0], loc_fields[fields], loc_metrics)]
+            windows_orbit = sliding_windows_metrics(values_orbit, window_values, amount_windows) # fields x windows x values
+
+            # if no data in window => skip it
+            windows_data = ~np.isnan(windows_orbit).all(axis=2)
+            for i in np.flatnonzero(~windows_data.all(axis=1)):
+                print('NO DATA FOR {} AND IN ORBIT {}'.format(ids_field[fields[i]], orbit_pass))
+            windows_metrics.append(windows_orbit[windows_data])
+            windows_order.append(np.repeat(np.asarray(fields) * len(orbit_passes) + p, windows_data.sum(axis=1)))
+            # the center date of the window which is in
+            # fact the harvest prediction date if the model returns 1
+            dates_window = np.array([date + timedelta(window_width / 2) for date in ts_orbit[:amount_windows]], dtype=object)
+            windows_dates.append(np.broadcast_to(dates_window, windows_data.shape)[windows_data])
+
+    # the windows are ordered per field and orbit pass, the
+    # windows of a field and orbit pass stay in order of date
+    windows_order = np.concatenate(windows_order)
+    order = np.argsort(windows_order, kind='stable')
+    windows_index = np.array(['{}_{}'.format(id_field, orbit_pass) for id_field in ids_field for orbit_pass in orbit_passes],
+                             dtype=object)[windows_order[order]]
+    df_harvest_model = pd.DataFrame(np.concatenate(windows_metrics, axis=0)[order], index=windows_index)
+    df_harvest_model['prediction_date_window'] = np.concatenate(windows_dates)[order]
+    # integer keys of the window: the position of the field in ids_field and of the orbit pass in orbit_passes
+    df_harvest_model['loc_field'] = windows_order[order] // len(orbit_passes)
+    df_harvest_model['loc_orbit_pass'] = windows_order[order] % len(orbit_passes)
     df_harvest_model.index.name = 'ID_field'
     return df_harvest_model
 
-# function to run the NN model
-def apply_NN_model_crop_calendars(df, amount_metrics_model, thr_detection, crop_calendar_event, NN_model_dir):
+# function to get the registry with the models that are kept
+# in memory by the worker. The udf code is executed in a new
+# namespace for every call, so the registry is stored as a module
+# in sys.modules to survive between the udf calls of the same process
+def get_model_registry():
+    #local import, file level import has issue in udf inspection
+    import sys
+    import types
+    from collections import OrderedDict
+
+    registry = sys.modules.get('_cropcalendars_model_registry')
+    if registry is None:
+        registry = types.ModuleType('_cropcalendars_model_registry')
+        registry.models = OrderedDict()
+        registry.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'load_time': 0.0}
+        sys.modules['_cropcalendars_model_registry'] = registry
+    return registry
+
+# function to get the hit/miss and load time counters of the model registry
+def get_model_cache_stats():
+    return dict(get_model_registry().stats)
+
+# forward pass of a dense NN model in numpy, using the weights
+# exported to .npz by convert_NN_model.export_NN_model_npz.
+# It has the same predict interface as the keras model so that
+# the workers don't need to import tensorflow
+class NumpyDenseModel():
+    def __init__(self, npz_path):
+        with np.load(npz_path, allow_pickle=False) as model_npz:
+            self.activations = [str(item) for item in model_npz['activations']]
+            self.kernels = [model_npz['kernel_{}'.format(l)] for l in range(len(self.activations))]
+            self.biases = [model_npz['bias_{}'.format(l)] for l in range(len(self.activations))]
+
+    @staticmethod
+    def activation(x, activation):
+        if activation == 'relu':
+            return np.maximum(x, 0)
+        elif activation == 'sigmoid':
+            return 1 / (1 + np.exp(-x))
+        elif activation == 'tanh':
+            return np.tanh(x)
+        elif activation == 'softmax':
+            x = np.exp(x - x.max(axis=-1, keepdims=True))
+            return x / x.sum(axis=-1, keepdims=True)
+        elif activation == 'linear':
+            return x
+        raise ValueError('Activation {} is not supported by the numpy backend'.format(activation))
+
+    def predict(self, x_test, batch_size=None):
+        output = np.asarray(x_test, dtype=np.float32)
+        for kernel, bias, activation in zip(self.kernels, self.biases, self.activations):
+            with np.errstate(over='ignore'):
+                output = self.activation(output @ kernel + bias, activation)
+        return output
+
+# function to load the NN model with the selected backend:
+# 'keras' loads the .h5 model (reference), 'numpy' the exported .npz weights
+def load_NN_model(NN_model_dir, backend='keras'):
+    if backend == 'numpy':
+        return NumpyDenseModel(NN_model_dir)
+    elif backend == 'keras':
+        #local import, tensorflow is only needed for the keras backend
+        from tensorflow.keras.models import load_model
+        return load_model(NN_model_dir)
+    raise ValueError('Unknown NN model backend: {}'.format(backend))
+
+# function to load the NN model, the loaded models are
+# cached per process on their path and modification time
+# and the least recently used model is dropped if the cache is full.
+# A path which doesn't exist is left to the loader, which reports it
+def load_model_cached(NN_model_dir, max_models=4, backend='keras'):
+    #local import, file level import has issue in udf inspection
+    import os
+    import time
+
+    registry = get_model_registry()
+    try:
+        mtime = os.path.getmtime(NN_model_dir)
+    except OSError:
+        mtime = None
+    key = (os.path.abspath(NN_model_dir), mtime, backend)
+    if key in registry.models:
+        registry.stats['hits'] += 1
+        registry.models.move_to_end(key)
+        return registry.models[key]
+    registry.stats['misses'] += 1
+    start_load = time.time()
+    loaded_model = load_NN_model(NN_model_dir, backend)
+    registry.stats['load_time'] += time.time() - start_load
+    registry.models[key] = loaded_model
+    while len(registry.models) > max(max_models, 1):
+        registry.models.popitem(last=False)
+        registry.stats['evictions'] += 1
+    return loaded_model
+
+# function to run the model on fixed size batches of windows,
+# so that the memory use doesn't depend on the amount of windows
+def predict_batched(loaded_model, x_test, batch_size=4096):
+    x_test = np.asarray(x_test, dtype=np.float32)
+    predictions = np.empty((x_test.shape[0], 1), dtype=np.float32)
+    for b in range(0, x_test.shape[0], batch_size):
+        predictions[b:b + batch_size] = np.reshape(loaded_model.predict(x_test[b:b + batch_size], batch_size=batch_size), (-1, 1))
+    return predictions
+
+# function to run the NN model. With previous_probabilities (per window the
+# probability of a previous run, nan if unknown) only the windows without
+# previous probability are predicted
+def apply_NN_model_crop_calendars(df, amount_metrics_model, thr_detection, crop_calendar_event, NN_model_dir, batch_size=4096, max_models_cache=4,
+                                  NN_model_backend='keras', previous_probabilities=None):
     x_test = df.iloc[0:df.shape[0], 0:amount_metrics_model]
     # fill the empty places
     x_test = x_test.fillna(method='ffill')
-    loaded_model = load_model(NN_model_dir)
-    predictions = loaded_model.predict(x_test)
+    if previous_probabilities is None:
+        loaded_model = load_model_cached(NN_model_dir, max_models_cache, NN_model_backend)
+        predictions = predict_batched(loaded_model, x_test, batch_size)
+    else:
+        predictions = np.asarray(previous_probabilities, dtype=np.float32).reshape(-1, 1).copy()
+        windows_predict = np.isnan(predictions[:, 0])
+        print('{} OF {} WINDOWS TO PREDICT'.format(int(windows_predict.sum()), len(windows_predict)))
+        if windows_predict.any():
+            loaded_model = load_model_cached(NN_model_dir, max_models_cache, NN_model_backend)
+            predictions[windows_predict] = predict_batched(loaded_model, x_test[windows_predict], batch_size)
+    df['NN_model_probability_{}'.format(crop_calendar_event)] = predictions[:, 0]
     predictions[predictions >= thr_detection] = 1
     predictions[predictions < thr_detection] = 0
     df['NN_model_detection_{}'.format(crop_calendar_event)] = predictions
     return df
 
-# function to create the crop calendar information for the fields
-
-def create_crop_calendars_fields(df, ids_field, index_window_above_thr):
-    # the dataframe the will store per field the predict crop calendar event
-    df_crop_calendars = []
-    orbit_passes = [r'ascending', r'descending']
-    # here can insert a loop for the different
-    # crop calendar events for that field
-    for id in ids_field:
-        # the dataframe that will temporarily store
-        # the predicted crop calendar event per orbit pass
-        df_crop_calendars_orbit_pass = []
-        df_filtered_id = df[df.index.str.contains(id)]
-        for orbit_pass in orbit_passes:
-            df_filtered_id_pass = df_filtered_id[(df_filtered_id.index.str.contains(orbit_pass)) & (
-                        df_filtered_id['NN_model_detection_Harvest'] == 1)]
-            if not df_filtered_id_pass.shape[0] < index_window_above_thr + 1:
-                df_crop_calendars_orbit_pass.append(pd.DataFrame(data=pd.to_datetime(
-                    df_filtered_id_pass.iloc[index_window_above_thr, :]['prediction_date_window']),
-                                                                 index=['{}'.format(orbit_pass)], columns=[
-                        'prediction_date']))  # select the x-th position for which the threshold was exceeded
-
-        if df_crop_calendars_orbit_pass:
-            df_crop_calendars_orbit_pass = pd.concat(df_crop_calendars_orbit_pass)
-            crop_calendar_date = pd.to_datetime(df_crop_calendars_orbit_pass.prediction_date).mean()
+# function to get per window the probability of the previous run from the windows state
+# (per field, event and orbit pass a list of [prediction date, probability]). The windows
+# that end on or after update_from and the windows of which the probability is not known
+# get nan, they need to be predicted. update_from is a date or a dict with the date per field
+def previous_window_probabilities(df, ids_field, windows_state, crop_calendar_event, window_values, update_from=None):
+    orbit_passes = [r'descending', r'ascending']
+    df_previous = pd.DataFrame([(f, p, date, probability) for f, id_field in enumerate(ids_field) for p, orbit_pass in enumerate(orbit_passes)
+                                for date, probability in windows_state.get(id_field, {}).get(crop_calendar_event, {}).get(orbit_pass, [])],
+                               columns=['loc_field', 'loc_orbit_pass', 'date', 'probability'])
+    dates_window = pd.to_datetime(df['prediction_date_window'])
+    df_windows = pd.DataFrame({'loc_field': df['loc_field'].values, 'loc_orbit_pass': df['loc_orbit_pass'].values,
+                               'date': dates_window.dt.strftime('%Y-%m-%d').values})
+    probabilities = df_windows.merge(df_previous, on=['loc_field', 'loc_orbit_pass', 'date'], how='left')['probability'].values.astype(float)
+    if update_from is not None:
+        # the center date of the window + half of the window width is the end of the window
+        end_window = (dates_window + pd.Timedelta(days=(window_values - 1) * 3)).values
+        if isinstance(update_from, dict):
+            # the fields without date are predicted completely
+            update_from_fields = np.array([update_from.get(id_field, '1900-01-01') for id_field in ids_field], dtype='datetime64[ns]')
+            probabilities[end_window >= update_from_fields[df['loc_field'].values.astype(int)]] = np.nan
         else:
-            crop_calendar_date = pd.to_datetime(np.nan)
+            probabilities[end_window >= np.datetime64(update_from)] = np.nan
+    return probabilities
 
-        ## check if no nan date for the event
-        if not np.isnan(crop_calendar_date.day):
-            crop_calendar_date = crop_calendar_date.strftime('%Y-%m-%d')  # convert to string format
-            df_crop_calendars.append(pd.DataFrame(data=crop_calendar_date, index=[id], columns=['Harvest_date']))
-        else:
-            df_crop_calendars.append(pd.DataFrame(data=np.nan, index=[id], columns=['Harvest_date']))
-    df_crop_calendars = pd.concat(df_crop_calendars)
+# function to get the windows state of the fields: per field
+# and orbit pass the list of [prediction date, probability]
+def windows_state_fields(df, ids_field, crop_calendar_event):
+    orbit_passes = [r'descending', r'ascending']
+    windows_state = {id_field: {orbit_pass: [] for orbit_pass in orbit_passes} for id_field in ids_field}
+    dates = pd.to_datetime(df['prediction_date_window']).dt.strftime('%Y-%m-%d').values
+    for loc_field, loc_orbit_pass, date, probability in zip(df['loc_field'].values, df['loc_orbit_pass'].values, dates,
+                                                             df['NN_model_probability_{}'.format(crop_calendar_event)].values):
+        windows_state[ids_field[loc_field]][orbit_passes[loc_orbit_pass]].append([date, float(probability)])
+    return windows_state
+
+# function to create the crop calendar information for the fields:
+# per field and orbit pass the date of the x-th window (index_window_above_thr)
+# for which the threshold was exceeded, averaged over the orbit passes.
+# The windows are grouped on their integer keys (see prepare_df_NN_model)
+def create_crop_calendars_fields(df, ids_field, index_window_above_thr, crop_calendar_event='Harvest'):
+    df_detections = df.loc[df['NN_model_detection_{}'.format(crop_calendar_event)] == 1, ['loc_field', 'loc_orbit_pass', 'prediction_date_window']]
+    # position of the window within the detections of its field and orbit pass
+    position_detection = df_detections.groupby(['loc_field', 'loc_orbit_pass'], sort=False).cumcount().values
+    df_detections = df_detections[position_detection == index_window_above_thr]
+
+    # average of the dates of the orbit passes per field
+    loc_fields = df_detections['loc_field'].values.astype(int)
+    dates_ns = pd.to_datetime(df_detections['prediction_date_window']).values.astype('datetime64[ns]').astype(np.int64)
+    sum_dates = np.zeros(len(ids_field), dtype=np.int64)
+    np.add.at(sum_dates, loc_fields, dates_ns)
+    amount_dates = np.bincount(loc_fields, minlength=len(ids_field))
+
+    crop_calendar_dates = np.full(len(ids_field), np.nan, dtype=object)
+    has_date = amount_dates > 0
+    crop_calendar_dates[has_date] = pd.to_datetime(sum_dates[has_date] // amount_dates[has_date]).strftime('%Y-%m-%d')  # convert to string format
+    return pd.DataFrame({'{}_date'.format(crop_calendar_event): pd.Series(list(crop_calendar_dates), index=ids_field)})
+
+# function to create the crop calendar information for the fields per season
+# (list of dicts with the name ('season') and 'start' and 'end' date of the season).
+# All events in a season are reported: per field and orbit pass the peaks of the
+# model probability above thr_detection are taken. The peaks of both orbit passes
+# that are less than min_days_between_events apart are the same event, their dates
+# are averaged. Per season a '{event}_dates_{season}' column with the list of dates
+def create_crop_calendars_seasons(df, ids_field, seasons, thr_detection, crop_calendar_event='Harvest', min_days_between_events=30):
+    probabilities = df['NN_model_probability_{}'.format(crop_calendar_event)].values
+    dates = pd.to_datetime(df['prediction_date_window']).values.astype('datetime64[D]')
+    loc_season = np.full(df.shape[0], -1)
+    for s, season in enumerate(seasons):
+        loc_season[(dates >= np.datetime64(season['start'])) & (dates <= np.datetime64(season['end']))] = s
+
+    # the windows are ordered per field and orbit pass on date, a peak is
+    # higher than the previous window and not lower than the next window
+    # of the same field, orbit pass and season
+    keys = np.stack([df['loc_field'].values, df['loc_orbit_pass'].values, loc_season])
+    same_group = np.concatenate([[False], (keys[:, 1:] == keys[:, :-1]).all(axis=0)])
+    probabilities_previous = np.where(same_group, np.roll(probabilities, 1), -np.inf)
+    probabilities_next = np.where(np.append(same_group[1:], False), np.roll(probabilities, -1), -np.inf)
+    peaks = (loc_season >= 0) & (probabilities >= thr_detection) & (probabilities > probabilities_previous) & (probabilities >= probabilities_next)
+
+    # combine the peaks of both orbit passes into events
+    df_peaks = pd.DataFrame({'loc_field': keys[0][peaks], 'loc_season': loc_season[peaks], 'date': dates[peaks].astype(np.int64)})
+    df_peaks = df_peaks.sort_values(['loc_field', 'loc_season', 'date'])
+    new_event = np.ones(df_peaks.shape[0], dtype=bool)
+    new_event[1:] = (np.diff(df_peaks['loc_field'].values) != 0) | (np.diff(df_peaks['loc_season'].values) != 0) | (
+            np.diff(df_peaks['date'].values) > min_days_between_events)
+    df_peaks['event'] = np.cumsum(new_event)
+    df_events = df_peaks.groupby('event').agg(loc_field=('loc_field', 'first'), loc_season=('loc_season', 'first'),
+                                              date_sum=('date', 'sum'), amount_dates=('date', 'size'))
+    df_events['date'] = np.datetime_as_string((df_events['date_sum'].values // df_events['amount_dates'].values).astype('datetime64[D]'))
+
+    df_crop_calendars = pd.DataFrame(index=ids_field)
+    for s, season in enumerate(seasons):
+        dates_fields = df_events[df_events['loc_season'] == s].groupby('loc_field')['date'].apply(list)
+        dates_season = [[] for _ in ids_field]
+        for loc_field, dates_field in dates_fields.items():
+            dates_season[loc_field] = dates_field
+        df_crop_calendars['{}_dates_{}'.format(crop_calendar_event, season['season'])] = pd.Series(dates_season, index=ids_field)
     return df_crop_calendars
 
-def udf_cropcalendars(udf_data:UdfData):
-    context_param_var = udf_data.user_context
-    print(context_param_var)
-    ts_dict = udf_data.get_structured_data_list()[0].data
-    if not ts_dict: #workaround of ts_dict is empty
-        return
-    ts_df = timeseries_json_to_pandas(ts_dict)
-    ts_df.index = pd.to_datetime(ts_df.index).date
+# function to get the settings of the crop calendar events from the context. The
+# list crop_calendar_events has per event its name (crop_calendar_event), model
+# (path_model), window_values, metrics_crop_event, thr_detection and index_window_above_thr.
+# The settings which are not given for the event (or the single event if there
+# is no list) are taken from the entries of the context with the same name
+def get_crop_calendar_events(context):
+    events = context.get('crop_calendar_events') or [{}]
+    settings = ['crop_calendar_event', 'window_values', 'metrics_crop_event', 'thr_detection', 'index_window_above_thr', 'NN_model_backend']
+    return [dict({setting: event.get(setting, context.get(setting)) for setting in settings},
+                 path_model=event.get('path_model', context.get('path_harvest_model'))) for event in events]
 
-    # function to calculate the cropsar curve
-    ts_df_cropsar = get_cropsar_TS(ts_df, context_param_var.get('unique_ids_fields'), context_param_var.get('metrics_order'), context_param_var.get('fAPAR_rescale_Openeo'))
-    # rescale cropsar values
-    ts_df_cropsar = rescale_cropSAR(ts_df_cropsar, context_param_var.get('fAPAR_range_normalization'), context_param_var.get('unique_ids_fields'), 'cropSAR')
+# timers and counters of the stages of the UDF, returned to the driver as part of
+# the result (see PipelineMetrics in pipeline_metrics.py). With profile the stages
+# are also profiled and the top of the cProfile statistics is added per stage
+class UdfMetrics():
+    def __init__(self, profile=False, profile_lines=25):
+        self.profile = profile
+        self.profile_lines = profile_lines
+        self.stages = dict()
+        self.counters = dict()
+        self.profiles = dict()
 
-    # function to rescale the metrics based
-    # on the rescaling factor of the metric
-    def rescale_metrics(df, rescale_factor, fAPAR_range, unique_ids_fields, metric_suffix):
-        df[[item + '_{}'.format(str(metric_suffix)) for item in unique_ids_fields]] = df.loc[:, ts_df.columns.isin(
-            [item + '_{}'.format(str(metric_suffix)) for item in unique_ids_fields])] * rescale_factor
-        df[[item + '_{}'.format(str(metric_suffix)) for item in unique_ids_fields]] = 2 * (
-                df[[item + '_{}'.format(str(metric_suffix)) for item in unique_ids_fields]] - fAPAR_range[0]) / (
-                                                                                              fAPAR_range[1] -
-                                                                                              fAPAR_range[0]) - 1
-        return df
+    def stage(self, name):
+        #local import, file level import has issue in udf inspection
+        from contextlib import contextmanager
+        import time
 
+        @contextmanager
+        def timer():
+            profiler = None
+            if self.profile:
+                import cProfile
+                profiler = cProfile.Profile()
+                try:
+                    profiler.enable()
+                except ValueError:
+                    # another profiler is active (python >= 3.12), the stage is only timed
+                    profiler = None
+                    self.count('profiles_skipped')
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                duration = time.perf_counter() - start
+                stage = self.stages.setdefault(name, {'runs': 0, 'total_s': 0., 'max_s': 0.})
+                stage['runs'] += 1
+                stage['total_s'] += duration
+                stage['max_s'] = max(stage['max_s'], duration)
+                if profiler is not None:
+                    import io
+                    import pstats
+                    profiler.disable()
+                    stream = io.StringIO()
+                    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(self.profile_lines)
+                    self.profiles['{}_{}'.format(name, stage['runs'])] = stream.getvalue()
+        return timer()
 
-    #### USE THE FUNCTIONS TO DETERMINE THE CROP CALENDAR DATES
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + int(amount)
 
-    ### EVENT 1: HARVEST DETECTION
-    NN_model_dir = context_param_var.get('path_harvest_model')
-    amount_metrics_model = len(context_param_var.get('metrics_crop_event')) * context_param_var.get('window_values')
+    def to_dict(self):
+        metrics = {'stages': self.stages, 'counters': self.counters}
+        if self.profile:
+            metrics['profiles'] = self.profiles
+        return metrics
 
-    #### PREPARE THE DATAFRAMES (REFORMATTING AND RESCALING) IN THE
-    # RIGHT FORMAT TO ALLOW THE USE OF THE TRAINED NN
-    ts_df_prepro = rename_df_columns(ts_df, context_param_var.get('unique_ids_fields'), context_param_var.get('metrics_order'))
+def udf_cropcalendars(udf_data:UdfData):
+    metrics = UdfMetrics(profile=bool(udf_data.user_context.get('profile_udf')))
+    with metrics.stage('decode'):
+        context_param_var = decode_context_fields(udf_data.user_context)
+        print(context_param_var)
+        ts_dict = udf_data.get_structured_data_list()[0].data
+        if not ts_dict: #workaround of ts_dict is empty
+            return
+        if ts_dict.get('encoding') == 'npy_base64':
+            # compact columnar time series (see udf_transport.py)
+            ts_df = timeseries_npy_to_pandas(ts_dict)
+        else:
+            ts_df = timeseries_json_to_pandas(ts_dict)
+        ts_df.index = pd.to_datetime(ts_df.index).date
+    metrics.count('fields', len(context_param_var.get('unique_ids_fields')))
+    metrics.count('dates', ts_df.shape[0])
 
-    ts_df_prepro = VHVV_calc_rescale(ts_df_prepro, context_param_var.get('unique_ids_fields'), context_param_var.get('VH_VV_range_normalization'))
+    # function to calculate the cropsar curve
+    with metrics.stage('cropsar'):
+        ts_df_cropsar = get_cropsar_TS(ts_df, context_param_var.get('unique_ids_fields'), context_param_var.get('metrics_order'), context_param_var.get('fAPAR_rescale_Openeo'),
+                                       chunk_size=context_param_var.get('cropsar_chunk_size'), max_workers=context_param_var.get('cropsar_max_workers'),
+                                       cropsar_backend=context_param_var.get('cropsar_backend', 'cropsar'))
 
-    #### rescale the fAPAR to 0 and 1 and convert
-    # it to values between -1 and 1
-    ts_df_prepro = rescale_metrics(ts_df_prepro, context_param_var.get('fAPAR_rescale_Openeo'), context_param_var.get('fAPAR_range_normalization'),
-                                   context_param_var.get('unique_ids_fields'), 'fAPAR')
+    with metrics.stage('prepare_timeseries'):
+        ts_fields = prepare_timeseries(ts_df, ts_df_cropsar, context_param_var)
+        ro_s = {'ascending': context_param_var.get('RO_ascending_selection_per_field'), 'descending': context_param_var.get('RO_descending_selection_per_field')}
 
-    ro_s = {'ascending': context_param_var.get('RO_ascending_selection_per_field'), 'descending': context_param_var.get('RO_descending_selection_per_field')}
+    #### USE THE FUNCTIONS TO DETERMINE THE CROP CALENDAR DATES
+    # the time series are prepared once for all events, the windows once for
+    # the events with the same window size and metrics
+    windows_events = dict()
+    df_crop_calendars_result = []
+    # multi season mode: the windows cover all seasons and all events per season are reported
+    seasons = context_param_var.get('seasons')
+    end_date = max(season['end'] for season in seasons) if seasons else None
+    # incremental mode: the probabilities of the windows of the previous run (see previous_window_probabilities)
+    windows_state = context_param_var.get('windows_state')
+    windows_state_result = dict()
+    for event in get_crop_calendar_events(context_param_var):
+        ### create windows in the time series to extract the metrics
+        # and store each window in a seperate row in the dataframe
+        key_windows = (event['window_values'], tuple(event['metrics_crop_event']))
+        if key_windows not in windows_events:
+            with metrics.stage('windowing'):
+                windows_events[key_windows] = prepare_df_NN_model(ts_fields, event['window_values'], context_param_var.get('unique_ids_fields'), ro_s,
+                                                                  event['metrics_crop_event'], end_date)
+            metrics.count('windows', windows_events[key_windows].shape[0])
+        ts_df_input_NN = windows_events[key_windows]
+        amount_metrics_model = len(event['metrics_crop_event']) * event['window_values']
 
-    #### now merge the cropsar ts file with the other
-    # df containing the S1 metrics
-    date_range = pd.date_range(ts_df_cropsar.index[0], ts_df_cropsar.index[-1]).date
-    ts_df_prepro = ts_df_prepro.reindex(date_range)  # need to set the index axis on the same frequency
-    ts_df_prepro = pd.concat([ts_df_cropsar, ts_df_prepro], axis=1) # the columns of the cropsar df need to be the first ones in the new df to ensure the correct position for applying the NN model
-
-    ### create windows in the time series to extract the metrics
-    # and store each window in a seperate row in the dataframe
-    ts_df_input_NN = prepare_df_NN_model(ts_df_prepro, context_param_var.get('window_values'), context_param_var.get('unique_ids_fields'), ro_s,
-                                         context_param_var.get('metrics_crop_event'))
-
-    ### apply the trained NN model on the window extracts
-    df_NN_prediction = apply_NN_model_crop_calendars(ts_df_input_NN, amount_metrics_model, context_param_var.get('thr_detection'),
-                                                     context_param_var.get('crop_calendar_event'), NN_model_dir)
-    df_crop_calendars_result = create_crop_calendars_fields(df_NN_prediction, context_param_var.get('unique_ids_fields'), context_param_var.get('index_window_above_thr'))
-    print(df_crop_calendars_result)
-    # return the predicted crop calendar events as a dict  (json format)
-    udf_data.set_structured_data_list([StructuredData(description="crop calendar json",data=df_crop_calendars_result.to_dict(),type="dict")])
+        ### apply the trained NN model on the window extracts, in the incremental
+        # mode the probabilities of the windows which didn't change are reused
+        with metrics.stage('inference'):
+            previous_probabilities = None
+            if windows_state is not None:
+                previous_probabilities = previous_window_probabilities(ts_df_input_NN, context_param_var.get('unique_ids_fields'), windows_state,
+                                                                       event['crop_calendar_event'], event['window_values'],
+                                                                       context_param_var.get('windows_update_from'))
+            df_NN_prediction = apply_NN_model_crop_calendars(ts_df_input_NN, amount_metrics_model, event['thr_detection'],
+                                                             event['crop_calendar_event'], event['path_model'],
+                                                             context_param_var.get('predict_batch_size', 4096), context_param_var.get('max_models_cache', 4),
+                                                             event['NN_model_backend'] or 'keras', previous_probabilities)
+        metrics.count('windows_predicted', ts_df_input_NN.shape[0] if previous_probabilities is None else np.isnan(previous_probabilities).sum())
+        if context_param_var.get('return_windows_state'):
+            for id_field, windows_state_field in windows_state_fields(df_NN_prediction, context_param_var.get('unique_ids_fields'),
+                                                                      event['crop_calendar_event']).items():
+                windows_state_result.setdefault(id_field, dict())[event['crop_calendar_event']] = windows_state_field
+        with metrics.stage('crop_calendars'):
+            if seasons:
+                df_crop_calendars_result.append(create_crop_calendars_seasons(df_NN_prediction, context_param_var.get('unique_ids_fields'), seasons,
+                                                                              event['thr_detection'], event['crop_calendar_event'],
+                                                                              context_param_var.get('min_days_between_events', 30)))
+            else:
+                df_crop_calendars_result.append(create_crop_calendars_fields(df_NN_prediction, context_param_var.get('unique_ids_fields'),
+                                                                             event['index_window_above_thr'], event['crop_calendar_event']))
+    print('MODEL CACHE STATS: {}'.format(get_model_cache_stats()))
+    with metrics.stage('merge_results'):
+        df_crop_calendars_result = pd.concat(df_crop_calendars_result, axis=1)
+        print(df_crop_calendars_result)
+        # return the predicted crop calendar events as a dict  (json format)
+        crop_calendars_result = df_crop_calendars_result.to_dict()
+    if context_param_var.get('return_windows_state'):
+        crop_calendars_result['_windows_state'] = windows_state_result
+    if context_param_var.get('return_metrics'):
+        crop_calendars_result['_metrics'] = metrics.to_dict()
+    udf_data.set_structured_data_list([StructuredData(description="crop calendar json",data=crop_calendars_result,type="dict")])
     return udf_data
\ No newline at end of file
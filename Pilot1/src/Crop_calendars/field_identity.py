@@ -0,0 +1,28 @@
+# Content addressed identity of the fields: the id of a field is the hash of its
+# (normalized) geometry, the time range and the parameters which determine the
+# crop calendar result, so that the same field with the same settings always gets
+# the same id (used for the output, the FieldResultCache and the FieldStateStore).
+
+import hashlib
+import json
+
+# function to round the coordinates of a geojson geometry, so that the same
+# geometry written with another precision gets the same hash. The geometries
+# of a GeometryCollection are normalized one by one
+def normalize_geometry(geometry, decimals=7):
+    def round_coordinates(coordinates):
+        if isinstance(coordinates, (list, tuple)):
+            return [round_coordinates(item) for item in coordinates]
+        return round(float(coordinates), decimals)
+    if geometry is None:
+        return None
+    if 'geometries' in geometry:
+        return {'type': geometry['type'], 'geometries': [normalize_geometry(item, decimals) for item in geometry['geometries']]}
+    return {'type': geometry['type'], 'coordinates': round_coordinates(geometry.get('coordinates', []))}
+
+# function to get the content addressed id of a field: the hash of its (normalized)
+# geometry, the time range and the parameters which determine the result (model,
+# thresholds, ...), so that the same field and settings always get the same id
+def field_id(geometry, start, end, parameters):
+    content = {'geometry': normalize_geometry(geometry), 'start': start, 'end': end, 'parameters': parameters}
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
@@ -0,0 +1,56 @@
+# Persistent state of the fields for the incremental update of the crop calendars
+# (see Cropcalendars.generate_cropcalendars_incremental). Per field, with as key its
+# field_id (see field_identity.py), the extracted time series ({date: [per band: value]}), the RO's
+# of the acquisitions from the catalogue, the probabilities of the windows of the NN
+# model and the crop calendar result are stored in a sqlite database, so that an
+# update only needs to process the dates after the last stored date of the field.
+
+import contextlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+# function to create the state of a field which was not processed before
+def new_field_state(start):
+    return {'start': start, 'last_date': None, 'timeseries': dict(), 'orbits': [dict(), dict()], 'windows_state': dict(),
+            'properties': dict()}
+
+
+class FieldStateStore:
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self.db_path = os.path.join(store_dir, 'field_state.sqlite')
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS fields (key TEXT PRIMARY KEY, state BLOB, updated REAL)')
+
+    # the transaction is committed (rolled back on an error) and the connection closed
+    @contextlib.contextmanager
+    def _connect(self):
+        with contextlib.closing(sqlite3.connect(self.db_path, timeout=60)) as conn, conn:
+            yield conn
+
+    # function to get the stored state of the fields, the
+    # fields which are not in the store are not returned
+    def get_many(self, keys, batch_size=500):
+        keys = list(keys)
+        states = dict()
+        with self._connect() as conn:
+            for b in range(0, len(keys), batch_size):
+                batch = keys[b:b + batch_size]
+                rows = conn.execute('SELECT key, state FROM fields WHERE key IN ({})'.format(','.join('?' * len(batch))), batch)
+                states.update({key: json.loads(zlib.decompress(state).decode('utf-8')) for key, state in rows})
+        return states
+
+    def put_many(self, states):
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO fields VALUES (?, ?, ?)',
+                             [(key, zlib.compress(json.dumps(state).encode('utf-8')), now) for key, state in states.items()])
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM fields').fetchone()[0]
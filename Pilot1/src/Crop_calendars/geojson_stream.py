@@ -0,0 +1,141 @@
+# Streaming reading and writing of geojson feature collections, so that
+# large field files can be processed in chunks without loading them in memory
+
+import hashlib
+import json
+import math
+import os
+import geojson
+from shapely.geometry import shape
+
+# function to read the features of a geojson feature collection one by one.
+# Only the features array is decoded, the file is read in blocks of block_size
+def iter_features(gjson_path, block_size=1024 ** 2):
+    decoder = json.JSONDecoder(object_hook=geojson.GeoJSON.to_instance)
+    with open(gjson_path, 'r', encoding='utf8') as f:
+        buffer = ''
+        # go to the start of the features array
+        while True:
+            block = f.read(block_size)
+            if not block:
+                raise ValueError('No features array found in {}'.format(gjson_path))
+            buffer += block
+            start_features = buffer.find('"features"')
+            if start_features < 0:
+                # keep the end of the buffer in case "features" is split over two blocks
+                buffer = buffer[-16:]
+            elif buffer.find('[', start_features) >= 0:
+                buffer = buffer[buffer.find('[', start_features) + 1:]
+                break
+
+        pos = 0
+        end_file = False
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if buffer.startswith(']', pos):
+                return
+            try:
+                if pos >= len(buffer):
+                    raise ValueError('Empty buffer')
+                feature, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # the feature is not yet completely in the buffer
+                if end_file:
+                    raise
+                block = f.read(block_size)
+                end_file = not block
+                buffer = buffer[pos:] + block
+                pos = 0
+                continue
+            yield feature
+
+# approximate area (m²) of a feature in WGS84
+def feature_area(feature):
+    geometry = shape(feature['geometry'])
+    lat = geometry.centroid.y
+    return geometry.area * (111320 ** 2) * math.cos(math.radians(lat))
+
+# function to group the features in chunks (feature collections) of at most
+# chunk_size features and/or with a total area of at most chunk_area (m²)
+def iter_feature_chunks(features, chunk_size=None, chunk_area=None):
+    chunk = []
+    area_chunk = 0
+    for feature in features:
+        area = feature_area(feature) if chunk_area is not None else 0
+        if chunk and ((chunk_size is not None and len(chunk) >= chunk_size) or
+                      (chunk_area is not None and area_chunk + area > chunk_area)):
+            yield geojson.FeatureCollection(chunk)
+            chunk = []
+            area_chunk = 0
+        chunk.append(feature)
+        area_chunk += area
+    if chunk:
+        yield geojson.FeatureCollection(chunk)
+
+# function to get the fingerprint of an input file: its size and the sha1 of its content
+def input_fingerprint(gjson_path, block_size=1024 ** 2):
+    sha1 = hashlib.sha1()
+    with open(gjson_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return '{}:{}'.format(os.path.getsize(gjson_path), sha1.hexdigest())
+
+# function to read the checkpoint of a chunked run: the settings of the run (the input
+# fingerprint and the chunking, which define the fields of a chunk index), the indexes of
+# the finished chunks, the position in the output file after the last written chunk and
+# the amount of written features. Without checkpoint (file) nothing is finished yet
+def load_checkpoint(checkpoint_path):
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return {'settings': None, 'chunks_done': [], 'offset': None, 'amount_features': 0, 'finished': False}
+    with open(checkpoint_path, 'r') as checkpoint_file:
+        return json.load(checkpoint_file)
+
+# function to save the checkpoint, the file is replaced at once so
+# that an interruption doesn't leave an incomplete checkpoint
+def save_checkpoint(checkpoint_path, checkpoint):
+    if checkpoint_path is None:
+        return
+    with open(checkpoint_path + '.tmp', 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+# writer of a geojson feature collection to which the features
+# can be appended while they are coming in. With resume_offset an
+# interrupted file is continued: it is truncated to the offset (the
+# position after the last completely written feature, see tell)
+class GeoJSONStreamWriter():
+    resumable = True
+
+    # properties: the kinds of the crop calendar properties for the typed
+    # output formats (see result_writers.py), not needed for geojson
+    def __init__(self, out_path, resume_offset=None, amount_features=0, properties=None):
+        self.out_path = out_path
+        self.amount_features = amount_features
+        if resume_offset is None:
+            self._file = open(out_path, 'w', encoding='utf8')
+            self._file.write('{"type": "FeatureCollection", "features": [')
+        else:
+            self._file = open(out_path, 'r+', encoding='utf8')
+            self._file.seek(resume_offset)
+            self._file.truncate()
+
+    def tell(self):
+        return self._file.tell()
+
+    def write_features(self, features):
+        for feature in features:
+            self._file.write((',\n' if self.amount_features else '\n') + json.dumps(feature))
+            self.amount_features += 1
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.write('\n]}\n')
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,92 @@
+# Orchestration of openEO batch jobs: independent jobs are started together and
+# polled in a single loop instead of blocking on start_and_wait() for each job.
+# The status of the jobs is cached so that a job is polled at most once per poll
+# interval and finished jobs are not polled anymore.
+
+import time
+
+JOB_FINISHED = 'finished'
+JOB_FAILED = ['error', 'canceled']
+
+
+class JobFailedException(Exception):
+    pass
+
+
+class JobOrchestrator():
+
+    # with metrics (PipelineMetrics) the submitted jobs are counted
+    def __init__(self, poll_interval=5, max_poll_interval=60, timeout=None, metrics=None):
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.metrics = metrics
+        self._jobs = dict()
+        self._status = dict() # name job => (status, time of the last poll, None if not polled yet)
+        self._results = dict()
+
+    # function to create and start the job of the datacube (process graph) without waiting
+    def submit(self, name, datacube):
+        job = datacube.send_job()
+        job.start_job()
+        self._jobs[name] = job
+        # the job is polled at the first status request, so that a
+        # job which finishes fast doesn't wait a poll interval
+        self._status[name] = ('queued', None)
+        if self.metrics is not None:
+            self.metrics.count('openeo_jobs')
+        return job
+
+    # function to get the status of a job, using the cached status when it
+    # was polled less than poll_interval seconds ago or when the job is done
+    def status(self, name):
+        status, last_poll = self._status[name]
+        if status == JOB_FINISHED or status in JOB_FAILED or (last_poll is not None and time.time() - last_poll < self.poll_interval):
+            return status
+        status = self._jobs[name].status()
+        self._status[name] = (status, time.time())
+        return status
+
+    def _get_result(self, name):
+        if name not in self._results:
+            status = self.status(name)
+            if status == JOB_FINISHED:
+                self._results[name] = self._jobs[name].get_result().load_json()
+            else:
+                self._results[name] = JobFailedException('Job {} ({}) ended with status {}'.format(
+                    name, getattr(self._jobs[name], 'job_id', ''), status))
+        return self._results[name]
+
+    # function to wait until all (or the given) jobs are done. Returns per job the
+    # loaded json result or the exception if the job failed, so that the caller
+    # can decide on a fallback. The poll interval grows while jobs are running
+    def wait(self, names=None):
+        names = list(self._jobs.keys()) if names is None else list(names)
+        start_wait = time.time()
+        interval = self.poll_interval
+        pending = list(names)
+        while True:
+            pending = [name for name in pending if self.status(name) != JOB_FINISHED and self.status(name) not in JOB_FAILED]
+            if not pending:
+                break
+            if self.timeout is not None and time.time() - start_wait > self.timeout:
+                raise TimeoutError('Jobs {} not finished after {} s'.format(pending, self.timeout))
+            time.sleep(interval)
+            interval = min(interval * 1.5, self.max_poll_interval)
+        results = dict()
+        for name in names:
+            try:
+                results[name] = self._get_result(name)
+            except Exception as e:
+                results[name] = e
+        return results
+
+    # function to get the result of a single job, raising the exception if it failed
+    def result(self, name):
+        result = self.wait([name])[name]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def statuses(self):
+        return {name: status for name, (status, _) in self._status.items()}
@@ -0,0 +1,301 @@
+# Local stand-in for the openEO backend and the Terrascope catalogue, so that the complete
+# crop calendar pipeline can be run (and benchmarked) offline. ReplayConnection replays
+# a recorded time series (the datacubes in Tests/Cropcalendars/EX_files) for
+# polygonal_mean_timeseries, with per field one of the recorded fields, and runs the UDF
+# in-process. StubCatalogueServer serves the S1 products of the replayed acquisitions
+# with the same json as the catalogue, so that OpenSearch can be pointed to it.
+# usage: Cropcalendars(..., connection=ReplayConnection(), open_search=OpenSearch(server.url, cache_dir=None))
+
+import datetime
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+
+PATH_TIMESERIES_RECORDED = Path(__file__).resolve().parents[2] / 'Tests' / 'Cropcalendars' / 'EX_files' / 'datacube_metrics_sigma_V2.json'
+# the position of the bands of the collections in the recorded time series
+BANDS_RECORDED = {('S1_GRD_SIGMA0_ASCENDING', 'VH'): 2, ('S1_GRD_SIGMA0_ASCENDING', 'VV'): 3, ('S1_GRD_SIGMA0_ASCENDING', 'angle'): 4,
+                  ('S1_GRD_SIGMA0_DESCENDING', 'VH'): 5, ('S1_GRD_SIGMA0_DESCENDING', 'VV'): 6, ('S1_GRD_SIGMA0_DESCENDING', 'angle'): 7,
+                  ('TERRASCOPE_S2_FAPAR_V2', 'FAPAR_10M'): 8}
+# the relative orbits (alternating every 6 days) of the orbit passes over Belgium
+RO_ORBIT_PASSES = {'ASCENDING': (88, 161), 'DESCENDING': (37, 110)}
+# the footprint (minx, miny, maxx, maxy) of the S1 products of the stub catalogue (Belgium)
+FOOTPRINT_PRODUCTS = (2.5, 49.4, 6.5, 51.6)
+
+
+# function to get the dates of the recorded (single year) time series replayed
+# for every year of start-end, as (replayed date, recorded date) sorted on date
+def replay_dates(dates_recorded, start, end):
+    start, end = str(start)[:10], str(end)[:10]
+    dates = []
+    for year in range(int(start[:4]), int(end[:4]) + 1):
+        for date in dates_recorded:
+            date_replay = '{}{}'.format(year, date[4:])
+            if date_replay[5:10] == '02-29' and year % 4:
+                continue
+            if start <= date_replay[:10] <= end:
+                dates.append((date_replay, date))
+    return sorted(dates)
+
+
+class ReplayJob():
+
+    def __init__(self, cube):
+        self.cube = cube
+        self.job_id = 'replay-{}'.format(id(self))
+        self._status = 'created'
+
+    def start_job(self):
+        self._status = 'finished'
+
+    def start_and_wait(self):
+        self.start_job()
+        return self
+
+    def status(self):
+        return self._status
+
+    def get_result(self):
+        return self
+
+    def load_json(self):
+        return self.cube.execute()
+
+
+class ReplayCube():
+
+    def __init__(self, connection, bands, start=None, end=None, geometry=None, udf=None, timeseries=None):
+        self.connection = connection
+        self.bands = bands  # list of (collection, band)
+        self.start = start
+        self.end = end
+        self.geometry = geometry
+        self.udf = udf  # (udf code, context) of run_udf
+        self.timeseries = timeseries  # the input time series of datacube_from_process
+        self._pg = {}
+
+    def _copy(self, **kwargs):
+        attributes = dict(bands=self.bands, start=self.start, end=self.end, geometry=self.geometry, udf=self.udf, timeseries=self.timeseries)
+        attributes.update(kwargs)
+        return ReplayCube(self.connection, **attributes)
+
+    def band(self, name):
+        return self._copy(bands=[item for item in self.bands if item[1] == name])
+
+    def filter_temporal(self, start, end):
+        return self._copy(start=start, end=end)
+
+    def polygonal_mean_timeseries(self, geometry):
+        return self._copy(geometry=geometry)
+
+    def filter_bbox(self, west=None, south=None, east=None, north=None, crs=None):
+        return self
+
+    def merge(self, other):
+        return self._copy(bands=self.bands + other.bands)
+
+    # the mask and the band math of create_mask don't change the replayed values
+    def mask(self, mask):
+        return self
+
+    def resample_cube_spatial(self, target):
+        return self
+
+    def apply_kernel(self, kernel):
+        return self
+
+    def __invert__(self):
+        return self
+
+    def __or__(self, other):
+        return self
+
+    def __eq__(self, other):
+        return self
+
+    def __gt__(self, other):
+        return self
+
+    __hash__ = object.__hash__
+
+    def process(self, process_id, data=None, udf=None, runtime='Python', context=None):
+        return self._copy(udf=(udf, context))
+
+    def send_job(self):
+        return ReplayJob(self)
+
+    def execute(self):
+        timeseries = self.timeseries
+        if timeseries is None:
+            timeseries = self.connection.replay_timeseries(self.bands, self.start, self.end, self.geometry)
+        if self.udf is None:
+            return timeseries
+        return self.connection.run_udf(self.udf[0], timeseries, self.udf[1])
+
+
+class ReplayConnection():
+
+    def __init__(self, timeseries_path=PATH_TIMESERIES_RECORDED, bands_recorded=BANDS_RECORDED):
+        with open(timeseries_path, 'r') as timeseries_file:
+            timeseries = json.load(timeseries_file)
+        self.dates_recorded = sorted(timeseries.keys())
+        amount_bands = max(len(band_data) for date in self.dates_recorded for band_data in timeseries[date])
+        # (dates x recorded fields x bands), the fields are replayed in turn
+        self.values = np.array([[band_data + [None] * (amount_bands - len(band_data)) for band_data in timeseries[date]]
+                                for date in self.dates_recorded], dtype=float)
+        self.bands_recorded = bands_recorded
+        self.stats = {'timeseries': 0, 'udf': 0}
+
+    def load_collection(self, collection_id, bands=None):
+        return ReplayCube(self, [(collection_id, band) for band in (bands or [])])
+
+    imagecollection = load_collection
+
+    # the UDF on a time series (json) which was already computed
+    def datacube_from_process(self, process_id, data=None, udf=None, runtime='Python', context=None):
+        return ReplayCube(self, [], udf=(udf, context), timeseries=data)
+
+    # function to get the time series json of polygonal_mean_timeseries for the geometries
+    def replay_timeseries(self, bands, start, end, geometry):
+        self.stats['timeseries'] += 1
+        amount_fields = len(getattr(geometry, 'geoms', [geometry]))
+        loc_dates = {date: d for d, date in enumerate(self.dates_recorded)}
+        loc_bands = [self.bands_recorded[band] for band in bands]
+        loc_fields = np.arange(amount_fields) % self.values.shape[1]
+        timeseries = dict()
+        for date_replay, date in replay_dates(self.dates_recorded, start or self.dates_recorded[0], end or self.dates_recorded[-1]):
+            values_date = self.values[loc_dates[date]][loc_fields][:, loc_bands]
+            timeseries[date_replay] = np.where(np.isnan(values_date), None, values_date.astype(object)).tolist()
+        return timeseries
+
+    # function to run the UDF code in-process on the time series, the
+    # result goes through json like the result of a job of the backend
+    def run_udf(self, udf, timeseries, context):
+        #local import, only needed to run the UDF
+        from openeo_udf.api.structured_data import StructuredData
+        from openeo_udf.api.udf_data import UdfData
+        self.stats['udf'] += 1
+        udf_data = UdfData(proj={'EPSG': 4326}, structured_data_list=[StructuredData(description='timeseries', data=timeseries, type='dict')])
+        udf_data.user_context = json.loads(json.dumps(context))
+        udf_data = self.exec_udf(udf)['udf_cropcalendars'](udf_data)
+        return json.loads(json.dumps(udf_data.get_structured_data_list()[0].data))
+
+    # function to execute the UDF code, returns its globals (the functions of the UDF)
+    def exec_udf(self, udf):
+        udf_globals = dict()
+        exec(compile(udf, 'crop_calendar_udf.py', 'exec'), udf_globals)
+        return udf_globals
+
+    # function to get per orbit pass the acquisitions ({date: RO}) of the
+    # replayed time series, as reported by the catalogue for the S1 products
+    def acquisitions(self, start, end):
+        acquisitions = dict()
+        for orbit_pass, ROs in RO_ORBIT_PASSES.items():
+            loc_angle = self.bands_recorded[('S1_GRD_SIGMA0_{}'.format(orbit_pass), 'angle')]
+            dates_pass = [date for d, date in enumerate(self.dates_recorded) if not np.isnan(self.values[d, :, loc_angle]).all()]
+            # each RO passes every 6 days
+            first_date = datetime.datetime.strptime(dates_pass[0][:10], '%Y-%m-%d')
+            RO_dates = {date: ROs[int((datetime.datetime.strptime(date[:10], '%Y-%m-%d') - first_date).days % 6 != 0)] for date in dates_pass}
+            acquisitions[orbit_pass] = {date_replay[:10]: RO_dates[date] for date_replay, date in replay_dates(dates_pass, start, end)}
+        return acquisitions
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubCatalogueServer():
+
+    # Local http server with the collections and the (paged) S1 products of the catalogue,
+    # for the acquisitions per orbit pass ({date: RO}, see ReplayConnection.acquisitions).
+    # The products of a RO have a fixed footprint (footprints: {RO: (minx, miny, maxx, maxy)},
+    # FOOTPRINT_PRODUCTS for the other RO's) and as the catalogue only the products of which
+    # the footprint intersects the requested bbox are returned.
+    # The first fail_requests requests get a 503 response (to test the retries of the client)
+    def __init__(self, acquisitions, items_per_page=100, collection_id='urn:eop:VITO:CGS_S1_GRD_SIGMA0_L1', port=0, fail_requests=0,
+                 footprints=None):
+        self.acquisitions = acquisitions
+        self.footprints = footprints or dict()
+        self.items_per_page = items_per_page
+        self.fail_requests = fail_requests
+        self.collection_id = collection_id
+        self.stats = {'requests': 0}
+        self._server = _ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.url = 'http://127.0.0.1:{}/catalogue/'.format(self._server.server_address[1])
+        self._thread = None
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                server.stats['requests'] += 1
+                if server.stats['requests'] <= server.fail_requests:
+                    self.send_error(503)
+                    return
+                request = urlparse(self.path)
+                if request.path.endswith('/collections'):
+                    response = server.collections()
+                elif request.path.endswith('/products'):
+                    response = server.products({key: value[0] for key, value in parse_qs(request.query).items()})
+                else:
+                    self.send_error(404)
+                    return
+                body = json.dumps(response).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def collections(self):
+        return {'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'id': self.collection_id, 'properties': {'title': 'S1 GRD SIGMA0'}}]}
+
+    def products(self, query):
+        start, end = query['start'][:10], query['end'][:10]
+        bbox = [float(item) for item in query['bbox'].split(',')]
+        products = [(date, orbit_pass, RO) for orbit_pass, acquisitions_pass in self.acquisitions.items()
+                    for date, RO in acquisitions_pass.items() if start <= date <= end and self.intersects(RO, bbox)]
+        products.sort()
+        start_index = int(query.get('startIndex', 1))
+        features = [{'type': 'Feature', 'id': 'S1_GRDH_SIGMA0_{}_{}_{}'.format(date.replace('-', ''), orbit_pass, RO), 'geometry': self.footprint(RO),
+                     'properties': {'date': '{}T05:50:00Z'.format(date),
+                                    'title': 'S1A_IW_GRDH_SIGMA0_DV_{}T055000_{}_{}'.format(date.replace('-', ''), orbit_pass, RO),
+                                    'acquisitionInformation': [{'platform': {'platformShortName': 'SENTINEL-1'}},
+                                                               {'acquisitionParameters': {'relativeOrbitNumber': RO}}]}}
+                    for date, orbit_pass, RO in products[start_index - 1:start_index - 1 + self.items_per_page]]
+        # as the catalogue, a response without results has itemsPerPage 0
+        return {'type': 'FeatureCollection', 'totalResults': len(products), 'itemsPerPage': self.items_per_page if products else 0,
+                'features': features}
+
+    def footprint(self, RO):
+        minx, miny, maxx, maxy = self.footprints.get(RO, FOOTPRINT_PRODUCTS)
+        return {'type': 'Polygon', 'coordinates': [[[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny]]]}
+
+    def intersects(self, RO, bbox):
+        minx, miny, maxx, maxy = self.footprints.get(RO, FOOTPRINT_PRODUCTS)
+        return minx <= bbox[2] and bbox[0] <= maxx and miny <= bbox[3] and bbox[1] <= maxy
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,102 @@
+# Timers and counters of the stages of the crop calendar pipeline. A stage is timed with
+# the context manager stage(name), several runs of the same stage are summed. With a
+# profile_dir each run of a stage is also profiled (cProfile) and dumped to
+# <profile_dir>/<stage>_<run>.prof, to be inspected with pstats or snakeviz. Only one
+# profiler can be active in the process, the runs which start while another stage is
+# profiled (in another thread or around it) are only timed (counter profiles_skipped).
+# The UDF keeps its own metrics (see UdfMetrics in crop_calendar_udf.py), which are
+# added with add_udf_metrics so that to_json reports both: the stages and counters of
+# all UDF runs are summed, so that the size of the metrics doesn't grow with the amount
+# of UDF runs. The profiles of the UDF stages are written to <profile_dir>/udf_<stage>_<run>.txt.
+
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# held while a stage is profiled: python >= 3.12 raises an error when a second profiler is
+# enabled and before the profiler of the other thread or the outer stage was replaced
+_profile_lock = threading.Lock()
+
+
+class PipelineMetrics():
+
+    def __init__(self, profile_dir=None):
+        self.profile_dir = profile_dir
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self.stages = dict()  # name => {'runs', 'total_s', 'max_s'}
+        self.counters = dict()
+        self.udf = {'runs': 0, 'stages': dict(), 'counters': dict()}
+
+    @contextmanager
+    def stage(self, name):
+        profiler = None
+        if self.profile_dir is not None and _profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # another profiling tool is active (python >= 3.12)
+                _profile_lock.release()
+                profiler = None
+        if self.profile_dir is not None and profiler is None:
+            self.count('profiles_skipped')
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                stage = self.stages.setdefault(name, {'runs': 0, 'total_s': 0., 'max_s': 0.})
+                stage['runs'] += 1
+                stage['total_s'] += duration
+                stage['max_s'] = max(stage['max_s'], duration)
+                run = stage['runs']
+            if profiler is not None:
+                profiler.disable()
+                _profile_lock.release()
+                profiler.dump_stats(os.path.join(self.profile_dir, '{}_{}.prof'.format(name, run)))
+
+    # function to time a function call as stage, e.g. for a function run in a thread
+    def timed(self, name, function, *args, **kwargs):
+        with self.stage(name):
+            return function(*args, **kwargs)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_udf_metrics(self, udf_metrics):
+        if not udf_metrics:
+            return
+        with self._lock:
+            self.udf['runs'] += 1
+            for name, stage_udf in udf_metrics.get('stages', dict()).items():
+                stage = self.udf['stages'].setdefault(name, {'runs': 0, 'total_s': 0., 'max_s': 0.})
+                stage['runs'] += stage_udf['runs']
+                stage['total_s'] += stage_udf['total_s']
+                stage['max_s'] = max(stage['max_s'], stage_udf['max_s'])
+            for name, amount in udf_metrics.get('counters', dict()).items():
+                self.udf['counters'][name] = self.udf['counters'].get(name, 0) + amount
+            run = self.udf['runs']
+        if self.profile_dir is not None:
+            for name, profile in udf_metrics.get('profiles', dict()).items():
+                with open(os.path.join(self.profile_dir, 'udf_{}_{}.txt'.format(name, run)), 'w') as profile_file:
+                    profile_file.write(profile)
+
+    def to_dict(self):
+        with self._lock:
+            return {'stages': {name: dict(stage) for name, stage in self.stages.items()}, 'counters': dict(self.counters),
+                    'udf': {'runs': self.udf['runs'], 'stages': {name: dict(stage) for name, stage in self.udf['stages'].items()},
+                            'counters': dict(self.udf['counters'])}}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def write(self, path):
+        with open(path, 'w') as metrics_file:
+            metrics_file.write(self.to_json(indent=2))
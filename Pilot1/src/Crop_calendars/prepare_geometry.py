@@ -1,34 +1,41 @@
-from functools import partial
+from functools import lru_cache
+import geojson
+import numpy as np
 import pyproj
+import shapely
 from shapely.ops import transform
 from shapely.geometry.polygon import Polygon
 import utm
 
+# shapely 2 can transform and buffer arrays of geometries at once
+SHAPELY_VECTORIZED = hasattr(shapely, 'transform') and hasattr(shapely, 'buffer')
+
+# function to get the transformer between two projections. The transformers
+# are cached so that they are only created once per UTM zone.
+# Note: this uses the same axis handling as pyproj.transform(Proj, Proj) which
+# was used before, so that the buffered geometries are not changed
+@lru_cache(maxsize=None)
+def _get_transformer(epsg_from, epsg_to):
+    return pyproj.Transformer.from_proj(pyproj.Proj('epsg:{}'.format(str(epsg_from))),
+                                        pyproj.Proj('epsg:{}'.format(str(epsg_to))))
+
+# function to get the coordinates of the (outer ring of the first) polygon of the field
+def _get_coordinates(field):
+    if field.type == 'Polygon':
+        return field.coordinates[0]
+    elif field.type == 'MultiPolygon':
+        return field.coordinates[0][0]
+
 # function to convert the field to UTM projection
 # and apply an inward buffer of 10 m
 def to_utm_inw_buffered(epsg_original, epsg_utm, field):
-    project = partial(
-        pyproj.transform,
-        pyproj.Proj('epsg:{}'.format(str(epsg_original))),
-        pyproj.Proj('epsg:{}'.format(str(epsg_utm)))
-    )
-    if field.type == 'Polygon':
-        lat_list = [field.coordinates[0][p][1] for p in range(len(field.coordinates[0]))]
-        lon_list = [field.coordinates[0][p][0] for p in range(len(field.coordinates[0]))]
-    elif field.type == 'MultiPolygon':
-        lat_list = [field.coordinates[0][0][p][1] for p in range(len(field.coordinates[0][0]))]
-        lon_list = [field.coordinates[0][0][p][0] for p in range(len(field.coordinates[0][0]))]
-    poly_reproject = transform(project ,Polygon(zip(lon_list, lat_list))).buffer(-10, cap_style = 1, join_style = 2, resolution  = 4) # inward buffering of the polygon
+    coordinates = np.asarray(_get_coordinates(field), dtype=float)
+    x_utm, y_utm = _get_transformer(epsg_original, epsg_utm).transform(coordinates[:, 0], coordinates[:, 1])
+    poly_reproject = Polygon(zip(x_utm, y_utm)).buffer(-10, cap_style = 1, join_style = 2, resolution  = 4) # inward buffering of the polygon
     poly_reproject_WGS = UTM_to_WGS84(epsg_utm, poly_reproject)
     return poly_reproject_WGS
 def UTM_to_WGS84(epsg_utm, field):
-    project = partial(
-        pyproj.transform,
-        pyproj.Proj('epsg:{}'.format(str(epsg_utm))),
-        pyproj.Proj('epsg:{}'.format(str(4326)))
-    )
-
-    poly_WGS84 = transform(project, field)
+    poly_WGS84 = transform(_get_transformer(epsg_utm, 4326).transform, field)
     return poly_WGS84
 
 # function to get the epsg of the UTM zone
@@ -38,29 +45,85 @@ def _get_epsg(lat, zone_nr):
     else:
         epsg_code = '327' + str(zone_nr)
     return int(epsg_code)
+
+# function that converts all fields of the same UTM zone to UTM and applies
+# the inward buffer of 10 m. The coordinates of all fields are projected in a
+# single call, the buffered polygons are converted back to WGS84
+def _utm_zone_inw_buffered(epsg_utm, fields):
+    coordinates = [np.asarray(_get_coordinates(field), dtype=float) for field in fields]
+    x_utm, y_utm = _get_transformer(4326, epsg_utm).transform(np.concatenate([item[:, 0] for item in coordinates]),
+                                                              np.concatenate([item[:, 1] for item in coordinates]))
+    split_fields = np.cumsum([len(item) for item in coordinates])[:-1]
+    polygons_utm = [Polygon(zip(x_field, y_field)) for x_field, y_field in
+                    zip(np.split(x_utm, split_fields), np.split(y_utm, split_fields))]
+
+    transformer_WGS84 = _get_transformer(epsg_utm, 4326)
+    if SHAPELY_VECTORIZED:
+        polygons_buffered = shapely.buffer(np.array(polygons_utm, dtype=object), -10, quad_segs=4, cap_style='round', join_style='mitre')
+        return list(shapely.transform(polygons_buffered, lambda coords: np.column_stack(
+            transformer_WGS84.transform(coords[:, 0], coords[:, 1]))))
+    polygons_buffered = [poly.buffer(-10, cap_style = 1, join_style = 2, resolution  = 4) for poly in polygons_utm]
+    return [transform(transformer_WGS84.transform, poly) for poly in polygons_buffered]
+
+# reason codes for the fields that are not used for the crop calendars
+REJECT_TOO_SMALL = 'too_small_inward_buffer' # the field disappears with the 10 m inward buffer
+REJECT_UNSUPPORTED_GEOMETRY = 'unsupported_geometry' # no (Multi)Polygon with coordinates
+
 # function that prepares the geometry of the fields so
-# that they are suitable for applying the crop calendar model
-def prepare_geometry(gj):
-    polygons_inw_buffered = []
-    poly_too_small_buffer = []
+# that they are suitable for applying the crop calendar model.
+# Returns the buffered polygons of the retained fields and per
+# field None if it is retained or else the reason code of the rejection
+def prepare_geometry_fields(gj):
+    rejection_reasons = [None] * len(gj.features)
+    # group the fields per UTM zone
+    fields_zones = dict()
     for field_loc in range(len(gj.features)):
-        if gj.features[0].geometry.type == 'Polygon':
-            lon = gj['features'][field_loc].geometry.coordinates[0][0][0]
-            lat = gj['features'][field_loc].geometry.coordinates[0][0][1]
-        elif gj.features[0].geometry.type == 'MultiPolygon':  # in case the data is stored as a multipolygon
-            lon = gj['features'][field_loc].geometry.coordinates[0][0][0][0]
-            lat = gj['features'][field_loc].geometry.coordinates[0][0][0][1]
+        geometry = gj.features[field_loc].geometry
+        if geometry is None or geometry.type not in ['Polygon', 'MultiPolygon'] or not geometry.coordinates:
+            rejection_reasons[field_loc] = REJECT_UNSUPPORTED_GEOMETRY
+            continue
+        lon, lat = _get_coordinates(geometry)[0][:2]
         utm_zone_nr = utm.from_latlon(lat, lon)[2]
         epsg_UTM_field = _get_epsg(lat, utm_zone_nr)
-        poly_inw_buffered = to_utm_inw_buffered('4326', epsg_UTM_field, gj.features[field_loc].geometry)
-        if poly_inw_buffered.is_empty:
-            poly_too_small_buffer.append(gj['features'][field_loc].geometry)
-            continue
-        polygons_inw_buffered.append(poly_inw_buffered)
+        fields_zones.setdefault(epsg_UTM_field, []).append(field_loc)
+
+    polygons_fields = [None] * len(gj.features)
+    for epsg_UTM_zone, fields_loc in fields_zones.items():
+        polygons_zone = _utm_zone_inw_buffered(epsg_UTM_zone, [gj.features[field_loc].geometry for field_loc in fields_loc])
+        for field_loc, poly_inw_buffered in zip(fields_loc, polygons_zone):
+            if poly_inw_buffered.is_empty:
+                rejection_reasons[field_loc] = REJECT_TOO_SMALL
+            else:
+                polygons_fields[field_loc] = poly_inw_buffered
+
+    # keep the order of the fields in the geojson
+    polygons_inw_buffered = [polygons_fields[field_loc] for field_loc in range(len(gj.features)) if rejection_reasons[field_loc] is None]
+    return polygons_inw_buffered, rejection_reasons
+
+# function that prepares the geometry of the fields so
+# that they are suitable for applying the crop calendar model
+def prepare_geometry(gj):
+    polygons_inw_buffered, rejection_reasons = prepare_geometry_fields(gj)
+    poly_too_small_buffer = [gj['features'][field_loc].geometry for field_loc in range(len(gj.features)) if rejection_reasons[field_loc] is not None]
     return polygons_inw_buffered, poly_too_small_buffer
 
+# function to remove the rejected fields from the geojson in a single pass,
+# the removed features are returned with their reason code as property
+def remove_rejected_poly(polygons, rejection_reasons):
+    features_retained = []
+    features_rejected = []
+    for feature, reason in zip(polygons.features, rejection_reasons):
+        if reason is None:
+            features_retained.append(feature)
+        else:
+            feature_rejected = geojson.Feature(geometry=feature.geometry, properties=dict(feature.properties))
+            feature_rejected.properties['rejection_reason'] = reason
+            features_rejected.append(feature_rejected)
+    polygons.features = features_retained
+    return polygons, geojson.FeatureCollection(features_rejected)
+
 def remove_small_poly(polygons, poly_too_small_buffer):
-    for poly_remove in poly_too_small_buffer:
-        gj_reduced = [item for item in polygons.features if item.geometry != poly_remove]
-        polygons.features = gj_reduced
-    return polygons
\ No newline at end of file
+    # the geometries are compared on their serialization so that it's a single pass
+    poly_remove = set(geojson.dumps(item, sort_keys=True) for item in poly_too_small_buffer)
+    polygons.features = [item for item in polygons.features if geojson.dumps(item.geometry, sort_keys=True) not in poly_remove]
+    return polygons
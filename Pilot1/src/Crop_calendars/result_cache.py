@@ -0,0 +1,59 @@
+# Persistent cache of the crop calendar result (the properties added to the field)
+# per field, with as key the content addressed id of the field (see field_id in
+# field_identity.py): the hash of its geometry, the time range and the parameters.
+# A field which was processed before with the same settings skips the whole pipeline.
+# The results are stored in a sqlite database in the cache directory.
+
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class FieldResultCache:
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, 'result_cache.sqlite')
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, created REAL)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # a new connection per operation, so that the cache can be used by several threads.
+        # The transaction is committed (rolled back on an error) and the connection closed
+        with contextlib.closing(sqlite3.connect(self.db_path, timeout=60)) as conn, conn:
+            yield conn
+
+    # function to get the cached results of the fields, the
+    # fields which are not in the cache are not returned
+    def get_many(self, keys, batch_size=500):
+        keys = list(keys)
+        results = dict()
+        with self._connect() as conn:
+            for b in range(0, len(keys), batch_size):
+                batch = keys[b:b + batch_size]
+                rows = conn.execute('SELECT key, value FROM results WHERE key IN ({})'.format(','.join('?' * len(batch))), batch)
+                results.update({key: json.loads(zlib.decompress(value).decode('utf-8')) for key, value in rows})
+        with self._lock:
+            self._stats['hits'] += len(results)
+            self._stats['misses'] += len(keys) - len(results)
+        return results
+
+    def put_many(self, results):
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                             [(key, zlib.compress(json.dumps(value).encode('utf-8')), now) for key, value in results.items()])
+
+    def stats(self):
+        with self._connect() as conn:
+            entries = conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        with self._lock:
+            return dict(self._stats, entries=entries)
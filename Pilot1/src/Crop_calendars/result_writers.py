@@ -0,0 +1,349 @@
+# Streaming writers of the crop calendar results (the fields with their crop calendar
+# properties), to which the features are appended chunk by chunk (see
+# Cropcalendars.generate_cropcalendars_chunked). Besides the geojson feature collection
+# the fields can be written as GeoJSON sequence (a feature per line), GeoParquet or
+# FlatGeobuf. In the columnar formats the crop calendar dates are a date column (a
+# list of dates for the dates per season) instead of strings, so that they are loaded
+# as dates by QGIS, GeoPandas, ... The writer is chosen on the extension of the output
+# file (see open_writer), other formats can be added to WRITERS.
+
+import datetime
+import json
+import re
+from shapely.geometry import mapping, shape
+
+from Crop_calendars.geojson_stream import GeoJSONStreamWriter
+
+# the crop calendar properties of the UDF: '{event}_date' (date or None)
+# and '{event}_dates_{season}' (list of dates)
+PATTERN_DATE = re.compile(r'.+_date$')
+PATTERN_DATES = re.compile(r'.+_dates_.+$')
+
+# function to convert a date ('YYYY-MM-DD', also the date of a timestamp) to a
+# datetime.date, empty values (None or NaN) become None
+def to_date(value):
+    if value is None or value != value:
+        return None
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+# function to get the kinds of the properties which are added to the fields by the crop
+# calendar pipeline: the id ('string') and per event the date ('date') or with seasons
+# per season the list of dates ('dates'), so that their column types don't depend on
+# the values of the first written chunk
+def crop_calendar_properties(crop_calendar_event, crop_calendar_events=None, seasons=None):
+    events = [event['crop_calendar_event'] for event in crop_calendar_events] if crop_calendar_events else [crop_calendar_event]
+    kinds = {'id': 'string'}
+    for event in events:
+        if seasons:
+            kinds.update({'{}_dates_{}'.format(event, season['season']): 'dates' for season in seasons})
+        else:
+            kinds['{}_date'.format(event)] = 'date'
+    return kinds
+
+# function to get per property of the features its kind: 'date' or 'dates' for the
+# crop calendar dates (name of the UDF output and all values are dates) or 'value'
+def property_kinds(features):
+    names = list(dict.fromkeys(name for feature in features for name in feature['properties']))
+    kinds = dict()
+    for name in names:
+        values = [feature['properties'].get(name) for feature in features]
+        kinds[name] = 'value'
+        try:
+            if PATTERN_DATE.match(name) and not any(isinstance(value, (list, tuple)) for value in values):
+                [to_date(value) for value in values]
+                kinds[name] = 'date'
+            elif PATTERN_DATES.match(name) and all(isinstance(value, (list, tuple)) or value is None for value in values):
+                [to_date(value) for dates in values if dates is not None for value in dates]
+                kinds[name] = 'dates'
+        except (TypeError, ValueError):
+            pass
+    return kinds
+
+# function to get the kinds of the properties of a typed output: the declared kinds (see
+# crop_calendar_properties) and of the other properties (those of the input fields) the
+# kind of their values in the first written chunk
+def declared_property_kinds(features, properties=None):
+    properties = properties or dict()
+    kinds = {name: kind for name, kind in property_kinds(features).items() if name not in properties}
+    names = list(dict.fromkeys([name for feature in features for name in feature['properties']] + list(properties)))
+    return {name: properties.get(name, kinds.get(name)) for name in names}
+
+# function to convert a value to a string column: empty values (None or NaN) become None
+def to_string(value):
+    if value is None or value != value:
+        return None
+    if isinstance(value, str):
+        return value
+    return json.dumps(value) if isinstance(value, (list, dict)) else str(value)
+
+# writer of a GeoJSON text sequence (RFC 8142): each feature is a separate
+# json text, so that the file can be read (and resumed) feature by feature
+class GeoJSONSeqWriter(GeoJSONStreamWriter):
+    def __init__(self, out_path, resume_offset=None, amount_features=0, properties=None):
+        self.out_path = out_path
+        self.amount_features = amount_features
+        if resume_offset is None:
+            self._file = open(out_path, 'w', encoding='utf8')
+        else:
+            self._file = open(out_path, 'r+', encoding='utf8')
+            self._file.seek(resume_offset)
+            self._file.truncate()
+
+    def write_features(self, features):
+        for feature in features:
+            self._file.write('\x1e' + json.dumps(feature) + '\n')
+            self.amount_features += 1
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+# writer of a GeoParquet file (geometry as WKB), each written chunk is a row group.
+# The columns of the crop calendar properties are declared (properties, see
+# crop_calendar_properties): the id as string, the dates as date32 (list of date32 for
+# the dates per season). The other properties get the type of their values in the first
+# chunk, values of a later chunk which can't be converted to that type are written as
+# null. Properties which are missing in a chunk are written as null, new properties
+# are not added. A parquet file can't be continued, so it is not resumable
+class GeoParquetWriter(GeoJSONStreamWriter):
+    resumable = False
+
+    def __init__(self, out_path, resume_offset=None, amount_features=0, properties=None):
+        if resume_offset is not None:
+            raise ValueError('A GeoParquet file can not be resumed')
+        self.check_supported()
+        #local import, pyarrow is only needed for this output format
+        import pyarrow as pa
+        self._pa = pa
+        self.out_path = out_path
+        self.amount_features = 0
+        self._properties = properties
+        self._kinds = None
+        self._schema = None
+        self._writer = None
+
+    @staticmethod
+    def check_supported():
+        #local import, pyarrow is only needed for this output format
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError('The parquet output format needs pyarrow')
+
+    def tell(self):
+        return None
+
+    def init_schema(self, features):
+        pa = self._pa
+        self._kinds = declared_property_kinds(features, self._properties)
+        fields = []
+        for name, kind in self._kinds.items():
+            if kind == 'date':
+                fields.append(pa.field(name, pa.date32()))
+            elif kind == 'dates':
+                fields.append(pa.field(name, pa.list_(pa.date32())))
+            elif kind == 'string':
+                fields.append(pa.field(name, pa.string()))
+            else:
+                try:
+                    type_values = pa.array([feature['properties'].get(name) for feature in features]).type
+                except (pa.ArrowException, TypeError, ValueError):
+                    # mixed types, the values are stored as string
+                    type_values = pa.null()
+                # without values the type is unknown, then the values are stored as string
+                fields.append(pa.field(name, pa.string() if type_values == pa.null() else type_values))
+        fields.append(pa.field('geometry', pa.binary()))
+        # the crs is not given, so it is OGC:CRS84 (WGS84 longitude, latitude) as for geojson
+        metadata = {'version': '1.0.0', 'primary_column': 'geometry',
+                    'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': []}}}
+        self._schema = pa.schema(fields, metadata={'geo': json.dumps(metadata)})
+
+    # function to convert the values to the type of the column, the values which can't be
+    # converted without change (e.g. a string or 2.5 in an integer column) become null
+    def to_array(self, name, values, type_values):
+        pa = self._pa
+        try:
+            array = pa.array(values, type=type_values)
+            if all(value is None or value == value_array for value, value_array in zip(values, array.to_pylist())):
+                return array
+        except (pa.ArrowException, TypeError, ValueError):
+            pass
+        values_column = []
+        for value in values:
+            try:
+                value_column = pa.array([value], type=type_values).to_pylist()[0]
+            except (pa.ArrowException, TypeError, ValueError):
+                value_column = None
+            values_column.append(value_column if value_column == value else None)
+        amount_null = sum(value is not None and value == value for value in values) - sum(value is not None for value in values_column)
+        if amount_null:
+            print('{} VALUES OF {} ARE NOT {}, WRITTEN AS NULL'.format(amount_null, name, type_values))
+        return pa.array(values_column, type=type_values)
+
+    def write_features(self, features):
+        #local import, pyarrow is only needed for this output format
+        import pyarrow.parquet as pq
+        pa = self._pa
+        features = list(features)
+        if not features:
+            return
+        if self._schema is None:
+            self.init_schema(features)
+            self._writer = pq.ParquetWriter(self.out_path, self._schema)
+        arrays = []
+        for field in self._schema:
+            if field.name == 'geometry':
+                arrays.append(pa.array([shape(feature['geometry']).wkb for feature in features], type=field.type))
+                continue
+            values = [feature['properties'].get(field.name) for feature in features]
+            kind = self._kinds[field.name]
+            if kind == 'date':
+                values = [to_date(value) for value in values]
+            elif kind == 'dates':
+                values = [None if dates is None else [to_date(value) for value in dates] for dates in values]
+            elif field.type == pa.string():
+                values = [to_string(value) for value in values]
+            arrays.append(self.to_array(field.name, values, field.type))
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self._schema))
+        self.amount_features += len(features)
+
+    def close(self):
+        #local import, pyarrow is only needed for this output format
+        import pyarrow.parquet as pq
+        if self._schema is None:
+            # no features: a file with the declared columns
+            self.init_schema([])
+            self._writer = pq.ParquetWriter(self.out_path, self._schema)
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+# writer of a FlatGeobuf file with fiona (needs GDAL >= 3.1, see check_supported). The
+# crop calendar properties are declared (properties, see crop_calendar_properties): the
+# dates as datetime (at 00:00, FlatGeobuf has no date type), the dates per season as a
+# json list of dates (FlatGeobuf has no list type). The other properties get the fiona
+# type of their values in the first chunk, values of a later chunk which don't have that
+# type are written as null. A FlatGeobuf file can't be continued, so it is not resumable
+class FlatGeobufWriter(GeoJSONStreamWriter):
+    resumable = False
+
+    def __init__(self, out_path, resume_offset=None, amount_features=0, properties=None):
+        if resume_offset is not None:
+            raise ValueError('A FlatGeobuf file can not be resumed')
+        self.check_supported()
+        #local import, fiona is only needed for this output format
+        import fiona
+        self._fiona = fiona
+        self.out_path = out_path
+        self.amount_features = 0
+        self._properties = properties
+        self._kinds = None
+        self._collection = None
+
+    @staticmethod
+    def check_supported():
+        #local import, fiona is only needed for this output format
+        try:
+            import fiona
+        except ImportError:
+            raise ValueError('The flatgeobuf output format needs fiona')
+        if 'w' not in fiona.supported_drivers.get('FlatGeobuf', ''):
+            raise ValueError('FlatGeobuf is not supported by the GDAL version of fiona ({}, GDAL >= 3.1 is needed)'.format(
+                getattr(fiona, '__gdal_version__', 'unknown')))
+
+    def tell(self):
+        return None
+
+    def open_collection(self, features):
+        self._kinds = declared_property_kinds(features, self._properties)
+        properties = dict()
+        for name, kind in self._kinds.items():
+            if kind == 'date':
+                properties[name] = 'datetime'
+            elif kind in ['dates', 'string']:
+                properties[name] = 'str'
+            else:
+                values = [feature['properties'].get(name) for feature in features]
+                values = [value for value in values if value is not None]
+                if values and all(isinstance(value, bool) for value in values):
+                    properties[name] = 'bool'
+                elif values and all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+                    properties[name] = 'int'
+                elif values and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+                    properties[name] = 'float'
+                else:
+                    properties[name] = 'str'
+        self._collection = self._fiona.open(self.out_path, 'w', driver='FlatGeobuf', crs='EPSG:4326',
+                                            schema={'geometry': 'Unknown', 'properties': properties})
+
+    def write_features(self, features):
+        features = list(features)
+        if not features:
+            return
+        if self._collection is None:
+            self.open_collection(features)
+        schema_properties = self._collection.schema['properties']
+        records = []
+        for feature in features:
+            properties = dict()
+            for name in schema_properties:
+                value = feature['properties'].get(name)
+                kind = self._kinds[name]
+                type_property = schema_properties[name].split(':')[0]
+                if kind == 'date':
+                    value = to_date(value)
+                    value = None if value is None else '{}T00:00:00'.format(value.isoformat())
+                elif kind == 'dates':
+                    value = None if value is None else json.dumps([to_date(date).isoformat() for date in value])
+                elif type_property == 'str':
+                    value = to_string(value)
+                elif value is not None and value != value:
+                    value = None
+                # values which don't have the type of the property are written as null
+                elif type_property == 'bool' and not isinstance(value, bool):
+                    value = None
+                elif type_property == 'int' and (isinstance(value, bool) or not isinstance(value, int)):
+                    value = None
+                elif type_property == 'float' and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                    value = None
+                properties[name] = value
+            records.append({'geometry': mapping(shape(feature['geometry'])), 'properties': properties})
+        self._collection.writerecords(records)
+        self.amount_features += len(features)
+
+    def close(self):
+        if self._collection is None:
+            self.open_collection([])
+        if not self._collection.closed:
+            self._collection.close()
+
+# the output formats with their writer and the extensions of their files
+WRITERS = {'geojson': (GeoJSONStreamWriter, ('.geojson', '.json')),
+           'geojsonseq': (GeoJSONSeqWriter, ('.geojsons', '.geojsonl', '.geojsonseq')),
+           'parquet': (GeoParquetWriter, ('.parquet', '.geoparquet')),
+           'flatgeobuf': (FlatGeobufWriter, ('.fgb',))}
+
+# function to get the writer class of an output format, or of the extension of out_path
+def get_writer_class(out_path, output_format=None):
+    if output_format is None:
+        for output_format, (writer_class, extensions) in WRITERS.items():
+            if out_path.lower().endswith(extensions):
+                return check_writer_class(writer_class)
+        raise ValueError('No output format for {}, the supported extensions are {}'.format(
+            out_path, ', '.join(extension for _, extensions in WRITERS.values() for extension in extensions)))
+    if output_format not in WRITERS:
+        raise ValueError('Unknown output format {}, the supported formats are {}'.format(output_format, ', '.join(WRITERS)))
+    return check_writer_class(WRITERS[output_format][0])
+
+# function to check that the dependencies of a writer (e.g. GDAL >= 3.1 for FlatGeobuf)
+# are available, so that a run fails before the processing instead of at its first result
+def check_writer_class(writer_class):
+    if hasattr(writer_class, 'check_supported'):
+        writer_class.check_supported()
+    return writer_class
+
+def open_writer(out_path, output_format=None, resume_offset=None, amount_features=0, properties=None):
+    return get_writer_class(out_path, output_format)(out_path, resume_offset, amount_features, properties)
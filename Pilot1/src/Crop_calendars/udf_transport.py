@@ -0,0 +1,48 @@
+# Compact transport of the UDF context and time series. Instead of nested json dicts
+# (per field for the context, per date/field/band for the time series) the data is sent
+# as columnar arrays: base64 encoded .npy buffers which the UDF decodes without json
+# parsing, see decode_array in crop_calendar_udf.py. Only numpy is needed on both sides.
+
+import base64
+import io
+import numpy as np
+import pandas as pd
+
+UDF_ENCODING_NPY = 'npy_base64'
+
+# function to encode an array as base64 encoded .npy buffer
+def encode_array(array):
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(array), allow_pickle=False)
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+# function to convert the time series json of polygonal_mean_timeseries
+# ({date: [per field: [per band: value]]}) to the sorted dates and
+# a (dates x fields x bands) array, missing values become nan
+def timeseries_json_to_arrays(timeseries, dtype=np.float64):
+    dates = sorted(timeseries.keys())
+    amount_fields = len(timeseries[dates[0]])
+    amount_bands = max(len(band_data) for date in dates for band_data in timeseries[date])
+    values = np.full((len(dates), amount_fields, amount_bands), np.nan, dtype=dtype)
+    for d, date in enumerate(dates):
+        for f, band_data in enumerate(timeseries[date]):
+            if band_data:
+                values[d, f] = np.array(band_data, dtype=float)
+    return np.array(dates), values
+
+# function to encode the time series json for the UDF
+def encode_timeseries(timeseries, dtype=np.float64):
+    dates, values = timeseries_json_to_arrays(timeseries, dtype)
+    return {'encoding': UDF_ENCODING_NPY, 'dates': encode_array(dates), 'values': encode_array(values)}
+
+# function to encode the ids of the fields and the selected RO per orbit pass
+# (table of select_RO_fields) for the UDF context: per orbit pass an array with
+# per field the RO (-1 if none) and an array with the first date of the RO (NaT if none)
+def encode_context_fields(df_RO_selection, unique_ids_fields, orbit_passes=('ASCENDING', 'DESCENDING')):
+    fields_encoded = {'encoding': UDF_ENCODING_NPY, 'unique_ids_fields': encode_array(np.array(unique_ids_fields, dtype=str))}
+    for orbit_pass in orbit_passes:
+        df_pass = df_RO_selection[df_RO_selection['pass'] == orbit_pass].set_index('field').reindex(np.arange(len(unique_ids_fields)))
+        fields_encoded['RO_{}'.format(orbit_pass.lower())] = encode_array(df_pass['RO'].fillna(-1).values.astype(np.int32))
+        fields_encoded['first_date_{}'.format(orbit_pass.lower())] = encode_array(
+            pd.to_datetime(df_pass['first_date']).values.astype('datetime64[D]'))
+    return fields_encoded